@@ -12,7 +12,7 @@ import tkinter
 import cv2
 import PIL
 from PIL import Image, ImageTk
-from components import Stream, CameraManager
+from components import Stream, CameraManager, LiveTile, LiveGrid, FootageBrowser, ImageCatalog, ProbeService
 import os
 import sys
 import time
@@ -34,6 +34,8 @@ filepath = '../bin/'
 calibrated = True
 stream = ''
 default_stream = Stream(src = '')
+default_tile = None
+probes = ProbeService(window) # Tests camera connections without blocking the window
 
 '''
 -----------------------------------------------
@@ -45,36 +47,72 @@ FUNCTIONS
 
 def show_frame():
 	'''
-	Enables the user to view the chosen camera stream from the default_stream variable. Use update_stream to set default stream to a different source
+	Enables the user to view the chosen camera stream from the default_stream variable. Use update_stream to set default stream to a different source.
+	The frame is only converted and redrawn when the stream has a new frame, at half the size of the stream
 	'''
+	global default_tile
+
+	if default_stream.src == '':
+		video_stream.config(text = '[ERROR - GUI] No stream to show. Please make sure that you have selected a camera to stream. If the error persists, idk.')
+		return
+
 	btn_stream["state"] = "disabled"
 	btn_stream["text"] = "streaming..."
-	frame = default_stream.get_stream()
-	height, width, _ = frame.shape
-
-	div_factor = 2
-	if frame is not None:
-		#frame = cv2.flip(frame, 1)
-		frame = cv2.resize(frame, (int(width/div_factor),int(height/div_factor)))
-		cv2image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
-		img = PIL.Image.fromarray(cv2image)
-		imgtk = ImageTk.PhotoImage(image=img)
-		video_stream.imgtk = imgtk
-		video_stream.configure(image=imgtk)
-		video_stream.after(10, show_frame)
+
+	if default_tile is None or default_tile.stream is not default_stream:
+		default_tile = LiveTile(video_stream, default_stream, scale = 0.5)
+
+	if default_tile.render():
 		lbl_default.config(text = '')
-		#cv2.imshow('Live stream', cv2image)
-	else:
-		video_stream.config(text = '[ERROR - GUI] No stream to show. Please make sure that you have selected a camera to stream. If the error persists, idk.')
+	video_stream.after(40, show_frame) # Check for a new frame 25 times per second
+
+def show_grid():
+	'''
+	Creates a new window that shows the live streams of all saved cameras at once
+	'''
+	cam_list = CameraManager.list_cameras(filepath) or []
+
+	grid_window = tkinter.Toplevel(window)
+	grid_window.title("All cameras")
+
+	if not cam_list:
+		tkinter.Label(grid_window, text = "No cameras have been added.").pack()
+		return
+
+	grid = LiveGrid(grid_window, [(cam[0], Stream(src = cam[1])) for cam in cam_list])
+
+	def close_grid():
+		grid.stop()
+		for tile in grid.tiles:
+			tile.stream.release_stream(timeout = 0)
+		grid_window.destroy()
+
+	grid_window.protocol("WM_DELETE_WINDOW", close_grid)
+	grid.start()
+
+def show_footage():
+	'''
+	Creates a new window in which the saved footage of the cameras can be browsed by camera and time
+	'''
+	cam_list = CameraManager.list_cameras(filepath) or []
+
+	footage_window = tkinter.Toplevel(window)
+	footage_window.title("Saved footage")
+
+	browser = FootageBrowser(footage_window, ImageCatalog(filepath + 'catalog.db'), [cam[0] for cam in cam_list])
+
+	def close_footage():
+		browser.stop()
+		browser.catalog.close()
+		footage_window.destroy()
+
+	footage_window.protocol("WM_DELETE_WINDOW", close_footage)
 
 def show_cameras():
 	'''
 	Creates a new window, and displays the names of all saved cameras as buttons. These buttons are used to update the source of default_stream
 	'''
-	cam_list = []
-
-	if CameraManager.list_cameras(filepath):
-		cam_list = CameraManager.list_cameras(filepath)
+	cam_list = CameraManager.list_cameras(filepath) or []
 
 	cam_window = tkinter.Tk()
 	cam_window.title("Select a stream")
@@ -90,10 +128,7 @@ def delete_cameras():
 	'''
 	Creates a new window, and displays the names of all saved cameras as buttons. These buttons are used to delete saved cameras
 	'''
-	cam_list = []
-
-	if CameraManager.list_cameras(filepath):
-		cam_list = CameraManager.list_cameras(filepath)
+	cam_list = CameraManager.list_cameras(filepath) or []
 
 	cam_window = tkinter.Tk()
 	cam_window.title("Delete a camera")
@@ -110,24 +145,43 @@ def update_stream(window, source):
 	Updates the source of default_stream
 	'''
 	global default_stream
+	default_stream.release_stream(timeout = 0)
 	default_stream  = Stream(src = source)
 	window.destroy()
 
 def test_stream(label, src, timeout = 7):
 	'''
-	Ensures that the provided information successfully connects to a camera by testing the 'ret' value from cv2.read()
+	Ensures that the provided information successfully connects to a camera. The test runs in the background, and the label is updated once it is done.
+	A local video file, or a full url (e.g. rtsp://127.0.0.1:8554/test), can be entered as the IPv4 address to test against a stand-in camera
 	'''
-	start_time = time.time()
-	t_stream = Stream(src = src)
-	ret = None
-	while time.time() - start_time <= timeout:
-		ret = t_stream.get_stream()
-	status = ''
-	if ret is not None:
-		status = 'Connection success, a stream is available: ' + src
-	else:
-		status = 'Stream not available: ' + src
-	label.config(text = status)
+	label.config(text = 'Testing ' + src + '...')
+	probes.submit(src, lambda result: label.config(text = ProbeService.describe(result)), timeout = timeout)
+
+def test_cameras():
+	'''
+	Creates a new window, and tests the connections of all saved cameras at the same time
+	'''
+	cam_list = CameraManager.list_cameras(filepath) or []
+
+	test_window = tkinter.Toplevel(window)
+	test_window.title("Camera connections")
+
+	if not cam_list:
+		tkinter.Label(test_window, text = "No cameras have been added.").pack()
+		return
+
+	for cam in cam_list:
+		lbl_status = tkinter.Label(test_window, text = cam[0] + ': testing...')
+		lbl_status.pack(anchor = 'w')
+		probes.submit(cam[1], lambda result, label = lbl_status, name = cam[0]: label.config(text = name + ': ' + ProbeService.describe(result)))
+
+def test_source(user, password, ip, port, extras):
+	'''
+	Builds the source that is tested from the fields of the add camera window. A video file or full url in the address field is tested as is
+	'''
+	if os.path.isfile(ip) or '://' in ip:
+		return ip
+	return str(user) + ':' + str(password) + '@' + str(ip) + ':' + str(port) + str(extras)
 
 def add_camera():
 	'''
@@ -151,7 +205,7 @@ def add_camera():
 
 	# Buttons
 
-	btn_test = tkinter.Button(add_window, text = "Test connection", command = lambda: test_stream(lbl_connection_status, str(entry_user.get()) + ':' + str(entry_password.get()) + '@' + str(entry_ip.get()) + ':' + str(entry_port.get()) + str(entry_extras.get())))
+	btn_test = tkinter.Button(add_window, text = "Test connection", command = lambda: test_stream(lbl_connection_status, test_source(entry_user.get(), entry_password.get(), entry_ip.get(), entry_port.get(), entry_extras.get())))
 	btn_add = tkinter.Button(add_window, text = "Add camera", command = lambda: CameraManager.save_camera(filepath, add_window, entry_name.get(), str(entry_user.get()) + ':' + str(entry_password.get()) + '@' + str(entry_ip.get()) + ':' + str(entry_port.get()) + str(entry_extras.get())))
 
 	# Input fields
@@ -207,6 +261,9 @@ btn_add = tkinter.Button(window, text = "Add a camera", command = add_camera)
 btn_detele = tkinter.Button(window, text = "Delete a camera", command = delete_cameras)
 btn_calibrate = tkinter.Button(window, text = "Run")
 btn_stream = tkinter.Button(window, text = "Show stream", command = show_frame)
+btn_grid = tkinter.Button(window, text = "Show all cameras", command = show_grid)
+btn_footage = tkinter.Button(window, text = "Saved footage", command = show_footage)
+btn_test_all = tkinter.Button(window, text = "Test cameras", command = test_cameras)
 
 video_stream = tkinter.Label(window)
 
@@ -216,8 +273,11 @@ btn_stream.grid(row=0, column = 1)
 btn_add.grid(row = 0, column = 2)
 btn_detele.grid(row = 0, column = 3)
 btn_calibrate.grid(row = 0, column = 4)
+btn_grid.grid(row = 0, column = 5)
+btn_footage.grid(row = 0, column = 6)
+btn_test_all.grid(row = 0, column = 7)
 lbl_default.grid(row = 3, columnspan = 2, sticky = 'W')
-video_stream.grid(columnspan = 5, sticky = 'W')
+video_stream.grid(columnspan = 8, sticky = 'W')
 
 # Application loop
 
@@ -0,0 +1,115 @@
+'''
+-----------------------------------------------
+title: benchmark_decode.py
+description: Measures the time and the peak resident memory it takes to decode the saved images in a folder, for every
+             decoding mode that the ImageLoader can use. Run on the Pi over a folder of real captures, e.g. python3 benchmark_decode.py ../bin/storage
+-----------------------------------------------
+'''
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import cv2
+import imutils
+
+from components_reduced import ImageLoader
+
+MODES = [
+    ('full colour', lambda path: cv2.imread(path, cv2.IMREAD_COLOR)),
+    ('full greyscale', lambda path: cv2.imread(path, cv2.IMREAD_GRAYSCALE)),
+    ('reduced colour 2', lambda path: cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_2)),
+    ('reduced colour 4', lambda path: cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_4)),
+    ('reduced colour 8', lambda path: cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_8)),
+    ('reduced greyscale 2', lambda path: cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_2)),
+    ('reduced greyscale 4', lambda path: cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)),
+    ('reduced greyscale 8', lambda path: cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)),
+    # What the consumers actually ask for
+    ('full colour + resize 700', lambda path: resize_700(path)),
+    ('loader colour 700', lambda path: ImageLoader.load(path, width=700, cached=False)),
+    ('loader greyscale 64', lambda path: ImageLoader.load(path, width=64, grayscale=True, cached=False)),
+]
+
+
+def resize_700(path):
+    # The way the scanners loaded images before the ImageLoader existed
+    image = cv2.imread(path)
+    if image is None:
+        return None
+    return imutils.resize(image, width=700)
+
+
+def benchmark(files, index):
+    '''
+    Decodes every file once with the mode at the given index of MODES, and returns the average decode time, the average
+    size of the decoded image and how far decoding raised the peak resident set size of the process.
+    Run in a fresh process per mode, since the peak RSS can not be reset and freed memory stays resident for reuse.
+    The RSS is measured instead of using tracemalloc, which does not see the native allocations of libjpeg and OpenCV
+    '''
+    name, decode = MODES[index]
+    total_time = 0
+    total_bytes = 0
+    decoded = 0
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+
+    for path in files:
+        start_time = time.perf_counter()
+        image = decode(path)
+        total_time = total_time + time.perf_counter() - start_time
+
+        if image is None:
+            continue
+        decoded = decoded + 1
+        total_bytes = total_bytes + image.nbytes
+        image = None
+
+    if decoded == 0:
+        return None
+
+    return {
+        'mode': name,
+        'images': decoded,
+        'ms_per_image': 1000 * total_time / decoded,
+        'kib_per_image': total_bytes / decoded / 1024,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark JPEG decoding modes over a folder of captures')
+    parser.add_argument('folder', help='folder containing .jpg captures')
+    parser.add_argument('--limit', type=int, default=200, help='maximum number of images to decode per mode')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.folder, '*.jpg')))[:args.limit]
+    if not files:
+        print("[ERROR - benchmark_decode] No .jpg files found in " + args.folder)
+        raise SystemExit(1)
+
+    print("[INFO - benchmark_decode] Decoding {} images per mode\n".format(len(files)))
+    print("{:<26}{:>14}{:>16}{:>14}".format('mode', 'ms/image', 'KiB/image', 'peak RSS KiB'))
+
+    # Read every file once beforehand so that every mode reads from a warm page cache
+    for path in files:
+        with open(path, 'rb') as f:
+            f.read()
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for index, (name, decode) in enumerate(MODES):
+        with context.Pool(1) as pool:
+            result = pool.apply(benchmark, (files, index))
+        if result is None:
+            continue
+        results.append(result)
+        print("{:<26}{:>14.2f}{:>16.1f}{:>14}".format(
+            name, result['ms_per_image'], result['kib_per_image'], result['peak_rss_kib']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
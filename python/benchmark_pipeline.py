@@ -0,0 +1,297 @@
+'''
+-----------------------------------------------
+title: benchmark_pipeline.py
+description: Replays local video files, or generated scenes, through the complete chain of the system (motion detection, the
+             frame writer, human detection, the SimilarityDetector and the StorageManager) without any cameras, and reports
+             the frames per second of every stage, the total CPU time and its mean per camera, the CPU time of every camera's
+             capture thread, the peak RSS, the bytes written and the files kept.
+             Every run happens in a temporary directory, so the real ../bin/ is never touched.
+             e.g. python3 benchmark_pipeline.py --synthetic 4 --scene walker --json results.json
+                  python3 benchmark_pipeline.py --video driveway.mp4 --cameras 2 --pace max
+-----------------------------------------------
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from components_reduced import (SystemPipeline, StorageManager, CameraConfig, UsageLedger, HumanDetectorUtil,
+                                FRAMES_CAPTURED, FRAMES_SAVED, BYTES_SAVED)
+
+
+# === SYNTHETIC SCENES ===
+
+def background(width, height, rng):
+    # A fixed random texture, so that the frames are not trivially compressible
+    texture = rng.integers(40, 200, size=(height // 8, width // 8, 3), dtype=np.uint8)
+    return cv2.resize(texture, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def static_scene(index, base, rng, fps):
+    # Sensor noise only, which the motion detector should ignore
+    noise = rng.integers(-4, 5, size=base.shape, dtype=np.int16)
+    return np.clip(base.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def walker_scene(index, base, rng, fps):
+    # A person sized block crosses the scene during 5 of every 15 seconds
+    frame = static_scene(index, base, rng, fps)
+    height, width = frame.shape[:2]
+    t = (index / fps) % 15
+    if t < 5:
+        x = int((width - width // 10) * t / 5)
+        cv2.rectangle(frame, (x, height // 3), (x + width // 10, height // 3 + height // 2), (30, 30, 30), -1)
+    return frame
+
+
+def busy_scene(index, base, rng, fps):
+    # Several blobs moving all the time, and a flickering light, so that almost every frame is saved
+    frame = static_scene(index, base, rng, fps)
+    height, width = frame.shape[:2]
+    for blob in range(4):
+        x = int((index * (3 + blob) * width / 200 + blob * width / 4) % width)
+        y = int(height / 5 * (blob + 1))
+        cv2.circle(frame, (x, y), height // 12, (20 + 50 * blob, 80, 200), -1)
+    if (index // fps) % 4 == 0:
+        frame = cv2.convertScaleAbs(frame, alpha=1.3)
+    return frame
+
+
+SCENES = {
+    'static': static_scene,
+    'walker': walker_scene,
+    'busy': busy_scene,
+}
+
+
+def generate_scene(path, scene, seconds, fps, width, height, seed):
+    '''
+    Writes a generated scene to path as an MJPG video, which decodes as cheaply as the cameras' streams
+    '''
+    rng = np.random.default_rng(seed)
+    base = background(width, height, rng)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    for index in range(int(seconds * fps)):
+        writer.write(SCENES[scene](index, base, rng, fps))
+    writer.release()
+    return path
+
+
+# === MEASUREMENTS ===
+
+def thread_cpu(native_id):
+    '''
+    Returns the CPU seconds used by a thread of this process, or None where /proc is not available
+    '''
+    try:
+        with open('/proc/self/task/{}/stat'.format(native_id)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def count_files(directory):
+    files = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        files = files + sum(1 for name in filenames if ' - ' in name)
+    return files
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class NoHumanDetector:
+    '''
+    Stands in for the HumanDetectorUtil with --no-humans, to measure the rest of the chain on its own
+    '''
+
+    def detect(self, frame):
+        return False
+
+    def detect_file(self, path):
+        return False
+
+
+# === BENCHMARK ===
+
+def run(sources, work_dir, pace, duration, capture_interval, motion_workers, classify_workers, no_humans, segments):
+    '''
+    Replays the sources, a list of (camera name, video file) tuples, through a SystemPipeline, and returns the results
+    pace : 'realtime' to read the files at their frame rate, looping them for duration seconds, or 'max' to read every file
+           once as fast as the pipeline takes the frames. In max pace every decoded frame is fed to the pipeline: the streams
+           only read the next frame once the last one was taken, and the motion queue blocks instead of dropping frames
+    '''
+    bin_dir = os.path.join(work_dir, pace, 'bin') + '/'
+    storage_dir = bin_dir + 'storage/'
+    os.makedirs(storage_dir, exist_ok=True)
+
+    config = CameraConfig.get(bin_dir)
+    for name, path in sources:
+        config.add(name, path)
+
+    ledger = UsageLedger()
+    storage_manager = StorageManager(storage_dir, interval=1, space=0, critical_space=0,
+                                     camera_dirs=[bin_dir + name + '/' for name, path in sources],
+                                     log_file=bin_dir + 'retention.log', ledger=ledger)
+    detector_util = NoHumanDetector() if no_humans else HumanDetectorUtil()
+    pipeline = SystemPipeline(storage_manager, segments=segments, ledger=ledger, config=config, detector_util=detector_util,
+                              filter_interval=0, capture_interval=capture_interval, motion_workers=motion_workers,
+                              classify_workers=classify_workers, bin_dir=bin_dir,
+                              motion_policy='drop_oldest' if pace == 'realtime' else 'block',
+                              stream_options={'test_source': True, 'pace': pace == 'realtime', 'loop': pace == 'realtime',
+                                              'lockstep': pace == 'max'})
+
+    before = {name: (FRAMES_CAPTURED.labels(name).value, FRAMES_SAVED.labels(name).value, BYTES_SAVED.labels(name).value)
+              for name, path in sources}
+    cpu_start = time.process_time()
+    start = time.time()
+    pipeline.start()
+
+    while time.time() - start < duration:
+        time.sleep(0.5)
+        if pace == 'max' and len(pipeline.detectors) == len(sources) and \
+                all(MD.Stream.finished for MD in pipeline.detectors.values()):
+            break
+
+    capture_cpu = {name: thread_cpu(MD.Stream.thread.native_id) for name, MD in pipeline.detectors.items()}
+    pipeline.stop(timeout=60)
+    elapsed = time.time() - start
+    cpu = time.process_time() - cpu_start
+
+    stages = {}
+    for stage, stats in pipeline.stats().items():
+        stages[stage] = {
+            'processed': stats['processed'],
+            'fps': stats['processed'] / elapsed,
+            'dropped': stats['dropped'],
+            'errors': stats['errors'],
+            'busy_seconds': stats['busy_seconds'],
+            'mean_latency': stats['mean_latency'],
+            'max_latency': stats['max_latency'],
+        }
+
+    cameras = {}
+    for name, path in sources:
+        captured, saved, written = before[name]
+        cameras[name] = {
+            'source': path,
+            'frames_captured': FRAMES_CAPTURED.labels(name).value - captured,
+            'capture_fps': (FRAMES_CAPTURED.labels(name).value - captured) / elapsed,
+            'frames_saved': FRAMES_SAVED.labels(name).value - saved,
+            'bytes_written': BYTES_SAVED.labels(name).value - written,
+            'capture_cpu_seconds': capture_cpu.get(name),
+            'files_kept': count_files(bin_dir + name),
+        }
+
+    return {
+        'pace': pace,
+        'cameras': len(sources),
+        'elapsed_seconds': elapsed,
+        'cpu_seconds': cpu,
+        'mean_cpu_seconds_per_camera': cpu / len(sources),  # Total divided by the cameras, not measured per camera
+        'cpu_utilisation': cpu / elapsed,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'bytes_written': sum(camera['bytes_written'] for camera in cameras.values()),
+        'files_kept': sum(camera['files_kept'] for camera in cameras.values()),
+        'files_in_storage': count_files(storage_dir),
+        'stages': stages,
+        'per_camera': cameras,
+    }
+
+
+def print_result(result):
+    print("\n[INFO - benchmark_pipeline] {} pace, {} cameras, {:.1f} s, {:.1f} CPU s ({:.1f} mean per camera), peak RSS {:.0f} MiB".format(
+        result['pace'], result['cameras'], result['elapsed_seconds'], result['cpu_seconds'], result['mean_cpu_seconds_per_camera'],
+        result['peak_rss_mib']))
+    print("{:<12}{:>12}{:>10}{:>10}{:>14}{:>14}".format('stage', 'processed', 'fps', 'dropped', 'mean lat. s', 'max lat. s'))
+    for stage, stats in result['stages'].items():
+        print("{:<12}{:>12}{:>10.1f}{:>10}{:>14.3f}{:>14.3f}".format(
+            stage, stats['processed'], stats['fps'], stats['dropped'], stats['mean_latency'], stats['max_latency']))
+    print("{:.1f} MiB written, {} files kept, {} files moved to storage".format(
+        result['bytes_written'] / 2**20, result['files_kept'], result['files_in_storage']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the complete pipeline on local video files or generated scenes')
+    parser.add_argument('--video', action='append', default=[], help='video file to replay, may be given more than once')
+    parser.add_argument('--cameras', type=int, default=1, help='number of cameras that replay every video file')
+    parser.add_argument('--synthetic', type=int, default=0, help='number of cameras that replay a generated scene')
+    parser.add_argument('--scene', choices=sorted(SCENES), default='walker', help='generated scene')
+    parser.add_argument('--seconds', type=float, default=30, help='length of the generated scenes')
+    parser.add_argument('--fps', type=int, default=10, help='frame rate of the generated scenes')
+    parser.add_argument('--resolution', default='1280x720', help='resolution of the generated scenes')
+    parser.add_argument('--pace', choices=['realtime', 'max', 'both'], default='both',
+                        help='read the files at their frame rate (looped), as fast as possible (once), or both')
+    parser.add_argument('--duration', type=float, default=60, help='seconds per realtime run, and the limit of a max run')
+    parser.add_argument('--capture-interval', type=float, default=None,
+                        help='seconds between frames taken from every camera, 1 (as the system) for realtime, 0.001 for max')
+    parser.add_argument('--motion-workers', type=int, default=2)
+    parser.add_argument('--classify-workers', type=int, default=2)
+    parser.add_argument('--no-humans', action='store_true', help='skip human detection')
+    parser.add_argument('--segments', action='store_true', help='write segment files instead of one file per frame')
+    parser.add_argument('--work-dir', help='directory for the generated scenes and the written frames, a temporary one if not given')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    if not args.video and args.synthetic == 0:
+        parser.error('give at least one --video or --synthetic camera')
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='benchmark_pipeline_')
+    os.makedirs(os.path.join(work_dir, 'videos'), exist_ok=True)
+    width, height = (int(v) for v in args.resolution.split('x'))
+
+    # Every camera gets its own file name, since the camera config rejects cameras with the same source
+    sources = []
+    for i, video in enumerate(args.video):
+        for j in range(args.cameras):
+            link = os.path.join(work_dir, 'videos', 'video{}-{}{}'.format(i, j, os.path.splitext(video)[1]))
+            if not os.path.exists(link):
+                os.symlink(os.path.abspath(video), link)
+            sources.append(('Replay {}-{}'.format(i, j), link))
+    if args.synthetic:
+        print("[INFO - benchmark_pipeline] Generating {} {} scenes of {} s".format(args.synthetic, args.scene, args.seconds))
+    for i in range(args.synthetic):
+        path = os.path.join(work_dir, 'videos', '{}-{}.avi'.format(args.scene, i))
+        generate_scene(path, args.scene, args.seconds, args.fps, width, height, seed=i)
+        sources.append(('Synthetic {}'.format(i), path))
+
+    results = []
+    for pace in (['realtime', 'max'] if args.pace == 'both' else [args.pace]):
+        capture_interval = args.capture_interval
+        if capture_interval is None:
+            capture_interval = 1 if pace == 'realtime' else 0.001
+        result = run(sources, work_dir, pace, args.duration, capture_interval, args.motion_workers, args.classify_workers,
+                     args.no_humans, args.segments)
+        print_result(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'commit': git_commit(),
+                'machine': platform.machine(),
+                'python': platform.python_version(),
+                'opencv': cv2.__version__,
+                'settings': vars(args),
+                'results': results,
+            }, f, indent=2)
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
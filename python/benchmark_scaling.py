@@ -0,0 +1,227 @@
+'''
+-----------------------------------------------
+title: benchmark_scaling.py
+description: Finds how many cameras one node can handle before the 1 fps sampling of the MotionDetectorLFR starts slipping.
+             For every configuration (resolution and frame rate of the simulated cameras), SystemMotionDetection and
+             SystemFiltering are started against N looping video files, and N is ramped up. Every step records the sampling
+             interval and its jitter, the time from reading a frame to having saved it, and how saturated the motion detection
+             thread and the CPUs are. The result is a capacity curve per configuration.
+             e.g. python3 benchmark_scaling.py --config 640x360@10 --config 1280x720@15 --json scaling.json
+                  python3 benchmark_scaling.py --video driveway.mp4 --steps 1,2,4,8
+-----------------------------------------------
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+import cv2
+
+from components_reduced import (SystemMotionDetection, SystemFiltering, CameraConfig, HumanDetectorUtil, SAMPLE_INTERVAL, FRAME_SECONDS,
+                                SAVE_LATENCY, FILTER_BACKLOG, FRAMES_CAPTURED)
+from benchmark_pipeline import SCENES, generate_scene, thread_cpu, git_commit, NoHumanDetector
+
+
+def snapshot(histogram, cameras):
+    '''
+    Returns the bucket counts, summed over the cameras, and the sum of the observations of a histogram
+    '''
+    counts = [0] * (len(histogram.buckets) + 1)
+    total = 0.0
+    for name in cameras:
+        child = histogram.labels(name)
+        with child.lock:
+            counts = [a + b for a, b in zip(counts, child.counts)]
+            total = total + child.sum
+    return counts, total
+
+
+def difference(after, before):
+    return [a - b for a, b in zip(after[0], before[0])], after[1] - before[1]
+
+
+def quantile(buckets, counts, q):
+    '''
+    Estimates a quantile from histogram bucket counts, interpolating within the bucket. Returns None without observations,
+    and the largest bucket bound if the quantile lies above every bucket
+    '''
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(buckets, counts):
+        if count > 0 and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative = cumulative + count
+        lower = bound
+    return float(buckets[-1])
+
+
+def run_step(sources, bin_dir, warmup, seconds, filter_interval, detector_util, tolerance):
+    '''
+    Runs the system against the sources, a list of (camera name, video file) tuples, and measures it after the warmup
+    '''
+    config = CameraConfig.get(bin_dir)
+    for name, path in sources:
+        config.add(name, path)
+    cameras = [name for name, path in sources]
+
+    stop = threading.Event()
+    detection = threading.Thread(target=SystemMotionDetection.start, kwargs={
+        'config': config, 'bin_dir': bin_dir, 'stop': stop, 'stream_options': {'test_source': True, 'pace': True, 'loop': True}})
+    filtering = threading.Thread(target=SystemFiltering.start, kwargs={
+        'filter_interval': filter_interval, 'config': config, 'bin_dir': bin_dir, 'detector_util': detector_util, 'stop': stop})
+    detection.start()
+    filtering.start()
+
+    time.sleep(warmup)  # Covers opening the streams and the frames that the background subtractors skip
+    before = {
+        'intervals': snapshot(SAMPLE_INTERVAL, cameras),
+        'frames': snapshot(FRAME_SECONDS, cameras),
+        'latency': snapshot(SAVE_LATENCY, cameras),
+        'captured': sum(FRAMES_CAPTURED.labels(name).value for name in cameras),
+        'cpu': time.process_time(),
+        'thread_cpu': thread_cpu(detection.native_id),
+        'time': time.time(),
+    }
+    backlog = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        time.sleep(min(1, max(0, end - time.time())))
+        backlog = max(backlog, sum(FILTER_BACKLOG.labels(name).value for name in cameras))
+    elapsed = time.time() - before['time']
+    intervals = difference(snapshot(SAMPLE_INTERVAL, cameras), before['intervals'])
+    frames = difference(snapshot(FRAME_SECONDS, cameras), before['frames'])
+    latency = difference(snapshot(SAVE_LATENCY, cameras), before['latency'])
+    captured = sum(FRAMES_CAPTURED.labels(name).value for name in cameras) - before['captured']
+    cpu = time.process_time() - before['cpu']
+    detection_cpu = thread_cpu(detection.native_id)
+
+    stop.set()
+    detection.join(30)
+    filtering.join(30)
+
+    samples = sum(intervals[0])
+    p95 = quantile(SAMPLE_INTERVAL.buckets, intervals[0], 0.95)
+    rate = samples / len(cameras) / elapsed
+    return {
+        'cameras': len(cameras),
+        'seconds': elapsed,
+        'samples_per_camera_per_second': rate,
+        'sample_interval_p50': quantile(SAMPLE_INTERVAL.buckets, intervals[0], 0.5),
+        'sample_interval_p95': p95,
+        'sample_interval_p99': quantile(SAMPLE_INTERVAL.buckets, intervals[0], 0.99),
+        'sample_interval_mean': intervals[1] / samples if samples else None,
+        'jitter_p95': p95 - 1 if p95 is not None else None,
+        'save_latency_p50': quantile(SAVE_LATENCY.buckets, latency[0], 0.5),
+        'save_latency_p95': quantile(SAVE_LATENCY.buckets, latency[0], 0.95),
+        'frames_saved': sum(latency[0]),
+        'capture_fps_per_camera': captured / len(cameras) / elapsed,
+        'detection_thread_load': frames[1] / elapsed,  # Fraction of the time the detection thread spent on frames, 1 = saturated
+        'detection_thread_cpu': (detection_cpu - before['thread_cpu']) / elapsed
+                                if detection_cpu is not None and before['thread_cpu'] is not None else None,
+        'process_cpu': cpu / elapsed,
+        'cpu_saturation': cpu / elapsed / (os.cpu_count() or 1),
+        'filter_backlog_max': backlog,
+        'keeps_up': p95 is not None and p95 <= 1 + tolerance and rate >= 0.95,
+    }
+
+
+def print_step(step):
+    def number(value, digits=3):
+        return '-' if value is None else '{:.{}f}'.format(value, digits)
+    print("{:>8}{:>10}{:>10}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}".format(
+        step['cameras'], number(step['samples_per_camera_per_second'], 2), number(step['sample_interval_p50']),
+        number(step['sample_interval_p95']), number(step['jitter_p95']), number(step['save_latency_p95']),
+        number(step['detection_thread_load'], 2), number(step['cpu_saturation'], 2), 'yes' if step['keeps_up'] else 'NO'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ramp up the number of simulated cameras until motion detection falls behind')
+    parser.add_argument('--config', action='append', default=[],
+                        help='resolution and frame rate of generated cameras, e.g. 1280x720@15, may be given more than once')
+    parser.add_argument('--video', action='append', default=[], help='video file that every camera loops, one configuration per file')
+    parser.add_argument('--scene', choices=sorted(SCENES), default='walker', help='generated scene')
+    parser.add_argument('--files', type=int, default=4, help='number of different generated files that the cameras share')
+    parser.add_argument('--scene-seconds', type=float, default=30, help='length of the generated files, which are looped')
+    parser.add_argument('--steps', default='1,2,4,8,16,32', help='numbers of cameras to try, in order')
+    parser.add_argument('--step-seconds', type=float, default=60, help='seconds measured per step')
+    parser.add_argument('--warmup', type=float, default=25, help='seconds before measuring, motion detection skips the first 20 samples')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='seconds that the 95th percentile sampling interval may exceed 1 s')
+    parser.add_argument('--filter-interval', type=float, default=1, help='minutes between the passes of the SimilarityDetectors')
+    parser.add_argument('--no-humans', action='store_true', help='skip human detection when ranking bursts')
+    parser.add_argument('--keep-going', action='store_true', help='try every step, instead of stopping at the first that falls behind')
+    parser.add_argument('--work-dir', help='directory for the generated files and the saved frames, a temporary one if not given')
+    parser.add_argument('--json', help='also write the capacity curves to this file')
+    args = parser.parse_args()
+
+    configs = args.config if args.config or args.video else ['640x360@10', '1280x720@15']
+    steps = [int(n) for n in args.steps.split(',')]
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='benchmark_scaling_')
+    detector_util = NoHumanDetector() if args.no_humans else HumanDetectorUtil()
+
+    runs = [(video, None) for video in args.video] + [(None, config) for config in configs]
+    curves = []
+    for video, config in runs:
+        label = os.path.basename(video) if video is not None else config
+        config_dir = os.path.join(work_dir, label.replace('@', '-'))
+        os.makedirs(config_dir, exist_ok=True)
+        if video is not None:
+            files = [os.path.abspath(video)]
+        else:
+            resolution, fps = config.split('@')
+            width, height = (int(v) for v in resolution.split('x'))
+            print("[INFO - benchmark_scaling] Generating {} {} scenes at {}".format(args.files, args.scene, config))
+            files = [generate_scene(os.path.join(config_dir, '{}-{}.avi'.format(args.scene, i)), args.scene, args.scene_seconds,
+                                    int(fps), width, height, seed=i) for i in range(args.files)]
+
+        print("\n[INFO - benchmark_scaling] {}".format(label))
+        print("{:>8}{:>10}{:>10}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}".format(
+            'cameras', 'samples/s', 'p50 int.', 'p95 int.', 'jitter', 'p95 save', 'det. load', 'CPU', 'keeps up'))
+        curve = []
+        for n in steps:
+            step_dir = os.path.join(config_dir, '{}-cameras'.format(n))
+            bin_dir = os.path.join(step_dir, 'bin') + '/'
+            os.makedirs(bin_dir + 'storage/', exist_ok=True)
+            # Every camera gets its own file name, since the camera config rejects cameras with the same source
+            sources = []
+            for i in range(n):
+                link = os.path.join(step_dir, 'camera{}{}'.format(i, os.path.splitext(files[i % len(files)])[1]))
+                if not os.path.exists(link):
+                    os.symlink(files[i % len(files)], link)
+                sources.append(('Camera {}'.format(i), link))
+
+            step = run_step(sources, bin_dir, args.warmup, args.step_seconds, args.filter_interval, detector_util, args.tolerance)
+            print_step(step)
+            curve.append(step)
+            shutil.rmtree(step_dir, ignore_errors=True)
+            if not step['keeps_up'] and not args.keep_going:
+                break
+
+        capacity = max([step['cameras'] for step in curve if step['keeps_up']], default=0)
+        print("[INFO - benchmark_scaling] {} keeps up with {} cameras".format(label, capacity))
+        curves.append({'configuration': label, 'video': video, 'capacity': capacity, 'curve': curve})
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'commit': git_commit(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'python': platform.python_version(),
+                'opencv': cv2.__version__,
+                'settings': vars(args),
+                'curves': curves,
+            }, f, indent=2)
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
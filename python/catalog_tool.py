@@ -0,0 +1,106 @@
+'''
+-----------------------------------------------
+title: catalog_tool.py
+description: Command line tool to inspect the image catalog and bring it in line with what is on disk.
+             e.g. python3 catalog_tool.py check
+                  python3 catalog_tool.py rebuild
+                  python3 catalog_tool.py oldest --camera Cam --non-human --limit 500
+                  python3 catalog_tool.py events --camera Cam --start "2020-11-09 14:00" --end "2020-11-09 14:30" --human
+-----------------------------------------------
+'''
+
+import argparse
+import datetime
+import time
+
+from components_reduced import CameraManager, ImageCatalog
+
+
+def catalog_directories(bin_dir):
+    '''
+    Returns the (directory, state) tuples of all directories that the running system stores images in
+    '''
+    directories = [(bin_dir + 'storage/', 'redundant')]
+    for cam in CameraManager.list_cameras(bin_dir) or []:
+        directories.append((bin_dir + cam[0] + '/', 'kept'))
+    return directories
+
+
+def parse_time(value):
+    '''
+    Accepts 'YYYY-MM-DD HH:MM[:SS]', or 'HH:MM[:SS]' for today, and returns a UNIX timestamp
+    '''
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        moment = datetime.time.fromisoformat(value)
+        return datetime.datetime.combine(datetime.date.today(), moment).timestamp()
+
+
+def parse_cursor(value):
+    captured, rowid = value.split(',')
+    return (float(captured), int(rowid))
+
+
+def print_rows(rows):
+    for path, camera, captured, size, human, cluster, state in rows:
+        human = '?' if human is None else ('yes' if human else 'no')
+        print("{}  {:<12} {:>9}  human: {:<4} {:<10} {}".format(
+            datetime.datetime.fromtimestamp(captured).strftime('%Y-%m-%d %H:%M:%S'), camera, size, human, state, path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect and repair the image catalog')
+    parser.add_argument('--bin', default='../bin/', help='directory in which the system stores its data')
+    parser.add_argument('--db', default=None, help='catalog database, defaults to <bin>/catalog.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('check', help='report differences between the catalog and the disk, without changing anything')
+    commands.add_parser('rebuild', help='scan the disk and correct the catalog')
+    commands.add_parser('usage', help='show the bytes used per camera')
+
+    oldest = commands.add_parser('oldest', help='list the oldest images')
+    oldest.add_argument('--camera')
+    oldest.add_argument('--limit', type=int, default=500)
+    oldest.add_argument('--non-human', action='store_true', help='only images without (known) humans')
+    oldest.add_argument('--state', choices=['kept', 'redundant'])
+
+    events = commands.add_parser('events', help='list the images captured in a time range')
+    events.add_argument('--camera')
+    events.add_argument('--start', type=parse_time, help="'YYYY-MM-DD HH:MM' or 'HH:MM' for today")
+    events.add_argument('--end', type=parse_time, help="'YYYY-MM-DD HH:MM' or 'HH:MM' for today, exclusive")
+    events.add_argument('--human', dest='human', action='store_true', default=None, help='only images with humans')
+    events.add_argument('--no-human', dest='human', action='store_false', help='only images without (known) humans')
+    events.add_argument('--limit', type=int, default=100, help='images per page')
+    events.add_argument('--after', type=parse_cursor, help='cursor printed with the previous page')
+
+    args = parser.parse_args()
+    catalog = ImageCatalog(args.db if args.db is not None else args.bin + 'catalog.db')
+
+    if args.command in ('check', 'rebuild'):
+        start_time = time.time()
+        result = catalog.rebuild(catalog_directories(args.bin), dry_run=args.command == 'check')
+        print("[INFO - catalog_tool] {} missing, {} stale, {} out of date ({:.1f} s)".format(
+            result['added'], result['removed'], result['updated'], time.time() - start_time))
+
+    elif args.command == 'usage':
+        for camera, size in sorted(catalog.usage().items()):
+            print("{:<20} {:>10.1f} MiB".format(camera, size / 2**20))
+
+    elif args.command == 'oldest':
+        start_time = time.time()
+        rows = catalog.oldest(camera=args.camera, limit=args.limit,
+                              human=False if args.non_human else None, state=args.state)
+        print_rows(rows)
+        print("[INFO - catalog_tool] {} images in {:.1f} ms".format(len(rows), 1000 * (time.time() - start_time)))
+
+    elif args.command == 'events':
+        start_time = time.time()
+        rows, cursor = catalog.events(camera=args.camera, start=args.start, end=args.end,
+                                      human=args.human, limit=args.limit, after=args.after)
+        print_rows(rows)
+        print("[INFO - catalog_tool] {} images in {:.1f} ms".format(len(rows), 1000 * (time.time() - start_time)))
+        if cursor is not None:
+            print("[INFO - catalog_tool] Next page: --after {!r},{}".format(cursor[0], cursor[1]))
+
+    catalog.close()
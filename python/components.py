@@ -10,6 +10,7 @@ for: Project (E) 448, Department of Electric and Electronic Engineering, Univers
 import cv2
 import PIL
 from PIL import Image, ImageTk
+import tkinter
 import pickle
 import sys
 import os
@@ -23,6 +24,11 @@ from threading import Lock, Thread
 import glob
 import shutil
 import random
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import FrameStore, ImageCatalog, CameraConfig
 
 # === STREAM ====
 
@@ -50,33 +56,62 @@ class Stream:
 
     last_frame = None
     last_ready = None
-    lock = Lock()
 
-    def __init__(self, src='', test_source=False):
+    def __init__(self, src='', test_source=False, timeout=None, pace=False):
+        '''
+        src : rtsp source without the 'rtsp://' prefix, '0' for the webcam, or any source that cv2.VideoCapture accepts if test_source is set
+        test_source : open src as is, e.g. a local video file or a loopback rtsp server
+        timeout : seconds after which opening the source or reading a frame is given up, the backend default if None
+        pace : read a video file at its own frame rate, as a camera would deliver it, instead of as fast as it decodes
+        '''
         global cap
         self.src = src
+        self.pace = pace
+        self.lock = Lock()  # Every stream has its own lock, so that streams do not wait for each other's frames
+        self.frame_count = 0  # Number of frames read so far, so that consumers can tell when a new frame has arrived
+        self.running = True  # Cleared by release_stream to stop the reading thread
 
         if not test_source:
             if src == '0' or src == ':@0:':  # Enable webcam support
                 self.cap = cv2.VideoCapture(0)
             else:
                 rtsp_string = 'rtsp://' + src
-                self.cap = cv2.VideoCapture(rtsp_string)
+                self.cap = Stream.open_capture(rtsp_string, timeout)
         else:
-            self.cap = cv2.VideoCapture(src)
+            self.cap = Stream.open_capture(src, timeout)
 
         # From https://stackoverflow.com/questions/51722319/skip-frames-and-seek-to-end-of-rtsp-stream-in-opencv
-        thread = threading.Thread(target=self.rtsp_cam_buffer, args=(
+        self.thread = threading.Thread(target=self.rtsp_cam_buffer, args=(
             self.cap,), name="rtsp_read_thread")
-        thread.daemon = True
-        thread.start()
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open_capture(source, timeout=None):
+        if timeout is None:
+            return cv2.VideoCapture(source)
+        timeout_ms = int(timeout * 1000)
+        return cv2.VideoCapture(source, cv2.CAP_ANY, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout_ms,
+                                                      cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout_ms])
 
     # From https://stackoverflow.com/questions/51722319/skip-frames-and-seek-to-end-of-rtsp-stream-in-opencv
 
     def rtsp_cam_buffer(self, capture):
-        while True:
+        frame_interval = 1 / (capture.get(cv2.CAP_PROP_FPS) or 25) if self.pace else 0
+        next_frame = time.time()
+        while self.running:
+            if self.pace:
+                next_frame = max(next_frame + frame_interval, time.time() - 1)  # Do not catch up on more than a second
+                time.sleep(max(0, next_frame - time.time()))
+            ready, frame = capture.read()  # Wait for the frame without holding the lock
             with self.lock:
-                self.last_ready, self.last_frame = capture.read()
+                self.last_ready, self.last_frame = ready, frame
+                if ready:
+                    self.frame_count = self.frame_count + 1
+            if not ready:
+                time.sleep(0.05)  # The source is closed or not available, do not spin on it
+
+        # The capture is released by the thread that reads it, so that it is never released in the middle of a read
+        capture.release()
 
     def get_stream(self):
         '''
@@ -91,6 +126,16 @@ class Stream:
         else:
             return None
 
+    def get_new_frame(self, seen=0):
+        '''
+        Returns (frame_count, frame) if a newer frame than the frame numbered seen is available, otherwise (seen, None).
+        The frame is not copied, so it must not be modified
+        '''
+        with self.lock:
+            if not self.last_ready or self.last_frame is None or self.frame_count == seen:
+                return seen, None
+            return self.frame_count, self.last_frame
+
     def refresh_stream(self):
         self.cap = None
         time.sleep(2)
@@ -100,11 +145,553 @@ class Stream:
             rtsp_string = 'rtsp://' + self.src
             self.cap = cv2.VideoCapture(rtsp_string)
 
-    def release_stream(self):
-        self.cap.release()
+    def release_stream(self, timeout=2):
+        '''
+        Stops the reading thread, which releases the capture. Waits at most timeout seconds for a read that is in progress
+        '''
+        self.running = False
+        self.thread.join(timeout)
         self.cap = None
 
 
+# === LIVE VIEW ===
+
+class LiveTile:
+    '''
+    Shows the frames of a stream in a tkinter Label. A tile only renders when the stream has a new frame, and converts the frame
+    straight to the size at which it is displayed. The resize and colour conversion write into buffers that are allocated once,
+    and the PIL image shares the memory of the colour converted buffer, so the only copy per frame is PhotoImage.paste().
+    '''
+
+    def __init__(self, label, stream, width=None, scale=0.5):
+        '''
+        label : tkinter Label in which the frames are shown
+        stream : Stream of which the frames are shown
+        width : display width, the height follows from the aspect ratio of the stream
+        scale : display size relative to the size of the stream, used if no width is given
+        '''
+        self.label = label
+        self.stream = stream
+        self.width = width
+        self.scale = scale
+        self.count = 0  # frame_count of the frame that is shown
+        self.size = None
+        self.photo = None
+
+    def display_size(self, frame):
+        height, width = frame.shape[:2]
+        if self.width is not None:
+            return (self.width, max(1, int(height * self.width / width)))
+        return (max(1, int(width * self.scale)), max(1, int(height * self.scale)))
+
+    def allocate(self, size):
+        self.size = size
+        self.resized = np.empty((size[1], size[0], 3), np.uint8)
+        self.rgba = np.empty((size[1], size[0], 4), np.uint8)
+        # PIL maps RGBA buffers instead of copying them, so the image follows the contents of self.rgba
+        self.image = Image.frombuffer('RGBA', size, self.rgba, 'raw', 'RGBA', 0, 1)
+        self.photo = ImageTk.PhotoImage('RGBA', size, master=self.label)
+        self.label.configure(image=self.photo)
+
+    def render(self):
+        '''
+        Shows the newest frame of the stream. Returns False if there was no new frame
+        '''
+        count, frame = self.stream.get_new_frame(self.count)
+        if frame is None:
+            return False
+
+        size = self.display_size(frame)
+        if size != self.size:
+            self.allocate(size)
+
+        cv2.resize(frame, size, dst=self.resized, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGBA, dst=self.rgba)
+        self.photo.paste(self.image)
+        self.count = count
+        return True
+
+
+class LiveGrid:
+    '''
+    Shows the live streams of several cameras at once, in a grid of LiveTiles. A single timer drives all tiles, and the total
+    number of tile renders per second is capped with a token bucket, so that the cost of the view does not grow with the
+    number of cameras or with their frame rates. Tiles are visited round robin, so that every camera gets its turn when the
+    cap is reached.
+    '''
+
+    def __init__(self, master, cameras, tile_width=320, max_renders=30, columns=None, tick=20):
+        '''
+        master : tkinter widget in which the grid is placed
+        cameras : list of (name, Stream) tuples
+        tile_width : display width of every tile
+        max_renders : maximum number of tile renders per second, for all tiles together
+        columns : number of columns, defaults to the smallest square grid that fits all cameras
+        tick : interval between checks for new frames, in milliseconds
+        '''
+        self.master = master
+        self.max_renders = max_renders
+        self.tick = tick
+        self.tiles = []
+        self.next_tile = 0
+        self.tokens = 0
+        self.last_tick = time.time()
+        self.job = None
+
+        if columns is None:
+            columns = max(1, int(np.ceil(np.sqrt(len(cameras)))))
+
+        for i, (name, stream) in enumerate(cameras):
+            row, column = divmod(i, columns)
+            tkinter.Label(master, text=name).grid(row=2*row, column=column)
+            label = tkinter.Label(master, text='Waiting for ' + name + '...')
+            label.grid(row=2*row + 1, column=column, padx=2, pady=2)
+            self.tiles.append(LiveTile(label, stream, width=tile_width))
+
+    def start(self):
+        self.last_tick = time.time()
+        self.job = self.master.after(self.tick, self.update)
+
+    def stop(self):
+        if self.job is not None:
+            self.master.after_cancel(self.job)
+            self.job = None
+
+    def update(self):
+        now = time.time()
+        # Unused renders are saved up for at most one round of all tiles
+        self.tokens = min(self.tokens + (now - self.last_tick) * self.max_renders, len(self.tiles))
+        self.last_tick = now
+
+        for i in range(len(self.tiles)):
+            if self.tokens < 1:
+                break
+            tile = self.tiles[(self.next_tile + i) % len(self.tiles)]
+            if tile.render():
+                self.tokens = self.tokens - 1
+        if self.tiles:
+            self.next_tile = (self.next_tile + 1) % len(self.tiles)
+
+        self.job = self.master.after(self.tick, self.update)
+
+# === CAMERA PROBE ===
+
+class ProbeService:
+    '''
+    Tests camera sources on worker threads, so that the GUI stays responsive while a camera is connected to, and so that many
+    cameras can be tested at the same time. Every probe opens the source, waits for the first frame, counts the frames that
+    arrive during measure_time, and releases the stream again, whether it succeeded or not.
+
+    Results are passed to a callback. If a tkinter master is given, the callbacks are called from its main loop, since tkinter
+    may only be used from the thread that runs it.
+    '''
+
+    def __init__(self, master=None, max_workers=8, poll_interval=100):
+        '''
+        master : tkinter widget from whose main loop the callbacks are called, the worker threads call them if None
+        max_workers : number of sources that are tested at the same time
+        poll_interval : interval at which finished probes are delivered to the main loop, in milliseconds
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.master = master
+        self.poll_interval = poll_interval
+        self.lock = Lock()
+        self.finished = []  # (callback, result) tuples still to be delivered to the main loop
+        self.job = None
+        if master is not None:
+            self.job = master.after(poll_interval, self.deliver)
+
+    def probe(src, timeout=7, measure_time=2, test_source=None):
+        '''
+        Tests a single source, and returns a dictionary with:
+         - ok : True if frames were received
+         - time_to_first_frame : seconds from opening the source to the first frame
+         - resolution : (width, height) of the frames
+         - fps : frames received per second while measuring
+         - error : why the test failed
+        test_source : open src as is (a video file or a loopback rtsp url), detected from src if None
+        A video file is read at its own frame rate, so that its fps is that of the file and not how fast it decodes
+        '''
+        if test_source is None:
+            test_source = os.path.isfile(src) or '://' in src
+
+        result = {'src': src, 'ok': False, 'time_to_first_frame': None, 'resolution': None, 'fps': None, 'error': None}
+        start = time.time()
+        stream = None
+        try:
+            stream = Stream(src=src, test_source=test_source, timeout=timeout, pace=os.path.isfile(src))
+            if not stream.cap.isOpened():
+                result['error'] = 'Could not open the source'
+                return result
+
+            count, frame = 0, None
+            while frame is None and time.time() - start < timeout:
+                count, frame = stream.get_new_frame(0)
+                if frame is None:
+                    time.sleep(0.01)
+            if frame is None:
+                result['error'] = 'No frame within {} seconds'.format(timeout)
+                return result
+
+            result['time_to_first_frame'] = time.time() - start
+            result['resolution'] = (frame.shape[1], frame.shape[0])
+
+            measure_start = time.time()
+            time.sleep(max(0, min(measure_time, timeout - (measure_start - start))))
+            elapsed = time.time() - measure_start
+            if elapsed > 0:
+                result['fps'] = (stream.frame_count - count) / elapsed
+            result['ok'] = True
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            if stream is not None:
+                stream.release_stream()
+        return result
+
+    def describe(result):
+        if not result['ok']:
+            return 'Stream not available: ' + result['src'] + ' (' + str(result['error']) + ')'
+        fps = '{:.1f} fps'.format(result['fps']) if result['fps'] is not None else 'fps unknown'
+        return 'Connection success, first frame after {:.1f} s, {}x{}, {}: {}'.format(
+            result['time_to_first_frame'], result['resolution'][0], result['resolution'][1], fps, result['src'])
+
+    def submit(self, src, callback, timeout=7, measure_time=2, test_source=None):
+        '''
+        Starts testing a source, and calls callback with the result once the test is done. Returns the Future of the test
+        '''
+        def run():
+            result = ProbeService.probe(src, timeout, measure_time, test_source)
+            if self.master is None:
+                callback(result)
+            else:
+                with self.lock:
+                    self.finished.append((callback, result))
+            return result
+
+        return self.executor.submit(run)
+
+    def submit_all(self, sources, callback, timeout=7, measure_time=2):
+        '''
+        Tests all sources concurrently, callback is called once per source
+        '''
+        return [self.submit(src, callback, timeout, measure_time) for src in sources]
+
+    def deliver(self):
+        with self.lock:
+            finished = self.finished
+            self.finished = []
+        for callback, result in finished:
+            callback(result)
+        self.job = self.master.after(self.poll_interval, self.deliver)
+
+    def close(self):
+        if self.job is not None:
+            self.master.after_cancel(self.job)
+            self.job = None
+        self.executor.shutdown(wait=False)
+
+# === FOOTAGE BROWSER ===
+
+class BackgroundLoader:
+    '''
+    Loads images on a worker thread, and keeps the most recently used ones in memory. Every request replaces the images that
+    are still waiting to be loaded, so that the worker always works on what the user is looking at now, and never on the
+    frames that were selected a second ago.
+
+    Tkinter may only be used from its own thread, so the GUI polls ready() for the images that were loaded, instead of being
+    called back from the worker.
+    '''
+
+    def __init__(self, load, capacity=64):
+        '''
+        load : function that loads the image with the given key, returns None if it can not be loaded
+        capacity : number of images kept in memory
+        '''
+        self.load = load
+        self.capacity = capacity
+        self.images = OrderedDict()  # key -> image, least recently used first
+        self.wanted = []  # keys still to be loaded, the first one first
+        self.loaded = []  # keys loaded since the last call to ready()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.work, name="background_loader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, key):
+        with self.condition:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def request(self, keys):
+        with self.condition:
+            self.wanted = [key for key in keys if key not in self.images]
+            self.condition.notify()
+
+    def ready(self):
+        with self.condition:
+            loaded = self.loaded
+            self.loaded = []
+            return loaded
+
+    def close(self):
+        '''
+        Stops the worker once it has finished the image it is loading, and drops the images in memory
+        '''
+        with self.condition:
+            self.stopped = True
+            self.wanted = []
+            self.images.clear()
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.wanted and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key = self.wanted.pop(0)
+
+            image = self.load(key)
+            if image is None:
+                continue
+
+            with self.condition:
+                if self.stopped:
+                    return
+                self.images[key] = image
+                while len(self.images) > self.capacity:
+                    self.images.popitem(last=False)
+                self.loaded.append(key)
+
+
+class ThumbnailStore:
+    '''
+    Thumbnails of saved frames, generated once and kept on disk, so that browsing a day of footage never decodes the full
+    resolution images again. Thumbnails are stored as <cache_dir>/<xx>/<sha1 of the image path>.jpg.
+    '''
+
+    def __init__(self, cache_dir='../bin/thumbnails/', width=160):
+        self.cache_dir = cache_dir
+        self.width = width
+
+    def thumbnail_path(self, path):
+        digest = hashlib.sha1(os.path.normpath(path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.jpg')
+
+    def load(self, path):
+        '''
+        Returns the thumbnail of the frame at path, generating it if it does not exist yet
+        '''
+        thumbnail_path = self.thumbnail_path(path)
+        if os.path.isfile(thumbnail_path):
+            thumbnail = cv2.imread(thumbnail_path)
+            if thumbnail is not None:
+                return thumbnail
+
+        thumbnail = FrameStore.load_path(path, width=self.width)
+        if thumbnail is None:
+            return None
+
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        tmp_file = thumbnail_path + '.tmp.jpg'
+        cv2.imwrite(tmp_file, thumbnail, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        os.replace(tmp_file, thumbnail_path)
+        return thumbnail
+
+
+class FootageBrowser:
+    '''
+    Pane to review saved footage: lists the events of a camera on a day from the ImageCatalog, shows a strip of thumbnails
+    around the selected event, and the selected frame itself.
+
+    Thumbnails come from a ThumbnailStore on one worker, and the frames are loaded lazily on another worker, which prefetches
+    the neighbours of the selected frame, so that stepping through the list with the arrow keys does not wait for a decode.
+    The events of a day are fetched a page at a time with the keyset pagination of the catalog: the first page when the day is
+    shown, and the next page whenever the list is scrolled or stepped to near its end, so that a busy day never blocks the GUI.
+    '''
+
+    def __init__(self, master, catalog, cameras, strip_size=7, frame_width=960, prefetch=3, page_size=500):
+        '''
+        master : tkinter widget in which the browser is placed
+        catalog : ImageCatalog of the saved frames
+        cameras : names of the cameras that can be browsed
+        strip_size : number of thumbnails shown around the selected event
+        frame_width : width at which the selected frame is shown
+        prefetch : number of frames before and after the selected frame that are loaded in advance
+        page_size : number of events fetched from the catalog at a time
+        '''
+        self.master = master
+        self.catalog = catalog
+        self.strip_size = strip_size
+        self.prefetch = prefetch
+        self.page_size = page_size
+
+        self.rows = []  # catalog rows of the listed events
+        self.query = None  # arguments of catalog.events() for the listed day
+        self.cursor = None  # cursor of the next page of events, None once the whole day is listed
+        self.page_pending = False  # the next page is loaded once tkinter is idle
+        self.selected = None
+        self.strip_paths = []  # paths of the events in the thumbnail strip
+        self.photos = {}  # label -> PhotoImage shown in it, so that tkinter does not garbage collect them
+
+        self.thumbnails = BackgroundLoader(ThumbnailStore().load, capacity=512)
+        self.frames = BackgroundLoader(lambda path: FrameStore.load_path(path, width=frame_width), capacity=2*prefetch + 8)
+
+        # Controls
+        controls = tkinter.Frame(master)
+        self.camera = tkinter.StringVar(master, value=cameras[0] if cameras else '')
+        self.day = tkinter.StringVar(master, value=datetime.date.today().isoformat())
+        self.human_only = tkinter.BooleanVar(master, value=False)
+        tkinter.OptionMenu(controls, self.camera, *(cameras or [''])).pack(side='left')
+        tkinter.Entry(controls, textvariable=self.day, width=10).pack(side='left')
+        tkinter.Checkbutton(controls, text="Humans only", variable=self.human_only).pack(side='left')
+        tkinter.Button(controls, text="Show events", command=self.list_events).pack(side='left')
+        self.status = tkinter.Label(controls, text='')
+        self.status.pack(side='left')
+        controls.grid(row=0, column=0, columnspan=2, sticky='W')
+
+        # Event list
+        scrollbar = tkinter.Scrollbar(master)
+        self.scrollbar = scrollbar
+        self.listbox = tkinter.Listbox(master, width=24, height=30, yscrollcommand=self.scrolled, exportselection=False)
+        scrollbar.config(command=self.listbox.yview)
+        self.listbox.bind('<<ListboxSelect>>', lambda event: self.select())
+        self.listbox.grid(row=1, column=0, rowspan=2, sticky='NS')
+        scrollbar.grid(row=1, column=1, rowspan=2, sticky='NS')
+
+        # Thumbnail strip and selected frame
+        strip = tkinter.Frame(master)
+        self.strip = [tkinter.Label(strip) for i in range(strip_size)]
+        for label in self.strip:
+            label.pack(side='left', padx=1)
+        strip.grid(row=1, column=2, sticky='W')
+        self.view = tkinter.Label(master, text="Select an event")
+        self.view.grid(row=2, column=2)
+
+        self.job = self.master.after(50, self.poll)
+
+    def list_events(self):
+        '''
+        Lists the events of the selected camera on the selected day
+        '''
+        try:
+            start = datetime.datetime.fromisoformat(self.day.get())
+        except ValueError:
+            self.status.config(text="Enter the day as YYYY-MM-DD")
+            return
+        end = start + datetime.timedelta(days=1)
+
+        self.query = {'camera': self.camera.get(), 'start': start.timestamp(), 'end': end.timestamp(),
+                      'human': True if self.human_only.get() else None}
+        self.rows = []
+        self.cursor = None
+        self.listbox.delete(0, 'end')
+        self.load_page()
+
+        # Thumbnails of the listed events are generated in the background, starting at the top of the list
+        self.thumbnails.request([row[0] for row in self.rows])
+        if self.rows:
+            self.listbox.selection_set(0)
+            self.select()
+
+    def load_page(self):
+        '''
+        Appends the next page of events to the list. Every page is a single indexed query of page_size rows
+        '''
+        rows, self.cursor = self.catalog.events(limit=self.page_size, after=self.cursor, **self.query)
+        self.rows.extend(rows)
+        for path, camera, captured, size, human, cluster, state in rows:
+            self.listbox.insert('end', datetime.datetime.fromtimestamp(captured).strftime('%H:%M:%S') +
+                                ('  human' if human else '') + ('  ' + state if state in ('redundant', 'timelapse') else ''))
+        self.status.config(text="{}{} events".format(len(self.rows), '+' if self.cursor is not None else ''))
+
+    def load_more(self, index):
+        '''
+        Loads the next page once the event at index is within a strip of the end of the list
+        '''
+        if self.cursor is not None and index >= len(self.rows) - self.strip_size:
+            self.load_page()
+
+    def scrolled(self, first, last):
+        self.scrollbar.set(first, last)
+        if self.cursor is not None and float(last) >= 0.9 and not self.page_pending:
+            # Called from within the listbox's redraw, so the next page is added once the redraw is done
+            self.page_pending = True
+            self.master.after_idle(self.load_pending_page)
+
+    def load_pending_page(self):
+        self.page_pending = False
+        if self.cursor is not None:
+            self.load_page()
+
+    def select(self):
+        selection = self.listbox.curselection()
+        if not selection:
+            return
+        index = selection[0]
+        self.load_more(index)
+        self.selected = self.rows[index][0]
+
+        first = max(0, index - self.strip_size // 2)
+        self.strip_paths = [row[0] for row in self.rows[first:first + self.strip_size]]
+
+        # The selected frame first, then its neighbours, nearest first
+        neighbours = [index]
+        for offset in range(1, self.prefetch + 1):
+            neighbours.extend([index + offset, index - offset])
+        self.frames.request([self.rows[i][0] for i in neighbours if 0 <= i < len(self.rows)])
+
+        # Thumbnails of the strip first, then the rest of the day from the selection onwards
+        self.thumbnails.request(self.strip_paths + [row[0] for row in self.rows[index:]] + [row[0] for row in self.rows[:index]])
+
+        self.show_strip()
+        self.show_frame()
+
+    def show_image(self, label, image):
+        if image is None:
+            return False
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        photo = ImageTk.PhotoImage(image=Image.fromarray(rgb), master=label)
+        label.configure(image=photo, text='')
+        self.photos[label] = photo
+        return True
+
+    def show_strip(self):
+        for i, label in enumerate(self.strip):
+            if i < len(self.strip_paths):
+                path = self.strip_paths[i]
+                label.configure(relief='solid' if path == self.selected else 'flat', borderwidth=2)
+                if not self.show_image(label, self.thumbnails.get(path)):
+                    label.configure(image='', text='...')
+            else:
+                label.configure(image='', text='')
+
+    def show_frame(self):
+        if not self.show_image(self.view, self.frames.get(self.selected)):
+            self.view.configure(image='', text="Loading...")
+
+    def poll(self):
+        '''
+        Shows the thumbnails and frames that the workers loaded since the previous poll
+        '''
+        if self.selected is not None:
+            if set(self.thumbnails.ready()) & set(self.strip_paths):
+                self.show_strip()
+            if self.selected in self.frames.ready():
+                self.show_frame()
+        self.job = self.master.after(50, self.poll)
+
+    def stop(self):
+        self.master.after_cancel(self.job)
+        self.thumbnails.close()
+        self.frames.close()
+
 # === MOTION DETECTOR ===
 
 
@@ -692,33 +1279,103 @@ class SimilarityDetector:
 # === SIMILARITY DETECTOR 2 ===
 
 class SimilarityDetector2:
+    '''
+    Compares every saved image to the image that was saved before it, and moves images that are too similar to the storage directory.
+
+    The detector works incrementally. A cursor (modification time and name of the last processed image) is persisted in the working
+    directory, together with the descriptors of that image, which serves as the reference for the next image. Every pass therefore
+    only decodes the images that arrived since the previous pass, and the time per pass does not grow with the size of the directory.
+    '''
 
-    first_image = None
     first_pass_completed = True
 
-    def __init__(self, work_in_dir, interval, similarity_thresh=93):
+    def __init__(self, work_in_dir, interval, similarity_thresh=93, storage_dir='../bin/storage/', cursor_file=None):
         '''
         work_in_dir : path to the directory in which the class must find images
         interval : interval between directory checks, in minutes
+        storage_dir : directory to which images that are too similar are moved
+        cursor_file : file in which the cursor is persisted, defaults to a hidden file in work_in_dir
         '''
         self.last_check_time = time.time()
         self.wid = work_in_dir
         self.interval = interval*60
-        self.imgs_in_dir = 0
         self.similarity_thresh = similarity_thresh
+        self.storage_dir = storage_dir
 
-    def determine_similarity(self, prev_frame, current_frame):
-        # FROM https://stackoverflow.com/questions/11541154/checking-images-for-similarity-with-opencv
-        prev_frame = imutils.resize(prev_frame, 700)
-        current_frame = imutils.resize(current_frame, 700)
+        if cursor_file is None:
+            cursor_file = os.path.join(self.wid, '.similarity_cursor.pickle')
+        self.cursor_file = cursor_file
+
+        self.cursor = (0, '')  # (mtime, name) of the last processed image
+        self.reference = None  # Descriptors of the last processed image
+        self.dir_mtime = None  # Modification time of the directory during the last pass
+        self.seen = set()  # Names of images in the directory that have already been processed
+        self.load_cursor()
 
-        first_image_hist = cv2.calcHist(
-            [prev_frame], [0], None, [256], [0, 256])
-        second_image_hist = cv2.calcHist(
-            [current_frame], [0], None, [256], [0, 256])
+    def load_cursor(self):
+        if not os.path.isfile(self.cursor_file):
+            return
+
+        try:
+            with open(self.cursor_file, 'rb') as f:
+                state = pickle.load(f)
+            self.cursor = state['cursor']
+            self.reference = state['reference']
+            print("[INFO - SimilarityDetector2] Resuming " + self.wid + " after " + self.cursor[1])
+        except Exception as e:
+            print("[ERROR - SimilarityDetector2] Could not read cursor file, starting from scratch: ", e)
+
+    def save_cursor(self):
+        # Write to a temporary file first, so that a crash can never leave a half written cursor behind
+        tmp_file = self.cursor_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'cursor': self.cursor,
+                         'reference': self.reference}, f)
+        os.replace(tmp_file, self.cursor_file)
+
+    def new_images(self):
+        '''
+        Returns a list of (mtime, name) tuples of images that have not been processed yet, oldest first.
+        Only images that were not seen during a previous pass are stat'ed
+        '''
+        names = set()
+        new = []
+
+        with os.scandir(self.wid) as it:
+            for entry in it:
+                if not entry.name.endswith('.jpg'):
+                    continue
+                names.add(entry.name)
+                if entry.name in self.seen:
+                    continue
+                try:
+                    key = (entry.stat().st_mtime, entry.name)
+                except FileNotFoundError:  # Removed since the directory was listed
+                    continue
+                if key > self.cursor:
+                    new.append(key)
+                else:
+                    self.seen.add(entry.name)
+
+        # Forget images that are no longer in the directory, so that the set stays the size of the directory
+        self.seen &= names
+        new.sort()
+        return new
+
+    def describe(self, frame):
+        '''
+        Computes the descriptors used for comparison once per image: the resized frame and its histogram
+        '''
+        frame = imutils.resize(frame, 700)
+        hist = cv2.calcHist([frame], [0], None, [256], [0, 256])
+        return (frame, hist)
+
+    def compare(self, prev_descriptors, current_descriptors):
+        prev_frame, prev_hist = prev_descriptors
+        current_frame, current_hist = current_descriptors
 
         img_hist_diff = cv2.compareHist(
-            first_image_hist, second_image_hist, cv2.HISTCMP_CORREL)
+            prev_hist, current_hist, cv2.HISTCMP_CORREL)
         img_template_probability_match = cv2.matchTemplate(
             prev_frame, current_frame, cv2.TM_CCOEFF_NORMED)[0][0]
 
@@ -728,71 +1385,205 @@ class SimilarityDetector2:
               commutative_image_match)
         return commutative_image_match
 
+    def determine_similarity(self, prev_frame, current_frame):
+        # FROM https://stackoverflow.com/questions/11541154/checking-images-for-similarity-with-opencv
+        return self.compare(self.describe(prev_frame), self.describe(current_frame))
+
     def match_and_filter(self):
 
-        # avg_time = 0
         if self.first_pass_completed:
-            # Check that time of interval has passed
-            if (time.time() - self.last_check_time < self.interval) or self.imgs_in_dir == len(os.listdir(self.wid)) or len(os.listdir(self.wid)) < 2:
+            # Check that time of interval has passed, and that images were added to or removed from the directory.
+            # A single stat of the directory replaces listing it
+            if time.time() - self.last_check_time < self.interval:
+                return
+            if os.stat(self.wid).st_mtime == self.dir_mtime:
                 return
 
-        print(
-            "[INFO - SimilarityDetector2] Starting matching and filtering of saved images...\n")
-
+        self.first_pass_completed = True
         self.last_check_time = time.time()  # Update the last checked time
-        # Updates the number of images in the directory in the latest check.
-        self.imgs_in_dir = len(os.listdir(self.wid))
-        # These two variables help to optimise the filtering process by only performing the process at specific intervals, and also only when
-        # the number of images in the indicated directory has changed
-        files = glob.glob(self.wid + '/*.jpg')
-        files.sort(key=os.path.getmtime)
+        self.dir_mtime = os.stat(self.wid).st_mtime
 
-        for img_name in files:
+        files = self.new_images()
+        if not files:
+            return
 
-            if self.first_image is None:
-                self.first_image = cv2.imread(img_name)
-                self.first_pass_completed = True
-                continue
+        print(
+            "[INFO - SimilarityDetector2] Starting matching and filtering of {} new images...\n".format(len(files)))
 
+        for mtime, name in files:
+            img_name = os.path.join(self.wid, name)
             image = cv2.imread(img_name)
 
-            SIM = self.determine_similarity(self.first_image, image)
+            if image is None:
+                if time.time() - mtime < 60:  # The image is probably still being written, try again during the next pass
+                    break
+                print("[ERROR - SimilarityDetector2] Skipping unreadable image " + name)
+                self.cursor = (mtime, name)
+                continue
 
-            if SIM > self.similarity_thresh:
-                '''
-                Save the image if the similarity is less than the set threshold
-                '''
-                print("[DEBUG - SimilarityDetector2] Image below threshold found")
-                os.rename(img_name, "../bin/storage/" +
-                          img_name[19:])  # Move the image
+            descriptors = self.describe(image)
+            kept = True
 
-            self.first_image = image
+            if self.reference is not None:
+                SIM = self.compare(self.reference, descriptors)
 
-            # avg_time = avg_time + time.time() - cur_time
+                if SIM > self.similarity_thresh:
+                    '''
+                    Only keep the image in the working directory if the similarity is less than the set threshold
+                    '''
+                    print("[DEBUG - SimilarityDetector2] Image below threshold found")
+                    os.rename(img_name, os.path.join(
+                        self.storage_dir, name))  # Move the image
+                    kept = False
+
+            if kept:
+                self.seen.add(name)
+            self.reference = descriptors
+            self.cursor = (mtime, name)
+
+        self.save_cursor()
 
-        # avg_time = avg_time/imgs_processed
 
+# === PERCEPTUAL HASH INDEX ===
+
+
+class PerceptualHash:
+    '''
+    Computes a difference hash (dHash) of an image. The image is shrunk to (hash_size + 1) x hash_size greyscale pixels,
+    and every bit of the hash records whether a pixel is brighter than its right hand neighbour. Images that look alike
+    end up with hashes that differ in only a few bits, so the Hamming distance between two hashes is used as the
+    measure of how similar the images are.
+    '''
+
+    def dhash(image, hash_size=8):
+        '''
+        image : BGR or greyscale image
+        hash_size : the hash will contain hash_size * hash_size bits
         '''
-		print("[TESTING] Processing of this dataset took {} second, on average, per image".format(avg_time))
-		print("[TESTING] A total of {} positives were identified from {} images".format(
-		    id_positives, imgs_processed))
-		print("[TESTING] {} of the images were correctly identified as positive".format(
-		    ac_positives))
-		'''
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        small = cv2.resize(image, (hash_size + 1, hash_size),
+                           interpolation=cv2.INTER_AREA)
+        diff = small[:, 1:] > small[:, :-1]
+
+        return int.from_bytes(np.packbits(diff.flatten()).tobytes(), 'big')
+
+    def hamming(hash_a, hash_b):
+        return bin(hash_a ^ hash_b).count('1')
+
+    def from_file(path, hash_size=8):
+        '''
+        Decodes the image at an eighth of its resolution, since the hash only needs a handful of pixels.
+        Returns None if the file could not be read
+        '''
+        image = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if image is None:
+            return None
+        return PerceptualHash.dhash(image, hash_size)
+
+
+class BKTree:
+    '''
+    A Burkhard-Keller tree holding perceptual hashes, using the Hamming distance as metric.
+    Every child of a node is stored under its distance to that node, so that a search only has to visit the children
+    whose distance lies within max_distance of the distance between the query and the node (triangle inequality).
+    This keeps a lookup close to O(log n) for small search radii, instead of comparing against every stored hash.
+    '''
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+        self.empty = 0  # Nodes whose items have all been removed
+
+    def add(self, hash_value, item):
+        '''
+        Adds an item under the given hash. Items with identical hashes share a node
+        '''
+        self.size = self.size + 1
+
+        if self.root is None:
+            self.root = [hash_value, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = PerceptualHash.hamming(hash_value, node[0])
+            if distance == 0:
+                if not node[1]:
+                    self.empty = self.empty - 1
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, [item], {}]
+                return
+            node = child
+
+    def search(self, hash_value, max_distance):
+        '''
+        Returns a list of (distance, item) tuples for all items within max_distance of hash_value, closest first
+        '''
+        results = []
+        if self.root is None:
+            return results
+
+        candidates = [self.root]
+        while candidates:
+            node = candidates.pop()
+            distance = PerceptualHash.hamming(hash_value, node[0])
+            if distance <= max_distance:
+                for item in node[1]:
+                    results.append((distance, item))
+
+            for child_distance in node[2]:
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(node[2][child_distance])
+
+        results.sort(key=lambda r: r[0])
+        return results
+
+    def remove(self, hash_value, item):
+        '''
+        Removes an item stored under the given hash. Returns False if it is not in the tree.
+        The node itself stays in place, since its children are stored under their distance to it, but it no longer
+        returns any items. Nodes without items are counted in self.empty, so that the owner can rebuild the tree once
+        too many of them have piled up
+        '''
+        node = self.root
+        while node is not None:
+            distance = PerceptualHash.hamming(hash_value, node[0])
+            if distance == 0:
+                if item not in node[1]:
+                    return False
+                node[1].remove(item)
+                self.size = self.size - 1
+                if not node[1]:
+                    self.empty = self.empty + 1
+                return True
+            node = node[2].get(distance)
+        return False
+
+    def __len__(self):
+        return self.size
 
 # === SIMILARITY DETECTOR 3 ===
 
 
 class SimilarityDetector3:
     '''
-    The third version of the SD actually compares each image to all other images in the directory
-    The problem here is that it takes way too long, and simply yields bad results.
+    The third version of the SD compares each image to all other images in the directory.
+    The first implementation compared every pair of images and read both of them from disk for every comparison, which took way too long.
+    Each image is now decoded only once, reduced to a perceptual hash and stored in a BK-tree, so that all near duplicates of an image
+    are found with a single lookup. Near-duplicate groups across the whole directory are found in roughly O(n log n).
+
+    max_distance : maximum number of differing hash bits for two images to be seen as near duplicates.
+                   If not given, it is derived from similarity_thresh
     '''
 
-    first_image = None
     first_pass_completed = False
 
-    def __init__(self, work_in_dir, interval, similarity_thresh=93):
+    def __init__(self, work_in_dir, interval, similarity_thresh=93, max_distance=None, hash_size=8):
         '''
         work_in_dir : path to the directory in which the class must find images
         interval : interval between directory checks, in minutes
@@ -802,41 +1593,85 @@ class SimilarityDetector3:
         self.interval = interval*60
         self.imgs_in_dir = 0
         self.similarity_thresh = similarity_thresh
+        self.hash_size = hash_size
 
-        self.files = glob.glob(self.wid + '/*.jpg')
-        self.files.sort(key=os.path.getmtime)
+        if max_distance is None:
+            max_distance = int(
+                round((100 - similarity_thresh) / 100 * hash_size * hash_size))
+        self.max_distance = max_distance
 
-    def determine_similarity(self, prev_frame, current_frame):
-        # FROM https://stackoverflow.com/questions/11541154/checking-images-for-similarity-with-opencv
+        # Images that have been kept are remembered between passes, so that they are not decoded again
+        self.index = BKTree()
+        self.hashes = {}
 
-        first_image_hist = cv2.calcHist(
-            [prev_frame], [0], None, [256], [0, 256])
-        second_image_hist = cv2.calcHist(
-            [current_frame], [0], None, [256], [0, 256])
+    def group_near_duplicates(self, files):
+        '''
+        Groups the given files (sorted from oldest to newest) into near-duplicate groups. The first file of each group is the
+        oldest image, and the image that all other members of the group were matched to.
+        Returns a list of groups, each group being a list of file names
+        '''
+        groups = {}
+        order = []
 
-        img_hist_diff = cv2.compareHist(
-            first_image_hist, second_image_hist, cv2.HISTCMP_CORREL)
-        # img_template_probability_match = cv2.matchTemplate(prev_frame, current_frame, cv2.TM_CCOEFF_NORMED)[0][0]
+        for img_name in files:
 
-        # taking only 10% of histogram diff, since it's less accurate than template method
-        commutative_image_match = (img_hist_diff)*100
-        # print("[DEBUG - SimilarityDetector] Image similarity: ", commutative_image_match)
-        return commutative_image_match
+            if img_name in self.hashes:  # Kept during a previous pass, and already in the index
+                if img_name not in groups:
+                    groups[img_name] = [img_name]
+                    order.append(img_name)
+                continue
+
+            hash_value = PerceptualHash.from_file(img_name, self.hash_size)
+            if hash_value is None:  # Ignore corrupt or half written files
+                continue
+            self.hashes[img_name] = hash_value
+
+            matches = self.index.search(hash_value, self.max_distance)
+            if matches:
+                leader = matches[0][1]
+                if leader not in groups:  # The leader was kept during a previous pass
+                    groups[leader] = [leader]
+                    order.append(leader)
+                groups[leader].append(img_name)
+                continue
+
+            self.index.add(hash_value, img_name)
+            groups[img_name] = [img_name]
+            order.append(img_name)
+
+        return [groups[leader] for leader in order]
+
+    def forget_deleted(self, files):
+        '''
+        Removes the hashes of kept images that are no longer in the directory, e.g. because the StorageManager deleted them,
+        so that new images are not matched to leaders that no longer exist and the index does not grow without bound.
+        The tree is rebuilt from the remaining hashes once more than half of its nodes are empty
+        files : the images currently in the directory
+        '''
+        present = set(files)
+        deleted = [name for name in self.hashes if name not in present]
+        for name in deleted:
+            self.index.remove(self.hashes.pop(name), name)
+
+        if self.index.empty > len(self.index):
+            self.index = BKTree()
+            for name in files:
+                if name in self.hashes:
+                    self.index.add(self.hashes[name], name)
+
+        return len(deleted)
 
     def match_and_filter(self):
         start_time = time.time()
         '''
-		Perform human detection in all saved images using Histograms of Oriented Gradients for Human Detection
-		'''
+        Moves all near duplicates of an image to the storage directory, keeping only the oldest image of each group
+        '''
 
-        # avg_time = 0
         if self.first_pass_completed:
             # Check that time of interval has passed
             if (time.time() - self.last_check_time < self.interval) or self.imgs_in_dir == len(os.listdir(self.wid)) or len(os.listdir(self.wid)) < 2:
                 return
 
-        # print("[INFO - SimilarityDetector2] Starting matching and filtering of saved images...\n")
-
         self.first_pass_completed = True
 
         self.last_check_time = time.time()  # Update the last checked time
@@ -845,31 +1680,20 @@ class SimilarityDetector3:
         # These two variables help to optimise the filtering process by only performing the process at specific intervals, and also only when
         # the number of images in the indicated directory has changed
 
-        iter = 0
-        for img_name in self.files:
-            print("CHECKING IMAGE", img_name)
-            iter = iter + 1
-
-            for comp_image_name in self.files:
-
-                if comp_image_name == img_name:
-                    continue
-
-                image_current = cv2.imread(img_name)
-                image_compare = cv2.imread(comp_image_name)
-
-                SIM = self.determine_similarity(image_current, image_compare)
-
-                if SIM > self.similarity_thresh:
-                    '''
-                    Save the image if the similarity is less than the set threshold
-                    '''
-                    print("[DEBUG - SimilarityDetector3] Similar image found")
-                    os.rename(comp_image_name, "../bin/storage/" +
-                              comp_image_name[19:])  # Move the image
-                    self.files.remove(comp_image_name)
-
-        print("[INFO - SimilarityDetector3] Match and filter completed. Time:",
+        files = glob.glob(self.wid + '/*.jpg')
+        files.sort(key=os.path.getmtime)
+        self.forget_deleted(files)
+
+        moved = 0
+        for group in self.group_near_duplicates(files):
+            for comp_image_name in group[1:]:
+                print("[DEBUG - SimilarityDetector3] Similar image found")
+                os.rename(comp_image_name, "../bin/storage/" +
+                          os.path.basename(comp_image_name))  # Move the image
+                del self.hashes[comp_image_name]
+                moved = moved + 1
+
+        print("[INFO - SimilarityDetector3] Match and filter completed. {} images moved. Time:".format(moved),
               time.time() - start_time)
 
 # === STORAGE MANAGER ===
@@ -1012,58 +1836,26 @@ class CameraManager:
 
     def list_cameras(filepath):
         """
-        Reads the saved camera information from a .pickle file, and returns a list containing the information.
+        Returns a list containing the information of the saved cameras, or False if no cameras have been saved yet.
+        The file is only read again when it has changed (see CameraConfig).
         """
-
-        cam_list = []
-
-        if not os.path.isfile(filepath + 'saved_cameras.pickle'):
+        config = CameraConfig.get(filepath)
+        cam_list = config.list()
+        if not config.exists():
             print("[INFO - CameraManager] No saved cameras exist on this device yet")
             return False
 
-        f = open(filepath + 'saved_cameras.pickle', 'rb')
-        print("[INFO - CameraManager] Fetching saved cameras")
-        cam_dict = pickle.load(f)
-
-        for cam in cam_dict:
-            cam_list.append([cam, cam_dict[cam]])
-
-        f.close()
-
         return cam_list
 
     def save_camera(filepath, window, name, src):
         """
-        Writes the info of a new camera to the file. Also performs a check for file existence, and rejects duplicates
+        Writes the info of a new camera to the file. Rejects duplicates
         """
-
-        if not os.path.isfile(filepath + 'saved_cameras.pickle'):
-            print("[INFO - CameraManager] Creating save file")
-            f = open(filepath + 'saved_cameras.pickle', 'wb')
-            pickle.dump({}, f)
-            f.close()
-
-        f = open(filepath + 'saved_cameras.pickle', 'rb')
-
-        cam_dict = pickle.load(f)
-        for cam in cam_dict:
-            if cam_dict[cam] == src:
-                print(
-                    "[ERROR - CameraManager] A camera with this source has already been added. Rejecting duplicate")
-                f.close()
-                window.destroy()
-                return
-
-        f.close()
-
-        f = open(filepath + 'saved_cameras.pickle', 'wb')
         print("[INFO - CameraManager] Saving current camera")
-        cam_dict.update({name: src})
-
-        pickle.dump(cam_dict, f)
-        f.close()
-
-        print("[INFO - CameraManager] Camera saved")
+        if CameraConfig.get(filepath).add(name, src):
+            print("[INFO - CameraManager] Camera saved")
+        else:
+            print("[ERROR - CameraManager] A camera with this source has already been added. Rejecting duplicate")
 
         window.destroy()
 
@@ -1073,21 +1865,10 @@ class CameraManager:
         """
         Deletes a named camera from the saved file
         """
-
-        if not os.path.isfile(filepath + 'saved_cameras.pickle'):
-            print("[INFO - CameraManager] No saved cameras exist on this device yet")
-            return
-
-        f = open(filepath + 'saved_cameras.pickle', 'rb')
-        print("[INFO - CameraManager] Fetching saved cameras")
-        cam_dict = pickle.load(f)
-        f.close()
-
-        del cam_dict[name]
-        print("[INFO - CameraManager] " + name + " has been removed")
-        f = open(filepath + 'saved_cameras.pickle', 'wb')
-        pickle.dump(cam_dict, f)
-        f.close()
+        if CameraConfig.get(filepath).remove(name):
+            print("[INFO - CameraManager] " + name + " has been removed")
+        else:
+            print("[INFO - CameraManager] " + name + " is not a saved camera")
 
         window.destroy()
 
@@ -8,8 +8,6 @@ for: Project (E) 448, Department of Electric and Electronic Engineering, Univers
 '''
 
 import cv2
-import PIL
-from PIL import Image, ImageTk
 import pickle
 import sys
 import os
@@ -20,9 +18,436 @@ import imutils
 from imutils.object_detection import non_max_suppression
 import threading
 from threading import Lock, Thread
-import glob
 import shutil
-import random
+import heapq
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import socket
+import queue
+import bisect
+import contextlib
+import json
+import signal
+import urllib.parse
+import html
+import base64
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from storage import (ShardedLayout, ImageCatalog, DirectoryWatcher, DecodedImageCache, ImageLoader, FrameStore, FileFrameStore,
+                     SegmentFrameStore, TimelapseFrameStore, CameraChanges, CameraConfig)
+
+# === METRICS ===
+
+class Counter:
+    '''
+    A value that only goes up, e.g. the number of frames saved. Metrics with label names are split into one child per
+    combination of label values, get it with labels() once and keep it, so that the hot path only pays for inc().
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, help='', labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.children = {}  # label values -> child metric
+        self.value = 0.0
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, type(self)(self.name, self.help))
+        return child
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value = self.value + amount
+
+    def samples(self):
+        '''
+        Returns a list of (name suffix, {label: value}, value) tuples
+        '''
+        if self.labelnames:
+            samples = []
+            for values, child in list(self.children.items()):
+                labels = dict(zip(self.labelnames, values))
+                samples.extend((suffix, dict(labels, **extra), value) for suffix, extra, value in child.samples())
+            return samples
+        return [('', {}, self.value)]
+
+
+class Gauge(Counter):
+    '''
+    A value that goes up and down, e.g. the free space. The value can also be read when the metrics are collected, with
+    set_function(), which keeps values that are already tracked elsewhere off the hot path
+    '''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help='', labelnames=()):
+        Counter.__init__(self, name, help, labelnames)
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        '''
+        function : returns the value, or for a gauge with labels a dictionary of label value (or tuple of values) to value
+        '''
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return Counter.samples(self)
+        result = self.function()
+        if not self.labelnames:
+            return [('', {}, result)]
+        return [('', dict(zip(self.labelnames, values if isinstance(values, tuple) else (values,))), value)
+                for values, value in result.items()]
+
+
+class Histogram(Counter):
+    '''
+    Counts observations, e.g. durations in seconds, in cumulative buckets, and keeps their sum and count
+    '''
+
+    kind = 'histogram'
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help='', labelnames=(), buckets=None):
+        Counter.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets) if buckets is not None else Histogram.default_buckets
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one counts the observations above every bucket
+        self.sum = 0.0
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, Histogram(self.name, self.help, buckets=self.buckets))
+        return child
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] = self.counts[index] + 1
+            self.sum = self.sum + value
+
+    def samples(self):
+        if self.labelnames:
+            return Counter.samples(self)
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative = cumulative + count
+            samples.append(('_bucket', {'le': repr(float(bound))}, cumulative))
+        cumulative = cumulative + counts[-1]
+        samples.append(('_bucket', {'le': '+Inf'}, cumulative))
+        samples.append(('_sum', {}, total))
+        samples.append(('_count', {}, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    '''
+    Holds the metrics of the system, and renders them in the Prometheus text format
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help='', labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help='', labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help='', labelnames=(), buckets=None):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print("[ERROR - MetricsRegistry] Could not collect {}: {}".format(metric.name, e))
+                continue
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for suffix, labels, value in samples:
+                if labels:
+                    label_text = ','.join('{}="{}"'.format(k, MetricsRegistry.escape(v)) for k, v in labels.items())
+                    lines.append('{}{}{{{}}} {}'.format(metric.name, suffix, label_text, float(value)))
+                else:
+                    lines.append('{}{} {}'.format(metric.name, suffix, float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    '''
+    Serves the metrics of a registry on http://<host>:<port>/metrics, by default only to the local machine
+    '''
+
+    def __init__(self, registry=None, host='127.0.0.1', port=9108):
+        self.registry = registry if registry is not None else METRICS
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = self.registry
+        self.port = self.httpd.server_address[1]
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        print("[INFO - MetricsServer] Serving metrics on http://{}:{}/metrics".format(self.host, self.port))
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+METRICS = MetricsRegistry()  # Shared by every component of the system
+FRAMES_CAPTURED = METRICS.counter('surveillance_frames_captured_total', 'Frames read from the camera', ['camera'])
+CAPTURE_FPS = METRICS.gauge('surveillance_capture_fps', 'Frames per second read from the camera over the last second', ['camera'])
+FRAMES_PROCESSED = METRICS.counter('surveillance_frames_processed_total', 'Frames handled by a stage', ['camera', 'stage'])
+FRAMES_SAVED = METRICS.counter('surveillance_frames_saved_total', 'Frames saved after motion was detected', ['camera'])
+BYTES_SAVED = METRICS.counter('surveillance_bytes_saved_total', 'Bytes of the saved frames', ['camera'])
+SAVE_SECONDS = METRICS.histogram('surveillance_save_seconds', 'Time to encode and write a frame', ['camera'])
+MOTION_SECONDS = METRICS.histogram('surveillance_motion_seconds', 'Time to detect motion in a frame', ['camera'])
+DETECT_SECONDS = METRICS.histogram('surveillance_human_detect_seconds', 'Time of HumanDetectorUtil.detect per frame')
+FILTER_BACKLOG = METRICS.gauge('surveillance_filter_backlog', 'Images waiting for the SimilarityDetector', ['camera'])
+FRAMES_FILTERED = METRICS.counter('surveillance_frames_filtered_total', 'Images moved to storage or discarded as redundant', ['camera'])
+DELETED_FILES = METRICS.counter('surveillance_deleted_files_total', 'Files deleted by retention', ['camera', 'reason'])
+DELETED_BYTES = METRICS.counter('surveillance_deleted_bytes_total', 'Bytes deleted by retention', ['camera', 'reason'])
+FREE_BYTES = METRICS.gauge('surveillance_free_bytes', 'Free space on the storage volume')
+STAGE_SECONDS = METRICS.histogram('surveillance_stage_seconds', 'Time a pipeline stage spends on an item', ['stage'])
+STAGE_LATENCY = METRICS.histogram('surveillance_stage_latency_seconds', 'Time from capture to the end of a pipeline stage', ['stage'])
+STAGE_DROPPED = METRICS.counter('surveillance_stage_dropped_total', 'Items dropped because a pipeline stage was full', ['stage'])
+STAGE_ERRORS = METRICS.counter('surveillance_stage_errors_total', 'Items on which a pipeline stage failed', ['stage'])
+STAGE_QUEUED = METRICS.gauge('surveillance_stage_queued', 'Items waiting in the queues of a pipeline stage', ['stage'])
+CAMERA_BYTES = METRICS.gauge('surveillance_camera_bytes', 'Bytes used by a camera according to the usage ledger', ['camera'])
+SAMPLE_INTERVAL = METRICS.histogram('surveillance_sample_interval_seconds', 'Time between the frames sampled by motion detection, 1 s when it keeps up',
+                                    ['camera'], buckets=(0.5, 0.9, 1.0, 1.01, 1.02, 1.05, 1.1, 1.2, 1.5, 2, 3, 5, 10))
+FRAME_SECONDS = METRICS.histogram('surveillance_frame_seconds', 'Time motion detection spends on a sampled frame, saving included', ['camera'])
+SAVE_LATENCY = METRICS.histogram('surveillance_save_latency_seconds', 'Time from reading a frame from the camera to having saved it', ['camera'])
+LIVE_VIEW_CLIENTS = METRICS.gauge('surveillance_live_view_clients', 'Clients connected to the live view of a camera', ['camera'])
+
+# === TRACING ===
+
+class Span:
+    '''
+    Times the code in a with block, and records it in the Tracer's ring buffer when the block ends
+    '''
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        thread = threading.current_thread()
+        Tracer.events.append((self.name, self.category, self.start, end - self.start, thread.ident, thread.name, self.args))
+        return False
+
+
+class Tracer:
+    '''
+    Opt-in timing of the steps of every frame and every filtering pass. While disabled, span() returns a shared no-op context,
+    so that the hot paths only pay for one function call. While enabled, every span is kept in a ring buffer of the last
+    capacity spans, which dump() writes in the Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev).
+
+    install_signal_handlers() lets a running system be traced and profiled without a restart:
+        kill -USR1 <pid>  starts tracing, a second signal writes the trace to dump_dir and stops
+        kill -USR2 <pid>  starts the SamplingProfiler, a second signal writes its stacks to dump_dir and stops
+    '''
+
+    enabled = False
+    events = deque(maxlen=200000)
+    null = contextlib.nullcontext()
+    origin = time.perf_counter()  # Timestamps in the trace are relative to this
+    profiler = None
+
+    def enable(capacity=200000):
+        if Tracer.events.maxlen != capacity:
+            Tracer.events = deque(maxlen=capacity)
+        Tracer.enabled = True
+        print("[INFO - Tracer] Tracing enabled, keeping the last {} spans".format(capacity))
+
+    def disable():
+        Tracer.enabled = False
+
+    def span(name, category='', **args):
+        '''
+        Returns a context manager that records the time spent in its block, e.g.
+            with Tracer.span('resize', 'motion', camera=self.name):
+        '''
+        if not Tracer.enabled:
+            return Tracer.null
+        return Span(name, category, args)
+
+    def dump(path):
+        '''
+        Writes the spans in the buffer to path as a Chrome trace, and clears the buffer. Returns the number of spans written
+        '''
+        events = list(Tracer.events)
+        Tracer.events.clear()
+        pid = os.getpid()
+        trace = []
+        threads = {}
+        for name, category, start, duration, tid, thread_name, args in events:
+            threads[tid] = thread_name
+            trace.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': (start - Tracer.origin) * 1e6,
+                          'dur': duration * 1e6, 'args': args})
+        for tid, thread_name in threads.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        print("[INFO - Tracer] Wrote {} spans to {}".format(len(events), path))
+        return len(events)
+
+    def install_signal_handlers(dump_dir='../bin/profiles/'):
+        '''
+        Must be called from the main thread. The dumps are written on a separate thread, so the handlers return at once
+        '''
+        def toggle_tracing(signum, frame):
+            if not Tracer.enabled:
+                Tracer.enable(Tracer.events.maxlen)
+                return
+            Tracer.disable()
+            path = os.path.join(dump_dir, 'trace-{}.json'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+            Thread(target=Tracer.dump, args=(path,), daemon=True).start()
+
+        def toggle_profiler(signum, frame):
+            if Tracer.profiler is None:
+                Tracer.profiler = SamplingProfiler()
+                Tracer.profiler.start()
+                return
+            profiler = Tracer.profiler
+            Tracer.profiler = None
+            path = os.path.join(dump_dir, 'profile-{}.folded'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+            Thread(target=lambda: (profiler.stop(), profiler.dump(path)), daemon=True).start()
+
+        signal.signal(signal.SIGUSR1, toggle_tracing)
+        signal.signal(signal.SIGUSR2, toggle_profiler)
+        print("[INFO - Tracer] Send SIGUSR1 to process {0} to trace, SIGUSR2 to profile".format(os.getpid()))
+
+
+class SamplingProfiler:
+    '''
+    Samples the stacks of every thread at a fixed interval, which unlike cProfile covers threads that were started before
+    profiling began, and costs the profiled threads nothing beyond the GIL taken by the sampler. dump() writes the samples as
+    folded stacks (one 'thread;outer;...;inner count' line per stack), which flamegraph.pl and https://speedscope.app read.
+    '''
+
+    def __init__(self, interval=0.005, max_depth=64):
+        '''
+        interval : seconds between samples
+        max_depth : number of innermost frames kept per stack
+        '''
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = {}  # folded stack -> number of samples
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.sample, name='sampling_profiler', daemon=True)
+        self.thread.start()
+        print("[INFO - SamplingProfiler] Sampling every {} ms".format(self.interval * 1000))
+
+    def sample(self):
+        own = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                folded = ';'.join(reversed(stack))
+                self.stacks[folded] = self.stacks.get(folded, 0) + 1
+            self.samples = self.samples + 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def top(self, n=15):
+        '''
+        Returns the n functions that were on top of the stack most often, as (function, samples) tuples
+        '''
+        functions = {}
+        for folded, count in self.stacks.items():
+            function = folded.rsplit(';', 1)[-1]
+            functions[function] = functions.get(function, 0) + count
+        return heapq.nlargest(n, functions.items(), key=lambda item: item[1])
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            for folded, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(folded, count))
+        print("[INFO - SamplingProfiler] Wrote {} samples to {}, busiest functions:".format(self.samples, path))
+        for function, count in self.top():
+            print("    {:6d}  {}".format(count, function))
 
 # === STREAM ====
 
@@ -49,33 +474,93 @@ class Stream:
 
     last_frame = None
     last_ready = None
-    lock = Lock()
 
-    def __init__(self, src='', test_source=False):
+    def __init__(self, src='', test_source=False, timeout=None, name='', pace=False, loop=False, lockstep=False):
+        '''
+        src : rtsp source without the 'rtsp://' prefix, '0' for the webcam, or any source that cv2.VideoCapture accepts if test_source is set
+        test_source : open src as is, e.g. a local video file or a loopback rtsp server
+        timeout : seconds after which opening the source or reading a frame is given up, the backend default if None
+        name : name of the camera in the metrics, the source is not used since it can contain credentials
+        pace : read a video file at its own frame rate, as a camera would deliver it, instead of as fast as it decodes
+        loop : start a video file from the beginning again once it ends, otherwise finished is set at its end
+        lockstep : only read the next frame once the last one has been taken with get_new_frame, so that a consumer of a video
+                   file gets every frame instead of the newest one
+        '''
         global cap
         self.src = src
+        self.test_source = test_source
+        self.pace = pace
+        self.loop = loop
+        self.lockstep = lockstep
+        self.taken = threading.Event()  # Set once the last frame read has been taken, only waited for in lockstep
+        self.taken.set()
+        self.finished = False  # Set once a video file has been read to its end
+        self.captured = FRAMES_CAPTURED.labels(name)
+        self.fps = CAPTURE_FPS.labels(name)
+        self.lock = Lock()  # Every stream has its own lock, so that streams do not wait for each other's frames
+        self.frame_count = 0  # Number of frames read so far, so that consumers can tell when a new frame has arrived
+        self.running = True  # Cleared by release_stream to stop the reading thread
+        self.last_time = None  # time.time() at which the last frame was read
 
         if not test_source:
             if src == '0' or src == ':@0:':  # Enable webcam support
                 self.cap = cv2.VideoCapture(0)
             else:
                 rtsp_string = 'rtsp://' + src
-                self.cap = cv2.VideoCapture(rtsp_string)
+                self.cap = Stream.open_capture(rtsp_string, timeout)
         else:
-            self.cap = cv2.VideoCapture(src)
+            self.cap = Stream.open_capture(src, timeout)
 
         # From https://stackoverflow.com/questions/51722319/skip-frames-and-seek-to-end-of-rtsp-stream-in-opencv
-        thread = threading.Thread(target=self.rtsp_cam_buffer, args=(
+        self.thread = threading.Thread(target=self.rtsp_cam_buffer, args=(
             self.cap,), name="rtsp_read_thread")
-        thread.daemon = True
-        thread.start()
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open_capture(source, timeout=None):
+        if timeout is None:
+            return cv2.VideoCapture(source)
+        timeout_ms = int(timeout * 1000)
+        return cv2.VideoCapture(source, cv2.CAP_ANY, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout_ms,
+                                                      cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout_ms])
 
     # From https://stackoverflow.com/questions/51722319/skip-frames-and-seek-to-end-of-rtsp-stream-in-opencv
 
     def rtsp_cam_buffer(self, capture):
-        while True:
+        second_start, second_count = time.time(), 0
+        frame_interval = 1 / (capture.get(cv2.CAP_PROP_FPS) or 25) if self.pace else 0
+        next_frame = time.time()
+        while self.running:
+            if self.pace:
+                next_frame = max(next_frame + frame_interval, time.time() - 1)  # Do not catch up on more than a second
+                time.sleep(max(0, next_frame - time.time()))
+            if self.lockstep:
+                if not self.taken.wait(0.1):
+                    continue
+                self.taken.clear()
+            ready, frame = capture.read()  # Wait for the frame without holding the lock
+            if not ready and capture.isOpened() and capture.get(cv2.CAP_PROP_FRAME_COUNT) > 0:  # The end of a video file
+                if self.loop and capture.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                    self.taken.set()
+                    continue
+                self.finished = True
             with self.lock:
-                self.last_ready, self.last_frame = capture.read()
+                self.last_ready, self.last_frame = ready, frame
+                if ready:
+                    self.frame_count = self.frame_count + 1
+                    self.last_time = time.time()
+            if ready:
+                self.captured.inc()
+            else:
+                self.taken.set()  # Nothing to take, try again
+                time.sleep(0.05)  # The source is closed or not available, do not spin on it
+
+            if time.time() - second_start >= 1:
+                self.fps.set((self.frame_count - second_count) / (time.time() - second_start))
+                second_start, second_count = time.time(), self.frame_count
+
+        # The capture is released by the thread that reads it, so that it is never released in the middle of a read
+        capture.release()
 
     def get_stream(self):
         '''
@@ -90,7 +575,20 @@ class Stream:
         else:
             return None
 
+    def get_new_frame(self, seen=0):
+        '''
+        Returns (frame_count, frame) if a newer frame than the frame numbered seen is available, otherwise (seen, None).
+        The frame is not copied, so it must not be modified
+        '''
+        with self.lock:
+            if not self.last_ready or self.last_frame is None or self.frame_count == seen:
+                return seen, None
+            self.taken.set()
+            return self.frame_count, self.last_frame
+
     def refresh_stream(self):
+        if self.test_source:  # A local source can not fall out of sync
+            return
         self.cap = None
         time.sleep(2)
         if self.src == '0' or self.src == ':@0:':  # Enable webcam support
@@ -99,8 +597,12 @@ class Stream:
             rtsp_string = 'rtsp://' + self.src
             self.cap = cv2.VideoCapture(rtsp_string)
 
-    def release_stream(self):
-        self.cap.release()
+    def release_stream(self, timeout=2):
+        '''
+        Stops the reading thread, which releases the capture. Waits at most timeout seconds for a read that is in progress
+        '''
+        self.running = False
+        self.thread.join(timeout)
         self.cap = None
         
 # === MOTION DETECTOR WITH FORCED LOWERED FRAME RATE ===
@@ -115,7 +617,14 @@ class MotionDetectorLFR:
     """
     frame = 0
 
-    def __init__(self, stream, name, filepath, min_area, width=800, initial_frame_skip=20):
+    def __init__(self, stream, name, filepath, min_area, width=800, initial_frame_skip=20, catalog=None, sharded=True, store=None,
+                 ledger=None):
+        '''
+        catalog : ImageCatalog to which saved images are added
+        sharded : save images in the hourly shards of the ShardedLayout below filepath, instead of in filepath itself
+        store : FrameStore in which images are saved, defaults to a FileFrameStore in filepath if sharded is set
+        ledger : UsageLedger in which the bytes of saved images are recorded
+        '''
         self.refresh_rate = 4*60
         self.last_check_time = time.time()
         self.Stream = stream
@@ -128,6 +637,50 @@ class MotionDetectorLFR:
         self.fg_detect = cv2.createBackgroundSubtractorKNN()
         self.initial_frame_skip = initial_frame_skip
         self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (4, 4))
+        self.catalog = catalog
+        if store is None and sharded:
+            store = FileFrameStore(filepath)
+        self.store = store
+        self.ledger = ledger
+        self.processed = FRAMES_PROCESSED.labels(name, 'motion')
+        self.motion_seconds = MOTION_SECONDS.labels(name)
+        self.saved = FRAMES_SAVED.labels(name)
+        self.bytes_saved = BYTES_SAVED.labels(name)
+        self.save_seconds = SAVE_SECONDS.labels(name)
+        self.sample_interval = SAMPLE_INTERVAL.labels(name)
+        self.frame_seconds = FRAME_SECONDS.labels(name)
+        self.save_latency = SAVE_LATENCY.labels(name)
+        self.last_sample = None  # time.time() of the previous sampled frame
+
+    def save_frame(self, frame, now):
+        '''
+        Saves a frame, and returns its path, size and key in the store (None if there is no store)
+        '''
+        if self.store is None:
+            img_name = self.filepath + self.name + " - " + \
+                now.strftime("%A %d %B %Y %I:%M:%S%p") + '.jpg'
+            cv2.imwrite(img_name, frame)
+            return img_name, os.path.getsize(img_name), None
+
+        key = self.store.append(self.name, now, frame)
+        return self.store.path(key), self.store.size(key), key
+
+    def save(self, frame, now=None):
+        '''
+        Saves a frame, and records it in the ledger and the catalog. Returns its path, size and key (see save_frame)
+        '''
+        now = now if now is not None else datetime.datetime.now()
+        start = time.perf_counter()
+        with Tracer.span('imwrite', 'motion', camera=self.name):
+            img_name, size, key = self.save_frame(frame, now)
+        self.save_seconds.observe(time.perf_counter() - start)
+        self.saved.inc()
+        self.bytes_saved.inc(size)
+        if self.ledger is not None:
+            self.ledger.record(self.name, size)
+        if self.catalog is not None:
+            self.catalog.add(img_name, self.name, now.timestamp(), size)
+        return img_name, size, key
 
     def process_single_frame(self):
         """
@@ -138,6 +691,7 @@ class MotionDetectorLFR:
             return None
 
         self.start_time = time.time()
+        frame_time = self.Stream.last_time
         frame_orig = self.Stream.get_stream()
 
         # print("[DEBUG] ",frame_orig)
@@ -145,42 +699,70 @@ class MotionDetectorLFR:
         if frame_orig is None:  # Check that a frame is available
             return None
 
+        if self.last_sample is not None:
+            self.sample_interval.observe(self.start_time - self.last_sample)
+        self.last_sample = self.start_time
+
+        with Tracer.span('frame', 'motion', camera=self.name):
+            if self.detect(frame_orig):
+                self.save(frame_orig)  # Save the original frame
+                if frame_time is not None:
+                    self.save_latency.observe(time.time() - frame_time)
+                # print("[INFO - MotionDetector] Motion detected on " + self.name + ", frame saved")
+        self.frame_seconds.observe(time.time() - self.start_time)
+
+        self.refresh_if_due()
+
+        # return True
+
+    def detect(self, frame_orig):
+        '''
+        Updates the background model with a frame, and returns True if the frame contains motion
+        '''
         if self.frame < self.initial_frame_skip:  # Skip frames during which the background subtractor initializes
             self.frame = self.frame + 1
-            return None
+            return False
+
+        start = time.perf_counter()
+        try:
+            return self.find_motion(frame_orig)
+        finally:
+            self.motion_seconds.observe(time.perf_counter() - start)
+            self.processed.inc()
 
+    def find_motion(self, frame_orig):
         frame = frame_orig  # Copy the original frame
-        frame = imutils.resize(frame, self.width)
-        fg_mask = self.fg_detect.apply(frame)
+        with Tracer.span('resize', 'motion', camera=self.name):
+            frame = imutils.resize(frame, self.width)
+        with Tracer.span('fg_detect.apply', 'motion', camera=self.name):
+            fg_mask = self.fg_detect.apply(frame)
 
-        fg_mask = cv2.morphologyEx(
-            fg_mask, cv2.MORPH_OPEN, self.kernel)  # Remove noise
+        with Tracer.span('morphologyEx', 'motion', camera=self.name):
+            fg_mask = cv2.morphologyEx(
+                fg_mask, cv2.MORPH_OPEN, self.kernel)  # Remove noise
 
-        cnts = cv2.findContours(fg_mask.copy(), cv2.RETR_EXTERNAL,
-                                cv2.CHAIN_APPROX_SIMPLE)
-        cnts = imutils.grab_contours(cnts)
+        with Tracer.span('findContours', 'motion', camera=self.name):
+            cnts = cv2.findContours(fg_mask.copy(), cv2.RETR_EXTERNAL,
+                                    cv2.CHAIN_APPROX_SIMPLE)
+            cnts = imutils.grab_contours(cnts)
 
-        # loop over the contours
+        # loop over the contours, the frame only has to be saved once, no matter how many contours are large enough
         for c in cnts:
             # if the contour is too small, ignore it
-            if cv2.contourArea(c) < self.min_area:
-                continue
+            if cv2.contourArea(c) >= self.min_area:
+                # cv2.imshow("Frame Delta", fg_mask)
+                # cv2.imshow("Security Feed", frame)
+                return True
 
-            img_name = self.filepath + self.name + " - " + \
-                datetime.datetime.now().strftime("%A %d %B %Y %I:%M:%S%p") + '.jpg'
-            cv2.imwrite(img_name, frame_orig)  # Save the original frame
-            # cv2.imshow("Frame Delta", fg_mask)
-            # cv2.imshow("Security Feed", frame)
-            # print("[INFO - MotionDetector] Motion detected on " + self.name + ", frame saved")
+        return False
 
+    def refresh_if_due(self):
         if time.time() - self.last_check_time > self.refresh_rate:
             # Refresh the incoming stream to avoid getting too far out of sync
             print("[INFO - MotionDetector]Refreshing stream data on " + self.name)
             self.Stream.refresh_stream()
             self.last_check_time = time.time()
 
-        # return True
-
 # === HUMAN DETECTOR UTILITY===
 
 class HumanDetectorUtil:
@@ -201,6 +783,14 @@ class HumanDetectorUtil:
         self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
 
     def detect(self, frame):
+        start = time.perf_counter()
+        try:
+            with Tracer.span('human detect', 'classify'):
+                return self.find_humans(frame)
+        finally:
+            DETECT_SECONDS.observe(time.perf_counter() - start)
+
+    def find_humans(self, frame):
 
         image = imutils.resize(frame, width=min(700, frame.shape[1]))
 
@@ -221,117 +811,1746 @@ class HumanDetectorUtil:
         else:
             return False
 
+    def detect_file(self, path):
+        '''
+        Loads the image at the resolution that detect works at, instead of decoding it at full resolution.
+        Returns None if the image could not be read
+        '''
+        image = ImageLoader.load(path, width=700)
+        if image is None:
+            return None
+        return self.detect(image)
+
+# === BATCH SIMILARITY SCORER ===
+
+class BatchSimilarityScorer:
+    '''
+    Scores the similarity of whole sequences of images at once. The descriptors of every image are computed exactly once,
+    and are stacked into NumPy matrices so that all consecutive pairs are scored with a handful of row-wise operations,
+    instead of one calcHist, compareHist and matchTemplate call per pair.
+
+    The score is the same 0.2/0.8 blend that SimilarityDetector has always used:
+     - the histogram term is the correlation between the histograms of the first (blue) channel, which is what
+       compareHist with HISTCMP_CORREL computes
+     - the template term is the normalised dot product of mean-centred, downscaled greyscale vectors, which is what
+       matchTemplate with TM_CCOEFF_NORMED computes for two images of the same size
+    '''
+
+    def __init__(self, template_weight=0.2, hist_weight=0.8, width=700, vector_size=(64, 48)):
+        '''
+        template_weight : weight of the template term in the blended score
+        hist_weight : weight of the histogram term in the blended score
+        width : wider images are resized to this width before the histogram is computed, as determine_similarity always did
+        vector_size : (width, height) to which images are downscaled for the template term
+        '''
+        self.template_weight = template_weight
+        self.hist_weight = hist_weight
+        self.width = width
+        self.vector_size = vector_size
+
+    def describe(self, frame):
+        '''
+        Returns the descriptors of a single BGR or greyscale frame as a (histogram, vector) tuple of 1D float32 arrays.
+        Both are mean-centred and scaled to unit length, so that comparing two images only needs a dot product
+        '''
+        if frame.shape[1] > self.width:
+            frame = imutils.resize(frame, self.width)
+
+        if len(frame.shape) == 3:
+            channel = frame[:, :, 0]
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        else:
+            channel = frame
+            gray = frame
+
+        with Tracer.span('histogram', 'filter'):
+            hist = self.normalise(cv2.calcHist([channel], [0], None, [256], [0, 256]).ravel())
+        with Tracer.span('template vector', 'filter'):
+            vector = self.normalise(cv2.resize(gray, self.vector_size,
+                                               interpolation=cv2.INTER_AREA).astype(np.float32).ravel())
+
+        return (hist, vector)
+
+    def normalise(self, values):
+        values = values - values.mean()
+        norm = np.linalg.norm(values)
+        if norm > 0:
+            values = values / norm
+        return values.astype(np.float32)
+
+    def stack(self, descriptors):
+        '''
+        Stacks a list of descriptors into a histogram matrix and a vector matrix, one row per image
+        '''
+        hists = np.vstack([d[0] for d in descriptors])
+        vectors = np.vstack([d[1] for d in descriptors])
+        return hists, vectors
+
+    def blend(self, hist_correlation, template_match):
+        return (self.template_weight*template_match + self.hist_weight*hist_correlation)*100
+
+    def score_sequence(self, hists, vectors):
+        '''
+        Returns an array of n - 1 scores, in which score i is the similarity between image i + 1 and image i
+        '''
+        hist_correlation = np.einsum('ij,ij->i', hists[1:], hists[:-1])
+        template_match = np.einsum('ij,ij->i', vectors[1:], vectors[:-1])
+        return self.blend(hist_correlation, template_match)
+
+    def score_against(self, reference, hists, vectors):
+        '''
+        Returns the similarity between a single reference descriptor and every row of the matrices
+        '''
+        return self.blend(hists @ reference[0], vectors @ reference[1])
+
+# === BURST CLUSTERER ===
+
+class BurstClusterer:
+    '''
+    Groups temporally adjacent frames that are similar to each other into bursts, and chooses the most useful frame of a burst
+    as its representative. Frames are ranked by whether a human was detected in them, by their sharpness (variance of the Laplacian)
+    and by the area in which they differ from the rest of the burst, which is where the motion that triggered the save took place.
+    '''
+
+    def __init__(self, detector_util=None, human_weight=2.0, sharpness_weight=1.0, motion_weight=1.0, max_detections=8, motion_thresh=25):
+        '''
+        detector_util : HumanDetectorUtil used to find humans in the frames of a burst, human detection is skipped if None
+        max_detections : human detection is only performed on this many of the best frames of a burst, since it is slow
+        motion_thresh : minimum difference in grey level from the burst's median frame for a pixel to count as motion
+        '''
+        self.detector_util = detector_util
+        self.human_weight = human_weight
+        self.sharpness_weight = sharpness_weight
+        self.motion_weight = motion_weight
+        self.max_detections = max_detections
+        self.motion_thresh = motion_thresh
+
+    def features(self, image):
+        '''
+        Returns the (sharpness, small greyscale frame) of an image, which is all that is kept of it until its burst is closed
+        '''
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        sharpness = cv2.Laplacian(image, cv2.CV_64F).var()
+        small = cv2.resize(image, (64, 48), interpolation=cv2.INTER_AREA)
+        return (sharpness, small)
+
+    def representative(self, members, load=None):
+        '''
+        members : list of (name, features) tuples of the frames in a burst
+        load : function that loads the image with the given name, used for human detection
+        Returns the index of the frame that should be kept
+        '''
+        sharpness = np.array([m[1][0] for m in members])
+        smalls = np.stack([m[1][1] for m in members]).astype(np.float32)
+
+        median = np.median(smalls, axis=0)
+        motion = (np.abs(smalls - median) > self.motion_thresh).mean(axis=(1, 2))
+
+        scores = self.sharpness_weight * sharpness / max(sharpness.max(), 1e-6) + \
+            self.motion_weight * motion / max(motion.max(), 1e-6)
+
+        if self.detector_util is not None and load is not None:
+            for i in np.argsort(-scores)[:self.max_detections]:
+                image = load(members[i][0])
+                if image is not None and self.detector_util.detect(image):
+                    scores[i] = scores[i] + self.human_weight
+
+        return int(np.argmax(scores))
+
 # === SIMILARITY DETECTOR ===
 
 class SimilarityDetector:
+    '''
+    Compares every saved image to the image that was saved before it, and moves images that are too similar to the storage directory.
+
+    The detector works incrementally. A cursor (modification time and name of the last processed image) is persisted in the working
+    directory, together with the descriptors of that image, which serves as the reference for the next image. Every pass therefore
+    only decodes the images that arrived since the previous pass, and the time per pass does not grow with the size of the directory.
+
+    New images are scored in batches with the BatchSimilarityScorer, so that the descriptors of every image are only computed once.
+    A DirectoryWatcher reports the images that arrived, so that the directory is only scanned when the detector starts
+    (to catch up with images saved while it was not running) or when the watcher lost track of it.
+
+    With burst clustering enabled, consecutive images that are similar and less than max_gap seconds apart are grouped into a burst.
+    Once a burst is complete, only its best frame (see BurstClusterer) is kept and the rest of the burst is moved away in one go.
+    Without it, every image that is too similar to its predecessor is moved away, and the first image of a burst is the one kept.
+    '''
 
-    first_image = None
     first_pass_completed = False
 
-    def __init__(self, work_in_dir, interval, similarity_thresh=93):
+    def __init__(self, work_in_dir, interval, similarity_thresh=93, storage_dir='../bin/storage/', cursor_file=None, batch_size=256,
+                 burst_clustering=True, max_gap=10, remove_redundant=False, detector_util=None, catalog=None, store=None,
+                 ledger=None):
         '''
         work_in_dir : path to the directory in which the class must find images
         interval : interval between directory checks, in minutes
+        storage_dir : directory to which images that are too similar are moved
+        cursor_file : file in which the cursor is persisted, defaults to a hidden file in work_in_dir
+        batch_size : maximum number of images that are decoded and scored together
+        burst_clustering : keep only the best frame of every burst of similar images
+        max_gap : maximum time between two images of the same burst, in seconds
+        remove_redundant : delete the redundant frames of a burst instead of moving them to storage_dir
+        detector_util : HumanDetectorUtil used to rank the frames of a burst, one is created if not given
+        catalog : ImageCatalog that is updated when images are moved or removed
+        store : FrameStore from which the images are read, defaults to a FileFrameStore in work_in_dir. Redundant frames of stores
+                whose frames can not be moved are removed from the store
+        ledger : UsageLedger in which the bytes of removed frames are recorded
         '''
         self.last_check_time = time.time()
         self.wid = work_in_dir
+        self.store = store if store is not None else FileFrameStore(work_in_dir)
+        self.ledger = ledger
+        camera = os.path.basename(os.path.normpath(work_in_dir))
+        self.camera = camera
+        self.processed = FRAMES_PROCESSED.labels(camera, 'filter')
+        self.filtered = FRAMES_FILTERED.labels(camera)
+        self.backlog = FILTER_BACKLOG.labels(camera)
         self.interval = interval*60
-        self.imgs_in_dir = 0
         self.similarity_thresh = similarity_thresh
+        self.storage_dir = storage_dir
+        self.batch_size = batch_size
+        self.scorer = BatchSimilarityScorer()
+        self.max_gap = max_gap
+        self.remove_redundant = remove_redundant
+        self.catalog = catalog
+
+        self.clusterer = None
+        if burst_clustering:
+            if detector_util is None:
+                detector_util = HumanDetectorUtil()
+            self.clusterer = BurstClusterer(detector_util)
+
+        if cursor_file is None:
+            cursor_file = os.path.join(self.wid, '.similarity_cursor.pickle')
+        self.cursor_file = cursor_file
+
+        self.cursor = (0, '')  # (mtime, name) of the last processed image
+        self.reference = None  # Descriptors of the last processed image
+        self.seen = set()  # Names of images in the directory that have already been processed
+        self.pending = set()  # Names of images reported by the watcher that have not been processed yet
+        self.rescan = True  # Scan the whole directory during the next pass
+        self.watcher = self.store.watcher()  # None if the store has to be listed during every pass
+        self.burst = []  # (mtime, name, features) of the images in the burst that is still open
+        self.storage_shards = set()  # Shard directories that are known to exist in storage_dir
+        self.last_save_time = 0  # time.time() at which the cursor was last saved
+        self.load_cursor()
+
+    def load_cursor(self):
+        if not os.path.isfile(self.cursor_file):
+            return
 
-    def determine_similarity(self, prev_frame, current_frame):
-        # FROM https://stackoverflow.com/questions/11541154/checking-images-for-similarity-with-opencv
-        prev_frame = imutils.resize(prev_frame, 700)
-        current_frame = imutils.resize(current_frame, 700)
+        try:
+            with open(self.cursor_file, 'rb') as f:
+                state = pickle.load(f)
+            self.cursor = state['cursor']
+            self.reference = state['reference']
+            self.burst = state.get('burst', [])
+            print("[INFO - SimilarityDetector] Resuming " + self.wid + " after " + self.cursor[1])
+        except Exception as e:
+            print("[ERROR - SimilarityDetector] Could not read cursor file, starting from scratch: ", e)
+
+        # Descriptors written by an older version of the detector can not be compared to the current ones
+        if self.reference is not None and self.reference[0].shape != (256,):
+            self.reference = None
+
+    def save_cursor(self):
+        # Write to a temporary file first, so that a crash can never leave a half written cursor behind
+        tmp_file = self.cursor_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'cursor': self.cursor,
+                         'reference': self.reference,
+                         'burst': self.burst}, f)
+        os.replace(tmp_file, self.cursor_file)
+        self.last_save_time = time.time()
+
+    def pending_images(self):
+        '''
+        Returns a list of (mtime, name) tuples of the images reported by the watcher that have not been processed yet, oldest first
+        '''
+        new = []
+        for name in self.pending:
+            try:
+                key = (self.store.timestamp(name), name)
+            except FileNotFoundError:  # Removed since it was reported
+                continue
+            if key > self.cursor:
+                new.append(key)
+
+        self.pending = set()
+        new.sort()
+        return new
+
+    def new_images(self):
+        '''
+        Scans the directory, and returns a list of (mtime, name) tuples of images that have not been processed yet, oldest first.
+        Names are paths relative to the working directory. Only the shards from the hour of the cursor onwards are listed, and
+        only images that were not seen during a previous pass are stat'ed
+        '''
+        names = set()
+        new = []
 
-        first_image_hist = cv2.calcHist(
-            [prev_frame], [0], None, [256], [0, 256])
-        second_image_hist = cv2.calcHist(
-            [current_frame], [0], None, [256], [0, 256])
+        since = self.cursor[0] - 60 if self.cursor[1] else None  # Allow for clock differences between saving and stat'ing
+        for name in self.store.keys(since=since):
+            names.add(name)
+            if name in self.seen:
+                continue
+            try:
+                key = (self.store.timestamp(name), name)
+            except FileNotFoundError:  # Removed since the directory was listed
+                continue
+            if key > self.cursor:
+                new.append(key)
+            else:
+                self.seen.add(name)
+
+        # Forget images that are no longer in the directory, so that the set stays the size of the directory
+        self.seen &= names
+        new.sort()
+        return new
 
-        img_hist_diff = cv2.compareHist(
-            first_image_hist, second_image_hist, cv2.HISTCMP_CORREL)
-        img_template_probability_match = cv2.matchTemplate(
-            prev_frame, current_frame, cv2.TM_CCOEFF_NORMED)[0][0]
+    def describe(self, frame):
+        return self.scorer.describe(frame)
 
-        commutative_image_match = (0.2*img_template_probability_match + 0.8*img_hist_diff)*100
+    def determine_similarity(self, prev_frame, current_frame):
+        # FROM https://stackoverflow.com/questions/11541154/checking-images-for-similarity-with-opencv
+        hists, vectors = self.scorer.stack(
+            [self.describe(prev_frame), self.describe(current_frame)])
+        commutative_image_match = self.scorer.score_sequence(hists, vectors)[0]
         print("[DEBUG - SimilarityDetector] Image similarity: ",
               commutative_image_match)
         return commutative_image_match
 
+    def decode_batch(self, files):
+        '''
+        Decodes the given files and computes their descriptors. Stops at the first image that is probably still being written.
+        Returns the (mtime, name) tuples and descriptors of all images that could be read
+        '''
+        decoded = []
+        descriptors = []
+        features = []
+
+        for mtime, name in files:
+            with Tracer.span('load', 'filter', camera=self.camera):
+                image = self.store.load(name, width=self.scorer.width)
+
+            if image is None:
+                if time.time() - mtime < 60:  # The image is probably still being written, try again during the next pass
+                    return decoded, descriptors, features, True
+                print("[ERROR - SimilarityDetector] Skipping unreadable image " + name)
+                self.cursor = max(self.cursor, (mtime, name))
+                continue
+
+            decoded.append((mtime, name))
+            with Tracer.span('describe', 'filter', camera=self.camera):
+                descriptors.append(self.describe(image))
+            if self.clusterer is not None:
+                with Tracer.span('burst features', 'filter', camera=self.camera):
+                    features.append(self.clusterer.features(image))
+            else:
+                features.append(None)
+
+        return decoded, descriptors, features, False
+
+    def storage_path(self, name):
+        '''
+        Returns the path to which a redundant image is moved. Sharded images keep their shard under <storage>/<camera>/
+        '''
+        if os.sep not in name:  # Image of the old flat layout
+            return os.path.join(self.storage_dir, name)
+
+        directory = os.path.join(self.storage_dir, ShardedLayout.camera_of(name), os.path.dirname(name))
+        if directory not in self.storage_shards:
+            os.makedirs(directory, exist_ok=True)
+            self.storage_shards.add(directory)
+        return os.path.join(directory, os.path.basename(name))
+
+    def discard(self, names):
+        '''
+        Moves (or deletes) a batch of redundant images. Returns the number of images that were discarded
+        '''
+        with Tracer.span('discard', 'filter', camera=self.camera, images=len(names)):
+            return self.move_redundant(names)
+
+    def move_redundant(self, names):
+        discarded = 0
+        removed = []
+        for name in names:
+            img_name = self.store.path(name)
+            try:
+                if self.remove_redundant or not self.store.movable:
+                    freed = self.store.remove([name])
+                    if self.ledger is not None:
+                        self.ledger.record(ShardedLayout.camera_of(name), -freed)
+                    removed.append(img_name)
+                else:
+                    storage_path = self.storage_path(name)
+                    os.rename(img_name, storage_path)  # Move the image
+                    if self.catalog is not None:
+                        self.catalog.move(img_name, storage_path, state='redundant')
+                discarded = discarded + 1
+            except FileNotFoundError:  # Already removed by another component
+                pass
+
+        if self.catalog is not None and removed:
+            self.catalog.remove(removed)
+        return discarded
+
+    def close_burst(self):
+        '''
+        Keeps the representative of the open burst, and discards the rest of the burst
+        '''
+        burst = self.burst
+        self.burst = []
+
+        if len(burst) < 2:
+            return 0
+
+        with Tracer.span('close burst', 'filter', camera=self.camera, images=len(burst)):
+            return self.keep_representative(burst)
+
+    def keep_representative(self, burst):
+        best = self.clusterer.representative([(b[1], b[2]) for b in burst],
+                                             load=lambda name: self.store.load(name, width=self.scorer.width))
+        print("[INFO - SimilarityDetector] Burst of {} images, keeping {}".format(
+            len(burst), burst[best][1]))
+        if self.catalog is not None:
+            self.catalog.set_cluster([os.path.join(self.wid, b[1]) for b in burst],
+                                     os.path.join(self.wid, burst[best][1]))
+
+        return self.discard([b[1] for i, b in enumerate(burst) if i != best])
+
+    def burst_expired(self):
+        return len(self.burst) > 0 and time.time() - self.burst[-1][0] > self.max_gap
+
+    def close(self):
+        '''
+        Settles the open burst and stops watching the directory, used when the camera is removed from a running system
+        '''
+        self.close_burst()
+        self.save_cursor()
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def filter_scored(self, mtime, name, SIM, feature):
+        '''
+        Decides what happens to an image, given its similarity to the image before it. Returns the number of images discarded
+        '''
+        self.seen.add(name)
+
+        if self.clusterer is not None:
+            moved = 0
+            if self.burst and (SIM <= self.similarity_thresh or mtime - self.burst[-1][0] > self.max_gap):
+                moved = self.close_burst()
+            self.burst.append((mtime, name, feature))
+            return moved
+
+        if SIM > self.similarity_thresh:
+            '''
+            Only keep the image in the working directory if the similarity is less than the set threshold
+            '''
+            print("[DEBUG - SimilarityDetector] Image above threshold found")
+            return self.discard([name])
+        return 0
+
+    def filter_frame(self, name, frame):
+        '''
+        Scores an image that was just saved as name against the reference, from its frame in memory, so that a running system
+        filters its frames as they arrive instead of decoding them again in one long pass. Images older than the cursor were
+        already handled by a pass. Returns the number of images discarded
+        frame : the saved frame, at any width
+        '''
+        try:
+            key = (self.store.timestamp(name), name)
+        except FileNotFoundError:  # Already removed
+            return 0
+        if key <= self.cursor:
+            return 0
+
+        if frame.shape[1] > self.scorer.width:
+            frame = imutils.resize(frame, width=self.scorer.width)
+        with Tracer.span('describe', 'filter', camera=self.camera):
+            descriptor = self.describe(frame)
+        feature = None
+        if self.clusterer is not None:
+            with Tracer.span('burst features', 'filter', camera=self.camera):
+                feature = self.clusterer.features(frame)
+
+        SIM = 0
+        if self.reference is not None:
+            SIM = self.scorer.score_sequence(*self.scorer.stack([self.reference, descriptor]))[0]
+
+        self.processed.inc()
+        moved = self.filter_scored(key[0], name, SIM, feature)
+        self.reference = descriptor
+        self.cursor = key
+        self.pending.discard(name)
+        self.backlog.set(len(self.pending))
+        self.filtered.inc(moved)
+        if time.time() - self.last_save_time > 10:
+            self.save_cursor()
+        return moved
+
+    def update_pending(self):
+        if self.watcher is None:
+            self.rescan = True
+            return
+
+        for event, name in self.watcher.poll():
+            if event == 'new':
+                self.pending.add(name)
+            elif event == 'removed':
+                self.pending.discard(name)
+                self.seen.discard(name)
+            else:
+                self.rescan = True
+        self.backlog.set(len(self.pending))
+
     def match_and_filter(self):
 
-        # avg_time = 0
+        # The watcher is drained on every call, a pass every interval would leave more events than the kernel queues, and the
+        # backlog metric would only be updated once per interval
+        self.update_pending()
+
         if self.first_pass_completed:
-            # Check that time of interval has passed
-            if (time.time() - self.last_check_time < self.interval) or self.imgs_in_dir == len(os.listdir(self.wid)) or len(os.listdir(self.wid)) < 2:
+            # Check that time of interval has passed. Frames scored with filter_frame can leave a burst open in between
+            if time.time() - self.last_check_time < self.interval:
+                if self.burst_expired():
+                    self.filtered.inc(self.close_burst())
+                    self.save_cursor()
                 return
 
-        print(
-            "[INFO - SimilarityDetector] Starting matching and filtering of saved images...\n")
+        if self.first_pass_completed:
+            # Check that images were added to the directory
+            if not self.pending and not self.rescan and not self.burst_expired():
+                return
 
+        self.first_pass_completed = True
         self.last_check_time = time.time()  # Update the last checked time
-        # Updates the number of images in the directory in the latest check.
-        self.imgs_in_dir = len(os.listdir(self.wid))
-        # These two variables help to optimise the filtering process by only performing the process at specific intervals, and also only when
-        # the number of images in the indicated directory has changed
-        files = glob.glob(self.wid + '/*.jpg')
-        files.sort(key=os.path.getmtime)
-
-        for img_name in files:
-
-            if self.first_image is None:
-                self.first_image = cv2.imread(img_name)
-                self.first_pass_completed = True
+
+        if self.rescan:
+            self.rescan = False
+            self.pending = set()
+            files = self.new_images()
+        else:
+            files = self.pending_images()
+
+        if not files:
+            if self.burst_expired():
+                self.close_burst()
+                self.save_cursor()
+            return
+
+        print(
+            "[INFO - SimilarityDetector] Starting matching and filtering of {} new images...\n".format(len(files)))
+
+        moved = 0
+        for i in range(0, len(files), self.batch_size):
+            with Tracer.span('decode batch', 'filter', camera=self.camera, images=len(files[i:i + self.batch_size])):
+                decoded, descriptors, features, interrupted = self.decode_batch(
+                    files[i:i + self.batch_size])
+
+            if descriptors:
+                with Tracer.span('score', 'filter', camera=self.camera, images=len(descriptors)):
+                    if self.reference is None:
+                        scores = np.zeros(len(descriptors))
+                        scores[1:] = self.scorer.score_sequence(
+                            *self.scorer.stack(descriptors))
+                    else:
+                        scores = self.scorer.score_sequence(
+                            *self.scorer.stack([self.reference] + descriptors))
+
+                self.processed.inc(len(decoded))
+                for (mtime, name), SIM, feature in zip(decoded, scores, features):
+                    moved = moved + self.filter_scored(mtime, name, SIM, feature)
+
+                self.reference = descriptors[-1]
+                self.cursor = decoded[-1]
+
+            if interrupted:
+                break
+        else:
+            # Close the open burst once no more images can be added to it
+            if self.burst_expired():
+                moved = moved + self.close_burst()
+
+        # Images that could not be processed yet are tried again during the next pass
+        self.pending.update(
+            name for mtime, name in files if (mtime, name) > self.cursor)
+
+        print("[INFO - SimilarityDetector] {} images moved".format(moved))
+        self.filtered.inc(moved)
+        self.backlog.set(len(self.pending))
+        self.save_cursor()
+
+# === USAGE LEDGER ===
+
+class UsageLedger:
+    '''
+    Number of bytes that every camera uses on the storage volume. The components that write frames record what they add, and the
+    components that delete or shrink frames record what they release, so that the usage is always known without walking the
+    directories. The RetentionPolicy replaces the numbers with a full scan every now and then, which corrects any drift, e.g.
+    from files removed by hand.
+
+    Shared by the threads of the system, so every access takes the lock.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.usage = {}  # camera -> bytes
+        self.last_reconciled = None
+
+    def record(self, camera, delta):
+        with self.lock:
+            self.usage[camera] = self.usage.get(camera, 0) + delta
+
+    def get(self, camera):
+        with self.lock:
+            return self.usage.get(camera, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.usage)
+
+    def reconcile(self, usage):
+        '''
+        Replaces the usage with the result of a scan. Returns a dictionary of camera to the difference that was corrected
+        '''
+        with self.lock:
+            drift = {camera: usage.get(camera, 0) - self.usage.get(camera, 0) for camera in set(usage) | set(self.usage)}
+            self.usage = dict(usage)
+            self.last_reconciled = time.time()
+        return {camera: drift[camera] for camera in drift if drift[camera] != 0}
+
+# === RETENTION POLICY ===
+
+class RetentionPolicy:
+    '''
+    Decides which images are deleted when space runs out. Instead of deleting one random image at a time, all images are ranked
+    in a priority queue and deleted in batches, until the free space on the storage volume reaches the requested target.
+    Cameras that use more than their byte quota are trimmed back to it on their own by enforce_quotas(), so that one noisy camera
+    can not push out the history of every other camera, while enforce() keeps a floor of free space on the volume as a whole.
+
+    Images are deleted in the following order:
+     1. images of cameras that use more than their quota
+     2. redundant images, i.e. images that the SimilarityDetector moved to the storage directory, and the timelapse videos of
+        the TimelapseCompactor, which only hold stills without humans
+     3. images in which no human was detected
+     4. older images before newer ones
+    Images containing humans are only deleted when force is set. Human detection is slow, so it is only performed on an image
+    once the image reaches the front of the queue, and the result is remembered.
+
+    The images in the managed directories are tracked with DirectoryWatchers, so that the queue can be built without listing
+    the directories. Frames in SegmentFrameStores are listed through the stores, and ranked in the same queue. Their space can only
+    be freed a whole segment at a time, so once a frame reaches the front of the queue its whole segment is dropped, unless one of
+    its frames contains a human; segments that are still being written are left alone. The bytes used per camera are kept in a UsageLedger, which is updated by the writers and by every deletion,
+    and replaced by a full scan in reconcile(). Every decision is appended to log_file, so that deletions can be audited
+    afterwards. If a catalog is given, human labels are stored in it, so that they survive restarts, and deleted images are
+    removed from it.
+    '''
+
+    def __init__(self, directories, volume, quotas=None, batch_size=50, log_file=None, detector_util=None, catalog=None, stores=None,
+                 ledger=None):
+        '''
+        directories : list of (path, redundant) tuples of the directories that are managed
+        stores : SegmentFrameStores of the managed directories, of which the frames are ranked with the images
+        volume : path on the storage volume, of which the free space is measured
+        quotas : dictionary of camera name to the number of bytes that the camera may use
+        batch_size : number of images deleted before the free space is measured again
+        log_file : file to which every decision is appended
+        detector_util : HumanDetectorUtil used to protect images containing humans
+        catalog : ImageCatalog in which human labels and deletions are recorded
+        ledger : UsageLedger shared with the components that write frames, one is created if not given
+        '''
+        self.directories = directories
+        self.volume = volume
+        self.quotas = quotas if quotas is not None else {}
+        self.batch_size = batch_size
+        self.log_file = log_file
+        self.detector_util = detector_util
+        self.catalog = catalog
+        self.stores = stores if stores is not None else []
+        self.ledger = ledger if ledger is not None else UsageLedger()
+
+        self.images = {}  # path -> [camera, mtime, size, redundant]
+        self.frames = {}  # path -> (store, key) of the images that are frames in a segment store
+        self.timelapses = set()  # paths of the images that are timelapse videos
+        self.labels = {}  # path -> True if a human was detected
+        self.kept = set()  # paths of the images and segments that were logged as kept, so that every keep is logged once
+        self.stalled = {}  # camera -> (usage, force) of its last quota pass that freed nothing, it is skipped until either changes
+        self.watchers = {}
+
+        for path, redundant in self.directories:
+            self.watchers[path] = RetentionPolicy.watcher(path)
+        self.reconcile()
+
+    def watcher(directory):
+        return DirectoryWatcher(directory, suffix=('.jpg', TimelapseCompactor.SUFFIX), recursive=True)
+
+    def reconcile(self):
+        '''
+        Walks all managed directories once, rebuilds the list of images and replaces the usage in the ledger.
+        Every file named '<camera> - ...' counts towards the usage of its camera: stills, segments and their indexes, and
+        timelapse videos. Returns the corrections that were made to the ledger
+        '''
+        images = {}
+        timelapses = set()
+        usage = {}
+        for directory, redundant in self.directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                for name in filenames:
+                    if ' - ' not in name:
+                        continue
+                    path = os.path.normpath(os.path.join(dirpath, name))
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    camera = ShardedLayout.camera_of(name)
+                    usage[camera] = usage.get(camera, 0) + stat.st_size
+                    if name.endswith('.jpg'):
+                        images[path] = [camera, stat.st_mtime, stat.st_size, redundant]
+                    elif name.endswith(TimelapseCompactor.SUFFIX):
+                        # The index is deleted together with the video
+                        images[path] = [camera, stat.st_mtime, stat.st_size + RetentionPolicy.index_size(path), redundant]
+                        timelapses.add(path)
+
+        frames = {}
+        for store in self.stores:
+            self.scan_store(store, images, frames)
+
+        self.images = images
+        self.frames = frames
+        self.timelapses = timelapses
+        labels = self.catalog.human_labels() if self.catalog is not None else self.labels
+        self.labels = {path: labels[path] for path in labels if path in self.images}
+
+        drift = self.ledger.reconcile(usage)
+        for camera in drift:
+            print("[INFO - RetentionPolicy] Corrected the usage of {} by {:+.1f} MiB".format(camera, drift[camera] / 2**20))
+        return drift
+
+    def add_directory(self, directory, redundant=False, store=None):
+        '''
+        Starts managing another directory, e.g. of a camera that was added while the system is running
+        '''
+        if any(path == directory for path, r in self.directories):
+            return
+        self.directories.append((directory, redundant))
+        self.watchers[directory] = RetentionPolicy.watcher(directory)
+        if store is not None:
+            self.stores.append(store)
+        self.scan(directory, redundant)
+
+    def store_of(self, directory):
+        for store in self.stores:
+            if os.path.normpath(store.root) == os.path.normpath(directory):
+                return store
+        return None
+
+    def scan(self, directory, redundant):
+        '''
+        Adds the images below a directory: the frames of its segment store, if it has one, and the image files of its camera roots
+        '''
+        store = self.store_of(directory)
+        if store is not None:
+            self.scan_store(store, self.images, self.frames)
+
+        for root in ShardedLayout.roots(directory):
+            files = FileFrameStore(root)
+            for key in files.keys():
+                self.add(os.path.normpath(files.path(key)), redundant)
+            for name in ShardedLayout.walk(root, suffix=TimelapseCompactor.SUFFIX):
+                self.add(os.path.normpath(os.path.join(root, name)), redundant)
+
+    def scan_store(self, store, images, frames):
+        '''
+        Adds the frames of a segment store to the images and frames dictionaries
+        '''
+        for key in store.keys():
+            try:
+                captured, size = store.timestamp(key), store.size(key)
+            except FileNotFoundError:  # Removed since the store was listed
+                continue
+            path = os.path.normpath(store.path(key))
+            images[path] = [ShardedLayout.camera_of(SegmentFrameStore.split_key(key)[0]), captured, size, False]
+            frames[path] = (store, key)
+
+    def rescan_store(self, store):
+        '''
+        Brings the frames of a segment store up to date. The watchers do not report frames appended to a segment, nor frames
+        that were marked as removed
+        '''
+        images = {}
+        frames = {}
+        self.scan_store(store, images, frames)
+        for path in [p for p in self.frames if self.frames[p][0] is store and p not in frames]:
+            self.forget(path)
+        self.images.update(images)
+        self.frames.update(frames)
+
+    def add(self, path, redundant):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        # Rewritten images (e.g. recompressed) keep their human label
+        camera = ShardedLayout.camera_of(path)
+        size = stat.st_size
+        if path.endswith(TimelapseCompactor.SUFFIX):
+            size = size + RetentionPolicy.index_size(path)
+            self.timelapses.add(path)
+        self.images[path] = [camera, stat.st_mtime, size, redundant]
+
+    def index_size(video_file):
+        try:
+            return os.path.getsize(video_file + '.tsv')
+        except FileNotFoundError:  # The index is written after the video
+            return 0
+
+    def label(self, path, human):
+        '''
+        Records whether an image contains a human, when it is already known, so that it does not have to be detected again
+        '''
+        self.labels[path] = human
+
+    def forget(self, path):
+        self.images.pop(path, None)
+        self.frames.pop(path, None)
+        self.timelapses.discard(path)
+        self.labels.pop(path, None)
+        self.kept.discard(path)
+
+    def update(self):
+        '''
+        Applies the changes reported by the watchers since the previous update
+        '''
+        for directory, redundant in self.directories:
+            for event, name in self.watchers[directory].poll():
+                if event == 'new':
+                    self.add(os.path.normpath(os.path.join(directory, name)), redundant)
+                elif event == 'removed':
+                    self.forget(os.path.normpath(os.path.join(directory, name)))
+                else:
+                    self.rescan(directory, redundant)
+
+        for store in self.stores:
+            self.rescan_store(store)
+
+    def rescan(self, directory, redundant):
+        prefix = os.path.normpath(directory) + os.sep
+        for path in [p for p in self.images if p.startswith(prefix)]:
+            self.forget(path)
+        self.scan(directory, redundant)
+
+    def free_space(self):
+        return shutil.disk_usage(self.volume).free
+
+    def over_quota(self, camera):
+        return camera in self.quotas and self.ledger.get(camera) > self.quotas[camera]
+
+    def priority(self, path):
+        '''
+        Returns the key by which the image is ordered in the queue, lowest first
+        '''
+        camera, mtime, size, redundant = self.images[path]
+        return (0 if self.over_quota(camera) else 1,
+                0 if redundant or path in self.timelapses else 1,
+                1 if self.labels.get(path) else 0,
+                mtime)
+
+    def reason(self, path):
+        '''
+        Returns why an image is deleted, for the log and the metrics. Images containing humans are only deleted when forced,
+        which is always reported as such, whatever else put them at the front of the queue
+        '''
+        camera, mtime, size, redundant = self.images[path]
+        if self.labels.get(path):
+            return 'human'
+        if self.over_quota(camera):
+            return 'over quota'
+        if redundant:
+            return 'redundant'
+        if path in self.timelapses:
+            return 'timelapse'
+        return 'oldest'
+
+    def log(self, f, action, path, reason, free):
+        camera, mtime, size, redundant = self.images[path]
+        line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(datetime.datetime.now().isoformat(sep=' ', timespec='seconds'),
+                                                     action, camera, size, reason, free, path)
+        if f is not None:
+            f.write(line)
+
+    def delete(self, f, batch, free):
+        freed = 0
+        videos = [path for path, reason in batch if path in self.timelapses]
+        for path, reason in batch:
+            self.log(f, 'delete', path, reason, free)
+            try:
+                if path in self.timelapses:
+                    try:
+                        os.remove(path + '.tsv')
+                    except FileNotFoundError:
+                        pass
+                os.remove(path)
+                camera, size = self.images[path][0], self.images[path][2]
+                freed = freed + size
+                self.ledger.record(camera, -size)
+                DELETED_FILES.labels(camera, reason).inc()
+                DELETED_BYTES.labels(camera, reason).inc(size)
+            except FileNotFoundError:
+                pass
+            self.forget(path)
+
+        if self.catalog is not None:
+            self.catalog.remove([path for path, reason in batch])
+            for path in videos:  # The frames of a video are catalogued as '<video>/<frame number>'
+                self.catalog.remove_directory(path)
+        return freed
+
+    def delete_in_order(self, f, paths, remaining, force):
+        '''
+        Deletes the given images in order of priority, in batches, until remaining() returns 0 or less.
+        remaining : returns the number of bytes that still have to be released, it is called again after every batch
+        Returns the number of bytes freed
+        '''
+        queue = [(self.priority(path), path) for path in paths]
+        heapq.heapify(queue)
+
+        freed = 0
+        batch = []
+        needed = remaining()
+        free = self.free_space()
+        open_segments = self.open_segments() if self.frames else set()
+        decided = set()  # (store, segment) of the segments that were kept or dropped
+
+        while queue and needed > 0:
+            key, path = heapq.heappop(queue)
+            if path not in self.images:
+                continue
+
+            # The priority of an image changes when its camera drops below its quota, or when a human is found in it
+            current = self.priority(path)
+            if current != key:
+                heapq.heappush(queue, (current, path))
+                continue
+
+            if path in self.frames:
+                store, frame_key = self.frames[path]
+                segment = (store, SegmentFrameStore.split_key(frame_key)[0])
+                if segment in open_segments or segment in decided:
+                    continue
+                decided.add(segment)
+                freed = freed + self.drop_segment(f, store, segment[1], self.reason(path), force)
+                needed = remaining()
+                free = self.free_space()
+                continue
+
+            if path not in self.labels and path not in self.timelapses:
+                human = False
+                if self.detector_util is not None:
+                    human = bool(self.detector_util.detect_file(path))
+                    if self.catalog is not None:
+                        self.catalog.set_human(path, human)
+                self.labels[path] = human
+                if human:
+                    heapq.heappush(queue, (self.priority(path), path))
+                    continue
+
+            if self.labels.get(path) and not force:
+                if path not in self.kept:
+                    self.kept.add(path)
+                    self.log(f, 'keep', path, 'human', free)
                 continue
 
-            image = cv2.imread(img_name)
+            batch.append((path, self.reason(path)))
+            needed = needed - self.images[path][2]  # Estimate, the remaining bytes are measured after every batch
+
+            if len(batch) >= self.batch_size:
+                freed = freed + self.delete(f, batch, free)
+                batch = []
+                needed = remaining()
+                free = self.free_space()
+
+        if batch:
+            freed = freed + self.delete(f, batch, free)
+        return freed
+
+    def enforce(self, target_free, force=False):
+        '''
+        Keeps the floor of free space on the storage volume: deletes images of all cameras in order of priority until at least
+        target_free bytes are free.
+        force : also delete images containing humans
+        Returns the number of bytes freed
+        '''
+        self.update()
+
+        if self.free_space() >= target_free:
+            return 0
+
+        f = open(self.log_file, 'a') if self.log_file is not None else None
+        try:
+            freed = self.delete_in_order(f, list(self.images), lambda: target_free - self.free_space(), force)
+            if self.stores and self.free_space() < target_free:
+                freed = freed + self.drop_segments(f, lambda: target_free - self.free_space(), force)
+        finally:
+            if f is not None:
+                f.close()
+
+        print("[INFO - RetentionPolicy] Freed {:.1f} MiB, {:.2f} GiB free".format(
+            freed / 2**20, self.free_space() / 2**30))
+        return freed
+
+    def enforce_quotas(self, force=False):
+        '''
+        Deletes the images of every camera that uses more than its quota, in order of priority, until the camera is back within
+        its quota. The images of other cameras are not touched. A camera of which a pass freed nothing, e.g. because all of its
+        images contain humans, is skipped until its usage changes or force is set, since the pass would only repeat itself.
+        force : also delete images containing humans
+        Returns the number of bytes freed
+        '''
+        over = [camera for camera in self.quotas
+                if self.over_quota(camera) and self.stalled.get(camera) != (self.ledger.get(camera), force)]
+        if not over:
+            return 0
+
+        self.update()
+        f = open(self.log_file, 'a') if self.log_file is not None else None
+        freed = 0
+        try:
+            for camera in over:
+                remaining = lambda: self.ledger.get(camera) - self.quotas[camera]
+                paths = [path for path in self.images if self.images[path][0] == camera]
+                camera_freed = self.delete_in_order(f, paths, remaining, force)
+                if self.stores and remaining() > 0:
+                    camera_freed = camera_freed + self.drop_segments(f, remaining, force, camera=camera)
+                freed = freed + camera_freed
+                if camera_freed == 0:
+                    self.stalled[camera] = (self.ledger.get(camera), force)
+                else:
+                    self.stalled.pop(camera, None)
+                print("[INFO - RetentionPolicy] {} was over its quota, freed {:.1f} MiB, {:.1f} MiB used".format(
+                    camera, camera_freed / 2**20, self.ledger.get(camera) / 2**20))
+        finally:
+            if f is not None:
+                f.close()
+        return freed
+
+    def open_segments(self):
+        '''
+        Returns the (store, segment name) tuples of the segments that are still being written
+        '''
+        open_segments = set()
+        for store in self.stores:
+            open_segments.update((store, name) for start, name, size, is_open in store.segment_list() if is_open)
+        return open_segments
+
+    def segment_has_human(self, store, name, detect=True):
+        '''
+        Returns whether any frame of a segment that was not removed contains a human. Frames without a label are run through
+        the detector, unless detect is False, and their labels are remembered like those of images
+        '''
+        if self.catalog is not None and self.catalog.human_count(store.path(name)) > 0:
+            return True
+
+        for key in store.segment_keys(name):
+            path = os.path.normpath(store.path(key))
+            if path not in self.labels:
+                if not detect or self.detector_util is None:
+                    continue
+                image = store.load(key, width=700)
+                human = image is not None and bool(self.detector_util.detect(image))
+                if self.catalog is not None:
+                    self.catalog.set_human(path, human)
+                self.labels[path] = human
+            if self.labels[path]:
+                return True
+        return False
+
+    def drop_segment(self, f, store, name, reason, force=False):
+        '''
+        Drops a whole segment, unless one of its frames contains a human and force is not set. Returns the number of bytes freed
+        '''
+        path = store.path(name)
+        camera = ShardedLayout.camera_of(name)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+        # With force set, the frames are only checked for the log, so the detector is not run
+        if self.segment_has_human(store, name, detect=not force):
+            if not force:
+                if path not in self.kept:
+                    self.kept.add(path)
+                    self.log_segment(f, 'keep', camera, size, 'human', path)
+                return 0
+            reason = 'human'
+
+        keys = store.segment_keys(name)
+        dropped = store.drop(name)
+        self.kept.discard(path)
+        self.ledger.record(camera, -dropped)
+        DELETED_FILES.labels(camera, reason).inc()
+        DELETED_BYTES.labels(camera, reason).inc(dropped)
+        for key in keys:
+            self.forget(os.path.normpath(store.path(key)))
+        if self.catalog is not None:
+            self.catalog.remove_directory(path)
+
+        self.log_segment(f, 'drop', camera, dropped, reason, path)
+        return dropped
+
+    def log_segment(self, f, action, camera, size, reason, path):
+        if f is not None:
+            f.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                datetime.datetime.now().isoformat(sep=' ', timespec='seconds'), action, camera, size, reason, self.free_space(), path))
+
+    def drop_segments(self, f, remaining, force=False, camera=None):
+        '''
+        Drops whole segments, oldest first, until remaining() returns 0 or less. Used for the segments that are not reached
+        through the queue, because all of their frames were removed. Segments that are still being written are kept, as are
+        segments containing humans unless force is set. Returns the number of bytes freed
+        camera : only drop the segments of this camera
+        '''
+        segments = []
+        for store in self.stores:
+            segments.extend((start, name, store) for start, name, size, is_open in store.segment_list()
+                            if not is_open and (camera is None or ShardedLayout.camera_of(name) == camera))
+        segments.sort(key=lambda segment: segment[0])
+
+        freed = 0
+        for start, name, store in segments:
+            if remaining() <= 0:
+                break
+            freed = freed + self.drop_segment(f, store, name, 'segment', force)
+        return freed
+
+    def expire(self, max_age_days):
+        '''
+        Removes the day shards of all images older than max_age_days, a whole day at a time, regardless of their priority.
+        Returns the number of bytes freed
+        '''
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=max_age_days)).strftime('%Y %m %d').split()
+        freed = 0
+
+        f = open(self.log_file, 'a') if self.log_file is not None else None
+        try:
+            for directory, redundant in self.directories:
+                for root in ShardedLayout.roots(directory):
+                    for day in ShardedLayout.days(root):
+                        if list(day) >= cutoff:
+                            break
+                        day_dir = os.path.normpath(os.path.join(root, *day))
+                        for path in [p for p in self.images if p.startswith(day_dir + os.sep)]:
+                            self.forget(path)
+                        for dirpath, dirnames, filenames in os.walk(day_dir):
+                            for name in filenames:
+                                try:
+                                    size = os.path.getsize(os.path.join(dirpath, name))
+                                    self.ledger.record(ShardedLayout.camera_of(name), -size)
+                                    DELETED_FILES.labels(ShardedLayout.camera_of(name), 'expired').inc()
+                                    DELETED_BYTES.labels(ShardedLayout.camera_of(name), 'expired').inc(size)
+                                except FileNotFoundError:
+                                    pass
+                        day_freed = ShardedLayout.remove_day(root, day)
+                        if self.catalog is not None:
+                            self.catalog.remove_directory(day_dir)
+                        if f is not None:
+                            f.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                                datetime.datetime.now().isoformat(sep=' ', timespec='seconds'), 'expire',
+                                ShardedLayout.camera_of(root) if root != directory else '', day_freed,
+                                'older than {} days'.format(max_age_days), self.free_space(), day_dir))
+                        freed = freed + day_freed
+        finally:
+            if f is not None:
+                f.close()
+
+        if freed:
+            print("[INFO - RetentionPolicy] Expired {:.1f} MiB of images older than {} days".format(freed / 2**20, max_age_days))
+        return freed
+
+# === TIERED RECOMPRESSION ===
+
+class TieredRecompressor:
+    '''
+    Background job that re-encodes aging images at a lower quality or resolution, so that the same card holds weeks of history
+    instead of days. Frames are written by cv2.imwrite at full resolution and quality 95, while an image that is a few days old
+    is rarely looked at in more detail than a thumbnail.
+
+    Images move through a list of tiers. A tier applies to an hour shard once the whole hour is older than the age of the tier,
+    and an hour shard that is older than several tiers is re-encoded once, straight to the last of them. Images in which a human
+    was detected are re-encoded with the human_width and human_quality of the tier, so that they keep more detail.
 
-            SIM = self.determine_similarity(self.first_image, image)
+    The images are labelled and re-encoded in a pool of worker threads (cv2 releases the GIL while it decodes and encodes) that run
+    at the lowest CPU priority, in batches of batch_size images, and no new batch is started while the load average per core is
+    above max_load, so that motion detection is never starved. Each re-encoded image replaces the original atomically and keeps its modification time.
 
-            if SIM > self.similarity_thresh:
-                '''
-                Save the image if the similarity is less than the set threshold
-                '''
-                print("[DEBUG - SimilarityDetector] Image above threshold found")
-                os.rename(img_name, "../bin/storage/" +
-                          img_name[12:])  # Move the image
+    The hour shard up to which each tier is done is stored per root directory in state_file, so that restarts do not re-encode
+    images a second time.
+    '''
 
-            self.first_image = image
+    # age : hours after which the tier applies
+    # width, quality : size and JPEG quality of images without humans, width None keeps the size
+    # human_width, human_quality : size and JPEG quality of images with humans
+    TIERS = [{'age': 24, 'width': 1280, 'quality': 70, 'human_width': None, 'human_quality': 90},
+             {'age': 7*24, 'width': 320, 'quality': 60, 'human_width': 960, 'human_quality': 80}]
+
+    def __init__(self, directories, interval, tiers=None, state_file='../bin/.recompression.pickle', workers=2, max_load=0.75,
+                 detector_util=None, catalog=None, ledger=None, batch_size=16):
+        '''
+        directories : directories (and their per camera storage sub directories) of which the images are recompressed
+        interval : interval between passes, in minutes
+        tiers : list of tier dictionaries, oldest last, defaults to TIERS
+        state_file : file in which the progress of every tier is kept
+        workers : number of images re-encoded at the same time
+        max_load : load average per core above which no new batch is started
+        batch_size : number of images handed to the workers between two checks of the load
+        detector_util : HumanDetectorUtil used to label images that have no human label yet
+        catalog : ImageCatalog from which human labels are read, and in which the new sizes are recorded
+        ledger : UsageLedger in which the saved bytes are recorded
+
+        Images that have no label and can not be labelled are treated as containing a human, so that they are never degraded more
+        than necessary.
+        '''
+        self.directories = directories
+        self.interval = interval*60
+        self.last_check_time = 0
+        self.tiers = tiers if tiers is not None else TieredRecompressor.TIERS
+        self.state_file = state_file
+        self.workers = workers
+        self.max_load = max_load
+        self.batch_size = batch_size
+        self.detector_util = detector_util
+        self.detect_lock = Lock()  # The cascade classifier of the detector is not safe to use from several workers at once
+        self.catalog = catalog
+        self.ledger = ledger
+
+        self.done = {}  # root -> list of the last hour shard completed by every tier
+        self.load_state()
+
+    def load_state(self):
+        if not os.path.isfile(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'rb') as f:
+                self.done = pickle.load(f)
+        except Exception as e:
+            print("[ERROR - TieredRecompressor] Could not read state file, starting from scratch: ", e)
+
+    def save_state(self):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self.done, f)
+        os.replace(tmp_file, self.state_file)
+
+    def lower_priority():
+        # Linux applies the nice value of setpriority to the calling thread only
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+    def overloaded(self):
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1) > self.max_load
+        except OSError:
+            return False
+
+    def tier_of(self, shard):
+        '''
+        Returns the index of the last tier that applies to an hour shard, or -1 if it is still too young
+        '''
+        shard_end = ShardedLayout.shard_time(shard) + 60*60
+        age = (time.time() - shard_end) / (60*60)
+        tier = -1
+        for i, settings in enumerate(self.tiers):
+            if age >= settings['age']:
+                tier = i
+        return tier
+
+    def current_tier(self, root, shard):
+        done = self.done.get(root, [])
+        tier = -1
+        for i, last in enumerate(done):
+            if last is not None and tuple(shard) <= tuple(last):
+                tier = i
+        return tier
+
+    def is_human(self, path, labels):
+        if path in labels:
+            return labels[path]
+        if self.detector_util is None:
+            return True
+
+        with self.detect_lock:
+            human = bool(self.detector_util.detect_file(path))
+        if self.catalog is not None:
+            self.catalog.set_human(path, human)
+        return human
+
+    def recompress_file(self, path, settings, human):
+        '''
+        Re-encodes a single image. Returns the number of bytes saved
+        '''
+        width = settings['human_width'] if human else settings['width']
+        quality = settings['human_quality'] if human else settings['quality']
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:  # Deleted by the storage manager in the meantime
+            return 0
+
+        image = ImageLoader.load(path, width=width, cached=False)
+        if image is None:
+            return 0
+
+        ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok or len(data) >= stat.st_size:
+            return 0
+
+        # Write next to the original and rename over it, so that a crash never leaves a half written image behind
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(data.tobytes())
+        os.utime(tmp_file, (stat.st_atime, stat.st_mtime))
+        if not os.path.exists(path):  # Deleted while it was being re-encoded
+            os.remove(tmp_file)
+            return 0
+        os.rename(tmp_file, path)
+
+        if self.catalog is not None:
+            self.catalog.set_size(path, len(data))
+        if self.ledger is not None:
+            self.ledger.record(ShardedLayout.camera_of(path), len(data) - stat.st_size)
+        return stat.st_size - len(data)
+
+    def label_and_recompress(self, path, settings, labels):
+        # Runs in a worker, so that human detection is done at low priority as well
+        return self.recompress_file(path, settings, self.is_human(path, labels))
+
+    def recompress_shard(self, pool, root, shard, settings):
+        shard_dir = os.path.join(root, *shard)
+        paths = [os.path.normpath(os.path.join(shard_dir, name)) for name in sorted(os.listdir(shard_dir)) if name.endswith('.jpg')]
+        labels = self.catalog.human_labels(shard_dir) if self.catalog is not None else {}
+
+        saved = 0
+        for i in range(0, len(paths), self.batch_size):
+            while self.overloaded():
+                time.sleep(5)
+            saved = saved + sum(pool.map(lambda path: self.label_and_recompress(path, settings, labels),
+                                         paths[i:i + self.batch_size]))
+        return saved
+
+    def recompress(self):
+        '''
+        Brings every hour shard up to the tier that its age calls for. Returns the number of bytes saved
+        '''
+        if time.time() - self.last_check_time < self.interval:
+            return 0
+        self.last_check_time = time.time()
+
+        saved = 0
+        shards = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers, initializer=TieredRecompressor.lower_priority) as pool:
+            for directory in self.directories:
+                if not os.path.isdir(directory):
+                    continue
+                for root in ShardedLayout.roots(directory):
+                    root = os.path.normpath(root)
+                    for shard in ShardedLayout.hours(root):
+                        tier = self.tier_of(shard)
+                        if tier < 0:
+                            break  # The rest of the shards are younger
+                        if self.current_tier(root, shard) >= tier:
+                            continue
+
+                        saved = saved + self.recompress_shard(pool, root, shard, self.tiers[tier])
+                        shards = shards + 1
+
+                        done = self.done.setdefault(root, [])
+                        done.extend([None] * (len(self.tiers) - len(done)))
+                        for i in range(tier + 1):
+                            if done[i] is None or tuple(shard) > tuple(done[i]):
+                                done[i] = tuple(shard)
+                        self.save_state()
+
+        if shards:
+            print("[INFO - TieredRecompressor] Recompressed {} hour shards, saved {:.1f} MiB".format(shards, saved / 2**20))
+        return saved
+
+# === TIMELAPSE COMPACTION ===
+
+class TimelapseCompactor:
+    '''
+    Compacts the stills in which no human was detected into one timelapse video per camera per day. After filtering a camera
+    still leaves thousands of stills per day, most of which only matter as context, and a video stores them in a fraction of
+    the space because consecutive frames are encoded as differences.
+
+    The job runs incrementally: every hour shard that is older than min_age_hours is encoded into a chunk video in the shard
+    ('<camera> - YYYYMMDD-HH.timelapse.mp4'), so that a pass never has more than an hour of stills to encode. Once every hour of a day
+    has been compacted, the chunks are joined into '<camera> - YYYYMMDD.timelapse.mp4' in the day shard, so that expiring the day
+    removes the video as well.
+
+    Every video has an index next to it ('<video>.tsv') with the frame number, capture time and original name of every frame.
+    A chunk is only trusted once it has been read back and has the expected number of frames; only then are the stills
+    deleted. Stills with humans, and stills without a label when there is no detector, are never compacted.
+
+    The rows of the compacted stills in the catalog are replaced by one row per frame of the video ('<video>/<frame number>',
+    state 'timelapse'), which the TimelapseFrameStore reads, so that the frames stay in the events of their day.
+    '''
+
+    SUFFIX = TimelapseFrameStore.SUFFIX
+
+    def __init__(self, directories, interval, min_age_hours=24, fps=10, width=1280, fourcc='mp4v',
+                 state_file='../bin/.timelapse.pickle', detector_util=None, catalog=None, ledger=None):
+        '''
+        directories : directories (and their per camera storage sub directories) of which the stills are compacted
+        interval : interval between passes, in minutes
+        min_age_hours : age of an hour shard after which it is compacted
+        fps : frame rate of the timelapse videos
+        width : width of the video frames
+        fourcc : codec of the videos
+        state_file : file in which the last compacted hour shard of every root directory is kept
+        detector_util : HumanDetectorUtil used to label stills that have no human label yet
+        catalog : ImageCatalog from which human labels are read, and in which compacted stills are replaced by video frames
+        ledger : UsageLedger in which the saved bytes are recorded
+        '''
+        self.directories = directories
+        self.interval = interval*60
+        self.last_check_time = 0
+        self.min_age_hours = min_age_hours
+        self.fps = fps
+        self.width = width
+        self.fourcc = fourcc
+        self.state_file = state_file
+        self.detector_util = detector_util
+        self.catalog = catalog
+        self.ledger = ledger
+
+        self.done = {}  # root -> last hour shard that was compacted
+        self.load_state()
+
+    def load_state(self):
+        if not os.path.isfile(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'rb') as f:
+                self.done = pickle.load(f)
+        except Exception as e:
+            print("[ERROR - TimelapseCompactor] Could not read state file, starting from scratch: ", e)
+
+    def save_state(self):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self.done, f)
+        os.replace(tmp_file, self.state_file)
+
+    def is_human(self, path, labels):
+        if path in labels:
+            return labels[path]
+        if self.detector_util is None:
+            return True
+
+        human = bool(self.detector_util.detect_file(path))
+        if self.catalog is not None:
+            self.catalog.set_human(path, human)
+        return human
+
+    def write_video(self, video_file, frames):
+        '''
+        Encodes the frames yielded by frames into video_file. Returns the number of frames written
+        '''
+        writer = None
+        size = None
+        count = 0
+        for frame in frames:
+            if writer is None:
+                frame = imutils.resize(frame, width=self.width) if frame.shape[1] > self.width else frame
+                size = (frame.shape[1], frame.shape[0])
+                writer = cv2.VideoWriter(video_file, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, size)
+            elif (frame.shape[1], frame.shape[0]) != size:
+                frame = cv2.resize(frame, size)
+            writer.write(frame)
+            count = count + 1
+
+        if writer is not None:
+            writer.release()
+        return count
+
+    def count_frames(video_file):
+        capture = cv2.VideoCapture(video_file)
+        count = 0
+        while capture.grab():
+            count = count + 1
+        capture.release()
+        return count
+
+    def read_frames(video_file):
+        capture = cv2.VideoCapture(video_file)
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+        capture.release()
+
+    def write_index(index_file, rows):
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            for number, captured, name in rows:
+                f.write("{}\t{}\t{}\n".format(number, captured, name))
+        os.replace(tmp_file, index_file)
+
+    def discard(self, video_file):
+        for path in (video_file, video_file + '.tsv'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def catalog_video(self, camera, video_file, rows):
+        '''
+        Adds a row for every frame of a verified video to the catalog
+        '''
+        if self.catalog is None:
+            return
+        size = os.path.getsize(video_file) // max(len(rows), 1)
+        self.catalog.add_many([(os.path.join(video_file, str(number)), camera, captured, size, 0, 'timelapse')
+                               for number, captured, name in rows])
+
+    def compact_hour(self, root, shard):
+        '''
+        Encodes the non-human stills of an hour shard into a chunk video, and deletes them once the chunk is verified.
+        Returns the number of bytes saved
+        '''
+        shard_dir = os.path.join(root, *shard)
+        labels = self.catalog.human_labels(shard_dir) if self.catalog is not None else {}
+        names = sorted(name for name in os.listdir(shard_dir) if name.endswith('.jpg'))
+        paths = [os.path.normpath(os.path.join(shard_dir, name)) for name in names]
+        paths = [path for path in paths if not self.is_human(path, labels)]
+        if not paths:
+            return 0
+
+        camera = ShardedLayout.camera_of(paths[0])
+        video_file = os.path.join(shard_dir, camera + ' - ' + ''.join(shard) + TimelapseCompactor.SUFFIX)
+
+        rows = []
+        sizes = 0
+
+        def frames():
+            nonlocal sizes
+            for path in paths:
+                image = ImageLoader.load(path, width=self.width, cached=False)
+                if image is None:  # Removed by the storage manager in the meantime
+                    continue
+                captured = ShardedLayout.parse_name(path)[1]
+                rows.append((len(rows), captured if captured is not None else os.path.getmtime(path), os.path.basename(path)))
+                sizes = sizes + os.path.getsize(path)
+                yield image
+
+        count = self.write_video(video_file, frames())
+        if count == 0 or TimelapseCompactor.count_frames(video_file) != count:
+            print("[ERROR - TimelapseCompactor] Could not verify " + video_file + ", keeping the stills")
+            self.discard(video_file)
+            return 0
+
+        TimelapseCompactor.write_index(video_file + '.tsv', rows)
+        compacted = [os.path.join(shard_dir, row[2]) for row in rows]
+        for path in compacted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if self.catalog is not None:
+            self.catalog.remove(compacted)
+        self.catalog_video(camera, video_file, rows)
+
+        saved = sizes - os.path.getsize(video_file)
+        if self.ledger is not None:
+            self.ledger.record(camera, -saved)
+        return saved
+
+    def merge_day(self, root, day):
+        '''
+        Joins the chunk videos of a day into a single video in the day shard. Returns the number of bytes saved
+        '''
+        day_dir = os.path.join(root, *day)
+        chunks = []
+        for hour in sorted(d for d in os.listdir(day_dir) if ShardedLayout.is_shard(d, 3)):
+            hour_dir = os.path.join(day_dir, hour)
+            chunks.extend(os.path.join(hour_dir, name) for name in sorted(os.listdir(hour_dir))
+                          if name.endswith(TimelapseCompactor.SUFFIX) and os.path.isfile(os.path.join(hour_dir, name + '.tsv')))
+        if not chunks:
+            return 0
+
+        camera = ShardedLayout.camera_of(chunks[0])
+        video_file = os.path.join(day_dir, camera + ' - ' + ''.join(day) + TimelapseCompactor.SUFFIX)
+        if os.path.isfile(video_file + '.tsv'):  # Joined before, the chunks were left behind by a crash
+            for chunk in chunks:
+                self.discard(chunk)
+                if self.catalog is not None:
+                    self.catalog.remove_directory(chunk)
+            self.catalog_video(camera, video_file, TimelapseFrameStore.read_index(video_file + '.tsv'))
+            return 0
+
+        rows = []
+        for chunk in chunks:
+            hour = os.path.basename(os.path.dirname(chunk))
+            for number, captured, name in TimelapseFrameStore.read_index(chunk + '.tsv'):
+                rows.append((len(rows), captured, os.path.join(hour, name)))
+
+        def frames():
+            for chunk in chunks:
+                for frame in TimelapseCompactor.read_frames(chunk):
+                    yield frame
+
+        count = self.write_video(video_file, frames())
+        if count != len(rows) or TimelapseCompactor.count_frames(video_file) != count:
+            print("[ERROR - TimelapseCompactor] Could not verify " + video_file + ", keeping the hourly chunks")
+            self.discard(video_file)
+            return 0
+
+        TimelapseCompactor.write_index(video_file + '.tsv', rows)
+        sizes = sum(os.path.getsize(chunk) for chunk in chunks)
+        for chunk in chunks:
+            self.discard(chunk)
+            if self.catalog is not None:
+                self.catalog.remove_directory(chunk)
+        self.catalog_video(camera, video_file, rows)
+
+        saved = sizes - os.path.getsize(video_file)
+        if self.ledger is not None:
+            self.ledger.record(camera, -saved)
+        return saved
+
+    def compact(self):
+        '''
+        Compacts every hour shard that is old enough, and joins the chunks of every day of which all hours have been compacted.
+        Returns the number of bytes saved
+        '''
+        if time.time() - self.last_check_time < self.interval:
+            return 0
+        self.last_check_time = time.time()
+
+        saved = 0
+        hours = 0
+        cutoff = time.time() - self.min_age_hours*60*60
+
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for root in ShardedLayout.roots(directory):
+                root = os.path.normpath(root)
+                for shard in ShardedLayout.hours(root):
+                    if ShardedLayout.shard_time(shard) + 60*60 > cutoff:
+                        break  # The rest of the shards are younger
+
+                    done = self.done.get(root)
+                    if done is not None and tuple(shard) <= done:
+                        continue
+
+                    # The previous day is complete once the first hour of the next day is compacted
+                    if done is not None and tuple(shard[:3]) != done[:3]:
+                        saved = saved + self.merge_day(root, done[:3])
+
+                    saved = saved + self.compact_hour(root, shard)
+                    hours = hours + 1
+                    self.done[root] = tuple(shard)
+                    self.save_state()
+
+                # Days without later footage are joined once the whole day is older than the cutoff
+                done = self.done.get(root)
+                if done is not None and ShardedLayout.shard_time(done[:3]) + 24*60*60 <= cutoff:
+                    saved = saved + self.merge_day(root, done[:3])
+
+        if hours:
+            print("[INFO - TimelapseCompactor] Compacted {} hour shards, saved {:.1f} MiB".format(hours, saved / 2**20))
+        return saved
 
 # === STORAGE MANAGER ===
 
 class StorageManager:
     '''
-    This class will periodically check the available free space in the working directory, and select images at random to delete.
-    If the image contains features
+    This class will periodically check the available free space on the storage volume. Once it drops below the required space,
+    images are deleted in bulk by a RetentionPolicy until the target space is free again.
+    Images containing humans are only deleted once the free space drops below the critical space.
+    Cameras with a quota are trimmed back to their quota on every call, whatever the free space and the interval, and the usage
+    per camera is reconciled with a full scan every reconcile_interval hours.
+    While the free space is below the required space every call cleans, except after a pass that freed nothing (e.g. only
+    images containing humans are left), which is only repeated after stall_backoff seconds or once the space turns critical.
     '''
     force_remove = False
     memory_flag: bool
     first_pass_completed = True
+    stall_backoff = 300
 
-    def __init__(self, work_in_dir, interval, space=20, critical_space=2):
+    def __init__(self, work_in_dir, interval, space=20, critical_space=2, target_space=None, camera_dirs=None, quotas=None,
+                 log_file='../bin/retention.log', catalog=None, max_age_days=None, stores=None, ledger=None, reconcile_interval=6):
         '''
         work_in_dir : path to the directory in which the class must find images
         interval : interval between directory checks, in minutes
+        space : free space (GiB) below which images are deleted
+        critical_space : free space (GiB) below which images containing humans are deleted as well
+        target_space : free space (GiB) that deletion continues up to, defaults to 1.25 times space
+        camera_dirs : directories of the cameras, of which images are deleted once work_in_dir has been emptied
+        quotas : dictionary of camera name to the number of GiB that the camera may use
+        log_file : file to which every retention decision is appended
+        catalog : ImageCatalog that is updated when images are labelled or deleted
+        max_age_days : images older than this many days are removed a whole day at a time, kept forever if None
+        stores : SegmentFrameStores of the cameras, of which the frames are ranked with the images and dropped a segment at a time
+        ledger : UsageLedger shared with the components that write frames
+        reconcile_interval : hours between full scans of the usage per camera
         '''
         self.last_check_time = time.time()
+        self.stalled_until = 0  # time.time() before which a pass that freed nothing is not repeated
+        self.stalled_force = None  # force_remove of that pass
         self.wid = work_in_dir
+        # The SimilarityDetector only creates it when it moves its first image, but the free space is measured on it
+        os.makedirs(self.wid, exist_ok=True)
         self.interval = interval*60
-        self.files = glob.glob(self.wid + '/*.jpg')
-        self.files.sort(key=os.path.getmtime)
+        self.max_age_days = max_age_days
+        self.reconcile_interval = reconcile_interval*60*60
         self.required_space = space
         self.critical_space = critical_space
+        self.target_space = target_space if target_space is not None else space*1.25
         self.detector_util = HumanDetectorUtil()
 
+        directories = [(self.wid, True)]
+        for camera_dir in camera_dirs or []:
+            directories.append((camera_dir, False))
+
+        if quotas is not None:
+            quotas = {camera: quotas[camera] * 2**30 for camera in quotas}
+
+        self.retention = RetentionPolicy(directories, volume=self.wid, quotas=quotas,
+                                         log_file=log_file, detector_util=self.detector_util, catalog=catalog, stores=stores,
+                                         ledger=ledger)
+        self.lock = Lock()
+        self.new_camera_dirs = []  # (camera_dir, store) tuples added from other threads, managed from the next check on
+
+    def add_camera_dir(self, camera_dir, store=None):
+        '''
+        Manages the directory of a camera that was added while the system is running. Safe to call from any thread
+        '''
+        with self.lock:
+            self.new_camera_dirs.append((camera_dir, store))
+
     def check_free_space(self):
-        total, used, free = shutil.disk_usage("/")
+        # Measure the volume that the images are stored on, which is not necessarily the root file system
+        total, used, free = shutil.disk_usage(self.wid)
+        FREE_BYTES.set(free)
         #print ("Total free space on system: %d GiB" % (free // (2**30)))
         return (free // (2**30))
 
     def reduce_files(self):
         '''
-        Perform human detection in all saved images using Histograms of Oriented Gradients for Human Detection
+        Deletes images until the target space is free, once the free space drops below the required space
         '''
         space = self.check_free_space()
         if space < self.required_space:
@@ -344,85 +2563,336 @@ class StorageManager:
         else:
             self.force_remove = False
 
+        # Cameras added since the last call are tracked straight away, not only once the interval has passed
+        with self.lock:
+            new_camera_dirs = self.new_camera_dirs
+            self.new_camera_dirs = []
+        for camera_dir, store in new_camera_dirs:
+            os.makedirs(camera_dir, exist_ok=True)
+            self.retention.add_directory(camera_dir, False, store)
+
+        # Quotas are checked against the ledger on every call, which costs nothing while every camera is within its quota,
+        # so that a noisy camera can not overshoot its quota until the next interval
+        self.retention.enforce_quotas(force=self.force_remove)
+
         if self.first_pass_completed:
             # Check that time of interval has passed
-            if (time.time() - self.last_check_time < self.interval) and not self.memory_flag:
+            due = time.time() - self.last_check_time >= self.interval
+            stalled = time.time() < self.stalled_until and self.stalled_force == self.force_remove
+            if not due and (not self.memory_flag or stalled):
                 return
 
-        print("[INFO] Cleaning memory")
+        self.retention.update()
 
-        self.files = glob.glob(self.wid + '/*.jpg')
+        if time.time() - self.retention.ledger.last_reconciled >= self.reconcile_interval:
+            self.retention.reconcile()
 
-        if len(self.files) > 10:
-            rand_img = random.choice(self.files)
-            img = cv2.imread(rand_img)
+        if self.max_age_days is not None:
+            self.retention.expire(self.max_age_days)
 
-            if self.detector_util.detect(img) and not self.force_remove:
-                return None
+        stats = ImageLoader.cache.stats()
+        print("[INFO - StorageManager] Decoded image cache: {} hits, {} misses ({:.0%} hit rate), {:.1f} of {:.1f} MiB used".format(
+            stats['hits'], stats['misses'], stats['hit_rate'], stats['bytes'] / 2**20, stats['max_bytes'] / 2**20))
+
+        if self.memory_flag:
+            print("[INFO - StorageManager] Cleaning memory")
+            freed = self.retention.enforce(
+                int(self.target_space * 2**30), force=self.force_remove)
+            if freed == 0:
+                self.stalled_until = time.time() + self.stall_backoff
+                self.stalled_force = self.force_remove
             else:
-                os.remove(rand_img)
-                self.files.remove(rand_img)
+                self.stalled_until = 0
 
         self.last_check_time = time.time()
 
-# === CAMERA MANAGER ===
+# === LIVE VIEW SERVER ===
 
-class CameraManager:
+class SharedEncoder:
+    '''
+    Holds the JPEG encoding of a camera's latest frame. A frame is encoded at most once per output width, when the first client
+    asks for it, and every other client is handed the same bytes, so that more viewers do not mean more encoding.
+    '''
 
-    def list_cameras(filepath):
-        """
-        Reads the saved camera information from a .pickle file, and returns a list containing the information.
-        """
+    def __init__(self, stream, quality=80):
+        '''
+        stream : Stream whose frames are encoded, its reading thread is shared with whatever else uses it
+        quality : JPEG quality of the encoded frames
+        '''
+        self.stream = stream
+        self.quality = quality
+        self.lock = Lock()
+        self.encoded = {}  # width -> (frame count, JPEG bytes) of the last frame encoded at that width
+        self.encodes = 0
+        self.clients = 0
+
+    def get(self, width=None, seen=0):
+        '''
+        Returns (frame count, JPEG bytes) of the latest frame, or (seen, None) if there is no frame newer than seen
+        width : width to scale the frame down to, the full frame if None
+        '''
+        if self.stream.frame_count == seen:
+            return seen, None
+
+        with self.lock:
+            cached = self.encoded.get(width)
+            if cached is None or cached[0] != self.stream.frame_count:
+                count, frame = self.stream.get_new_frame(cached[0] if cached is not None else 0)
+                if frame is not None:
+                    if width is not None and width < frame.shape[1]:
+                        frame = imutils.resize(frame, width=width, inter=cv2.INTER_AREA)
+                    ok, jpeg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+                    if ok:
+                        cached = (count, jpeg.tobytes())
+                        self.encoded[width] = cached
+                        self.encodes = self.encodes + 1
+
+        if cached is None or cached[0] == seen:
+            return seen, None
+        return cached
+
+    def wait(self, width=None, seen=0, timeout=5, poll=0.01):
+        '''
+        Waits up to timeout seconds for a frame newer than seen, see get()
+        '''
+        end = time.time() + timeout
+        while True:
+            count, jpeg = self.get(width, seen)
+            if jpeg is not None or time.time() >= end:
+                return count, jpeg
+            time.sleep(poll)
 
-        cam_list = []
 
-        if not os.path.isfile(filepath + 'saved_cameras.pickle'):
-            print("[INFO - CameraManager] No saved cameras exist on this device yet")
-            return False
+class LiveViewHandler(BaseHTTPRequestHandler):
+    '''
+    Answers the requests of the live view server:
+     - / : a page showing every camera
+     - /snapshot/<camera>.jpg?width=640 : the latest frame of a camera
+     - /stream/<camera>.mjpg?width=640 : the frames of a camera as MJPEG
+    Every request must carry the server's credentials (HTTP basic auth) when it has any.
+    '''
 
-        f = open(filepath + 'saved_cameras.pickle', 'rb')
-        print("[INFO - CameraManager] Fetching saved cameras")
-        cam_dict = pickle.load(f)
+    protocol_version = 'HTTP/1.0'
+    boundary = 'frame'
 
-        for cam in cam_dict:
-            cam_list.append([cam, cam_dict[cam]])
+    def do_GET(self):
+        server = self.server.live_view
+        if not server.authorized(self.headers.get('Authorization')):
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="Live view", charset="UTF-8"')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
 
-        f.close()
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
 
-        return cam_list
+        width = None
+        if 'width' in query and query['width'][0].isdigit():
+            width = server.output_width(int(query['width'][0]))
 
-    def save_camera(filepath, window, name, src):
-        """
-        Writes the info of a new camera to the file. Also performs a check for file existence, and rejects duplicates
-        """
+        if url.path == '/':
+            self.send_index(server)
+        elif len(parts) == 2 and parts[0] == 'snapshot' and parts[1].endswith('.jpg'):
+            self.send_snapshot(server, urllib.parse.unquote(parts[1][:-len('.jpg')]), width)
+        elif len(parts) == 2 and parts[0] == 'stream' and parts[1].endswith('.mjpg'):
+            self.send_stream(server, urllib.parse.unquote(parts[1][:-len('.mjpg')]), width)
+        else:
+            self.send_error(404)
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_index(self, server):
+        images = ''.join('<figure><img src="/stream/{0}.mjpg?width={1}"><figcaption>{2}</figcaption></figure>'.format(
+            urllib.parse.quote(name), server.widths[0], html.escape(name)) for name in server.cameras())
+        page = '<!DOCTYPE html><html><head><title>Live view</title></head><body>' + images + '</body></html>'
+        self.send_body('text/html; charset=utf-8', page.encode('utf-8'))
+
+    def send_snapshot(self, server, camera, width):
+        encoder = server.encoder(camera)
+        if encoder is None:
+            self.send_error(404, 'Unknown camera')
+            return
+        count, jpeg = encoder.wait(width, 0, timeout=server.frame_timeout)
+        if jpeg is None:
+            self.send_error(503, 'No frame available')
+            return
+        self.send_body('image/jpeg', jpeg)
 
-        if not os.path.isfile(filepath + 'saved_cameras.pickle'):
-            print("[INFO - CameraManager] Creating save file")
-            f = open(filepath + 'saved_cameras.pickle', 'wb')
-            pickle.dump({}, f)
-            f.close()
+    def send_stream(self, server, camera, width):
+        '''
+        Sends the latest frame whenever the client has taken the previous one. A slow client skips the frames that arrived while
+        it was still receiving, instead of queueing them, and a client that stops reading is dropped after the write timeout
+        '''
+        encoder = server.encoder(camera)
+        if encoder is None:
+            self.send_error(404, 'Unknown camera')
+            return
 
-        f = open(filepath + 'saved_cameras.pickle', 'rb')
+        self.request.settimeout(server.write_timeout)
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + self.boundary)
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+
+        with server.lock:
+            encoder.clients = encoder.clients + 1
+        seen = 0
+        try:
+            while server.running and server.encoder(camera) is encoder:
+                sent = time.time()
+                seen, jpeg = encoder.wait(width, seen, timeout=server.frame_timeout)
+                if jpeg is None:
+                    continue
+                self.wfile.write(('--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(
+                    self.boundary, len(jpeg))).encode('ascii'))
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+                self.wfile.flush()
+                time.sleep(max(0, 1 / server.max_fps - (time.time() - sent)))
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            pass
+        finally:
+            with server.lock:
+                encoder.clients = encoder.clients - 1
+
+    def log_message(self, format, *args):
+        pass  # Streams would flood the log, errors are printed by the server itself
+
+
+class LiveViewServer:
+    '''
+    Serves the latest frames of the cameras over HTTP, as MJPEG streams and single snapshots, so that the cameras can be viewed
+    in a browser without the GUI and without opening more RTSP sessions. Every camera's frames are taken from the Stream that
+    the system already reads from, and are encoded once per frame and output width for all clients (see SharedEncoder).
 
-        cam_dict = pickle.load(f)
-        for cam in cam_dict:
-            if cam_dict[cam] == src:
-                print(
-                    "[ERROR - CameraManager] A camera with this source has already been added. Rejecting duplicate")
-                f.close()
-                window.destroy()
-                return
+    Every client is served by its own thread, and only ever waits for the encoded frames, never for the camera, so that a slow
+    client drops frames rather than holding up capture or the other clients.
 
-        f.close()
+    By default only the local machine can connect. Listening on other interfaces should go together with a user and password,
+    since the frames are otherwise visible to anyone on the network.
+    '''
 
-        f = open(filepath + 'saved_cameras.pickle', 'wb')
-        print("[INFO - CameraManager] Saving current camera")
-        cam_dict.update({name: src})
+    def __init__(self, host='127.0.0.1', port=8080, quality=80, widths=(320, 640), max_fps=10, write_timeout=10, frame_timeout=5,
+                 user=None, password=None):
+        '''
+        host, port : address to listen on
+        quality : JPEG quality of the served frames
+        widths : widths that clients may ask for, requests are rounded up to one of them, or to the full frame. Limiting them
+                 bounds the number of encodings per frame
+        max_fps : maximum frames per second sent to a single client
+        write_timeout : seconds after which a client that does not take a frame is disconnected
+        frame_timeout : seconds that a snapshot waits for a first frame
+        user, password : credentials that clients must send (HTTP basic auth), no authentication if None
+        '''
+        self.host = host
+        self.port = port
+        self.quality = quality
+        self.widths = sorted(widths)
+        self.max_fps = max_fps
+        self.write_timeout = write_timeout
+        self.frame_timeout = frame_timeout
+        self.credentials = None
+        if user is not None and password is not None:
+            self.credentials = 'Basic ' + base64.b64encode((user + ':' + password).encode('utf-8')).decode('ascii')
+        self.lock = Lock()
+        self.encoders = {}  # Camera name -> SharedEncoder
+        self.running = False
+        self.httpd = None
+        self.thread = None
+
+    def authorized(self, authorization):
+        '''
+        Returns whether a request with the given Authorization header may be served
+        '''
+        if self.credentials is None:
+            return True
+        return authorization is not None and hmac.compare_digest(authorization.encode('utf-8'), self.credentials.encode('utf-8'))
+
+    def output_width(self, width):
+        for allowed in self.widths:
+            if width <= allowed:
+                return allowed
+        return None
+
+    def add_camera(self, name, stream):
+        with self.lock:
+            self.encoders[name] = SharedEncoder(stream, self.quality)
+
+    def remove_camera(self, name):
+        '''
+        Stops serving a camera, its clients are disconnected once their current frame is sent
+        '''
+        with self.lock:
+            self.encoders.pop(name, None)
+
+    def encoder(self, name):
+        with self.lock:
+            return self.encoders.get(name)
+
+    def cameras(self):
+        with self.lock:
+            return sorted(self.encoders)
 
-        pickle.dump(cam_dict, f)
-        f.close()
+    def stats(self):
+        '''
+        Returns {camera: {'clients': connected clients, 'encodes': frames encoded so far}}
+        '''
+        with self.lock:
+            return {name: {'clients': e.clients, 'encodes': e.encodes} for name, e in self.encoders.items()}
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), LiveViewHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.live_view = self
+        self.port = self.httpd.server_address[1]  # The port that was chosen if port was 0
+        self.running = True
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print("[INFO - LiveViewServer] Serving live view on http://{}:{}/".format(self.host, self.port))
+        if self.credentials is None and self.host not in ('127.0.0.1', 'localhost', '::1'):
+            print("[INFO - LiveViewServer] No user and password set, anyone who can reach {} can see the cameras".format(self.host))
+
+    def stop(self):
+        self.running = False
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+# === CAMERA MANAGER ===
 
-        print("[INFO - CameraManager] Camera saved")
+class CameraManager:
+
+    def list_cameras(filepath):
+        """
+        Returns a list containing the information of the saved cameras, or False if no cameras have been saved yet.
+        The file is only read again when it has changed (see CameraConfig).
+        """
+        config = CameraConfig.get(filepath)
+        cam_list = config.list()
+        if not config.exists():
+            print("[INFO - CameraManager] No saved cameras exist on this device yet")
+            return False
+
+        return cam_list
+
+    def save_camera(filepath, window, name, src):
+        """
+        Writes the info of a new camera to the file. Rejects duplicates
+        """
+        print("[INFO - CameraManager] Saving current camera")
+        if CameraConfig.get(filepath).add(name, src):
+            print("[INFO - CameraManager] Camera saved")
+        else:
+            print("[ERROR - CameraManager] A camera with this source has already been added. Rejecting duplicate")
 
         window.destroy()
 
@@ -432,54 +2902,552 @@ class CameraManager:
         """
         Deletes a named camera from the saved file
         """
+        if CameraConfig.get(filepath).remove(name):
+            print("[INFO - CameraManager] " + name + " has been removed")
+        else:
+            print("[INFO - CameraManager] " + name + " is not a saved camera")
 
-        if not os.path.isfile(filepath + 'saved_cameras.pickle'):
-            print("[INFO - CameraManager] No saved cameras exist on this device yet")
+        window.destroy()
+
+        return
+    
+# === PIPELINE RUNTIME ===
+
+class PipelineStage:
+    '''
+    One stage of a Pipeline: a number of worker threads that take items from a bounded queue, pass them to function, and put
+    what function returns (unless it is None) into the queue of the next stage.
+
+    Since the queues are bounded, a stage that falls behind blocks the stage before it, which blocks the one before that, up to
+    the first stage. Its policy decides what happens there: 'block' waits for room, 'drop_oldest' discards the oldest queued
+    item to make room, so that a live source keeps the newest frames instead of building a backlog.
+
+    If key is given, items with the same key are always handled by the same worker, in order, so that per camera state (e.g. a
+    background model) is only ever used by one thread. Otherwise all workers share one queue.
+    '''
+
+    done = object()  # Put into a queue to stop the worker that takes it
+
+    def __init__(self, name, function, workers=1, queue_size=32, key=None, policy='block', idle=None, idle_interval=1):
+        '''
+        name : name used in logs and statistics
+        function : called with every item, returns the item for the next stage or None
+        workers : number of worker threads
+        queue_size : number of items that can wait in each queue
+        key : function returning the key of an item, see above
+        policy : 'block' or 'drop_oldest', see above
+        idle : called with the worker index whenever a worker has had nothing to do for idle_interval seconds
+        '''
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.key = key
+        self.policy = policy
+        self.idle = idle
+        self.idle_interval = idle_interval
+        self.queues = [queue.Queue(queue_size) for i in range(workers if key is not None else 1)]
+        self.next = None
+        self.threads = []
+        self.lock = Lock()
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy = 0.0  # Seconds spent in function
+        self.latency = 0.0  # Seconds from the creation of the items to the end of this stage, summed over the processed items
+        self.max_latency = 0.0
+        self.stage_seconds = STAGE_SECONDS.labels(name)
+        self.stage_latency = STAGE_LATENCY.labels(name)
+        self.dropped_metric = STAGE_DROPPED.labels(name)
+        self.errors_metric = STAGE_ERRORS.labels(name)
+        self.queued = STAGE_QUEUED.labels(name)
+
+    def worker_of(self, key):
+        return hash(key) % len(self.queues)
+
+    def queue_of(self, item):
+        if self.key is None:
+            return self.queues[0]
+        return self.queues[self.worker_of(self.key(item))]
+
+    def put(self, item, created=None):
+        '''
+        Queues an item, created is the time at which the item entered the pipeline
+        '''
+        q = self.queue_of(item)
+        entry = (created if created is not None else time.time(), item)
+        if self.policy != 'drop_oldest':
+            q.put(entry)
             return
 
-        f = open(filepath + 'saved_cameras.pickle', 'rb')
-        print("[INFO - CameraManager] Fetching saved cameras")
-        cam_dict = pickle.load(f)
-        f.close()
+        while True:
+            try:
+                q.put_nowait(entry)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    with self.lock:
+                        self.dropped = self.dropped + 1
+                    self.dropped_metric.inc()
+                except queue.Empty:
+                    pass
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self.work, args=(i,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self, index):
+        q = self.queues[index % len(self.queues)]
+        while True:
+            try:
+                entry = q.get(timeout=self.idle_interval)
+            except queue.Empty:
+                if self.idle is not None:
+                    self.run(self.idle, index)
+                continue
+            if entry is PipelineStage.done:
+                return
+
+            created, item = entry
+            start = time.time()
+            with Tracer.span(self.name, 'pipeline'):
+                result = self.run(self.function, item)
+            end = time.time()
+            with self.lock:
+                self.processed = self.processed + 1
+                self.busy = self.busy + (end - start)
+                self.latency = self.latency + (end - created)
+                self.max_latency = max(self.max_latency, end - created)
+            self.stage_seconds.observe(end - start)
+            self.stage_latency.observe(end - created)
+            self.queued.set(sum(q.qsize() for q in self.queues))
+            if result is not None and self.next is not None:
+                self.next.put(result, created)
+
+    def run(self, function, argument):
+        try:
+            return function(argument)
+        except Exception as e:
+            with self.lock:
+                self.errors = self.errors + 1
+            self.errors_metric.inc()
+            print("[ERROR - PipelineStage] {} failed: {}".format(self.name, e))
+            return None
+
+    def stop(self, timeout=None):
+        '''
+        Lets the workers finish every item that has been queued, then stops them. Returns False if they did not stop in time
+        '''
+        for i in range(self.workers):
+            self.queues[i % len(self.queues)].put(PipelineStage.done)
+        end = time.time() + timeout if timeout is not None else None
+        for thread in self.threads:
+            thread.join(None if end is None else max(0, end - time.time()))
+        stopped = not any(thread.is_alive() for thread in self.threads)
+        self.threads = []
+        return stopped
+
+    def stats(self):
+        with self.lock:
+            return {'queued': sum(q.qsize() for q in self.queues), 'processed': self.processed, 'dropped': self.dropped,
+                    'errors': self.errors, 'workers': self.workers, 'busy_seconds': self.busy,
+                    'mean_latency': self.latency / self.processed if self.processed else 0.0, 'max_latency': self.max_latency}
+
+
+class Pipeline:
+    '''
+    Connects sources and stages with bounded queues (see PipelineStage). Sources are called every interval seconds on their
+    own threads, and every item that they return is put into the first stage.
 
-        del cam_dict[name]
-        print("[INFO - CameraManager] " + name + " has been removed")
-        f = open(filepath + 'saved_cameras.pickle', 'wb')
-        pickle.dump(cam_dict, f)
-        f.close()
+    stop() shuts down in order: the sources stop producing, then every stage finishes its queued items before the next stage
+    is stopped, so that no item that entered the pipeline is lost.
+    '''
 
-        window.destroy()
+    def __init__(self):
+        self.stages = []
+        self.sources = []
+        self.running = False
+
+    def add_stage(self, name, function, **options):
+        '''
+        Adds a stage after the last one, see PipelineStage for the options. Returns the stage
+        '''
+        stage = PipelineStage(name, function, **options)
+        if self.stages:
+            self.stages[-1].next = stage
+        self.stages.append(stage)
+        return stage
+
+    def add_source(self, function, interval=1):
+        '''
+        function : called every interval seconds, returns a list of new items
+        '''
+        self.sources.append([function, interval, None])
+
+    def stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def start(self):
+        self.running = True
+        for stage in self.stages:
+            stage.start()
+        for source in self.sources:
+            source[2] = Thread(target=self.produce, args=(source[0], source[1]), daemon=True)
+            source[2].start()
+
+    def produce(self, function, interval):
+        while self.running:
+            start = time.time()
+            try:
+                items = function() or []
+            except Exception as e:
+                print("[ERROR - Pipeline] Source failed: ", e)
+                items = []
+            for item in items:
+                self.stages[0].put(item)
+            time.sleep(max(0, interval - (time.time() - start)))
+
+    def stop(self, timeout=30):
+        '''
+        Drains and stops the pipeline, waiting at most timeout seconds. Returns False if some items could not be finished
+        '''
+        end = time.time() + timeout
+        self.running = False
+        for source in self.sources:
+            if source[2] is not None:
+                source[2].join(max(0, end - time.time()))
+        stopped = True
+        for stage in self.stages:
+            if not stage.stop(max(0, end - time.time())):
+                print("[ERROR - Pipeline] {} did not finish its queue in time".format(stage.name))
+                stopped = False
+        print("[INFO - Pipeline] Stopped")
+        return stopped
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
 
-        return
-    
 # === SYSTEM CLASSES TO HANDLE MULTIPLE STREAMS AND SOURCES ===
 
 class SystemMotionDetection:
 
-    def start(min_area = 1250):
-        MD_list = []
-        cam_list = CameraManager.list_cameras('../bin/')
+    def start(min_area = 1250, catalog=None, segments=False, ledger=None, live_view=None, config=None, config_interval=5,
+              bin_dir='../bin/', stream_options=None, stop=None):
+        '''
+        Runs motion detection on every saved camera. Cameras that are added to or removed from the config while running are
+        started or stopped without disturbing the others; new streams are opened on a separate thread, since connecting can
+        take seconds.
+        segments : append the frames to segment files (SegmentFrameStore) instead of saving one file per frame
+        live_view : LiveViewServer that serves the frames of the cameras' streams
+        config : CameraConfig of the saved cameras, that of bin_dir if None
+        config_interval : seconds between checks for changes of the saved cameras
+        bin_dir : directory below which the cameras' directories are
+        stream_options : keyword arguments of the cameras' Streams, e.g. {'test_source': True, 'loop': True} to replay video files
+        stop : threading.Event that ends the loop and releases the streams once set, runs forever if None
+        '''
+        config = config if config is not None else CameraConfig.get(bin_dir)
+        stream_options = stream_options if stream_options is not None else {}
+        changes = config.changes()  # Subscribe before listing, so that no change can be missed in between
+        detectors = {}  # name -> MotionDetectorLFR
+        wanted = {}  # name -> src of the cameras that should be running
+        opened = CameraChanges()  # ('opened', name, detector) tuples of streams that have been opened
+
+        def open_camera(name, src):
+            store = SegmentFrameStore(bin_dir + name + '/') if segments else None
+            MD = MotionDetectorLFR(stream=Stream(src, name=name, **stream_options), name=name, min_area=min_area,
+                                   filepath=str(bin_dir + name + '/'), catalog=catalog, store=store, ledger=ledger)
+            opened('opened', name, MD)
+
+        def stop_camera(name):
+            MD = detectors.pop(name, None)
+            if MD is None:
+                return
+            if live_view is not None:
+                live_view.remove_camera(name)
+            MD.Stream.release_stream(timeout=0)  # Not joined, a reader stuck on an unreachable camera would hold up the others
+            print("[INFO - SystemMotionDetection] Stopped " + name)
+
+        for name, src in config.list():
+            wanted[name] = src
+            Thread(target=open_camera, args=(name, src), daemon=True).start()
+
+        last_refresh = time.time()
+        while stop is None or not stop.is_set():
+            if time.time() - last_refresh >= config_interval:
+                config.refresh()
+                last_refresh = time.time()
+
+            for event, name, src in changes.drain():
+                if event == 'removed':
+                    wanted.pop(name, None)
+                    stop_camera(name)
+                else:
+                    wanted[name] = src
+                    os.makedirs(bin_dir + name + '/', exist_ok=True)
+                    Thread(target=open_camera, args=(name, src), daemon=True).start()
+
+            for event, name, MD in opened.drain():
+                if wanted.get(name) != MD.Stream.src or name in detectors:
+                    MD.Stream.release_stream(timeout=0)  # Removed or replaced while its stream was being opened
+                    continue
+                detectors[name] = MD
+                if live_view is not None:
+                    live_view.add_camera(name, MD.Stream)
+                print("[INFO - SystemMotionDetection] Started " + name)
+
+            if not detectors:
+                time.sleep(0.1)
+            for MD in list(detectors.values()):
+                MD.process_single_frame()
 
-        for c in cam_list:
-            MD_list.append(MotionDetectorLFR(stream=Stream(
-                c[1]), name=c[0], min_area=min_area, filepath=str('../bin/' + c[0] + '/')))
+            # Sleep until the next camera is due for a frame, instead of spinning on the other cameras' 1 s gates
+            if detectors:
+                next_due = min(MD.start_time for MD in detectors.values()) + 1
+                time.sleep(min(0.1, max(0, next_due - time.time())))
 
-        while(True):
-            for MD in MD_list:
-                MD.process_single_frame()
+        config.unsubscribe(changes)
+        for name in list(detectors):
+            stop_camera(name)
+        for event, name, MD in opened.drain():
+            MD.Stream.release_stream()
 
 
 class SystemFiltering:
 
-    def start(filter_interval=10):
+    def start(filter_interval=10, catalog=None, segments=False, ledger=None, config=None, config_interval=5, bin_dir='../bin/',
+              detector_util=None, stop=None):
+        '''
+        Filters the images of every saved camera, starting and stopping the filtering of cameras that are added to or
+        removed from the config while running.
+        config : CameraConfig of the saved cameras, that of bin_dir if None
+        bin_dir : directory below which the cameras' directories and the storage directory are
+        detector_util : HumanDetectorUtil used to rank the frames of bursts, one is created if None
+        stop : threading.Event that ends the loop and closes the detectors once set, runs forever if None
+        '''
+        config = config if config is not None else CameraConfig.get(bin_dir)
+        changes = config.changes()
+        SD_list = {}  # name -> SimilarityDetector
+        detector_util = detector_util if detector_util is not None else HumanDetectorUtil()  # Shared by all cameras
+
+        def start_camera(name):
+            os.makedirs(bin_dir + name + '/', exist_ok=True)
+            store = SegmentFrameStore(bin_dir + name + '/') if segments else None
+            SD_list[name] = SimilarityDetector(work_in_dir=str(
+                bin_dir + name + '/'), interval=filter_interval, similarity_thresh=93, storage_dir=bin_dir + 'storage/',
+                detector_util=detector_util, catalog=catalog, store=store, ledger=ledger)
+
+        for name, src in config.list():
+            start_camera(name)
+
+        last_refresh = time.time()
+        while stop is None or not stop.is_set():
+            if time.time() - last_refresh >= config_interval:
+                config.refresh()
+                last_refresh = time.time()
+
+            for event, name, src in changes.drain():
+                if event == 'removed' and name in SD_list:
+                    SD_list.pop(name).close()
+                elif event == 'added' and name not in SD_list:
+                    start_camera(name)
+
+            for SD in list(SD_list.values()):
+                SD.match_and_filter()
+            time.sleep(0.1)  # The filter intervals are minutes long, checking them continuously only takes CPU from capture
+
+        config.unsubscribe(changes)
+        for name in list(SD_list):
+            SD_list.pop(name).close()
+
+class SystemPipeline:
+    '''
+    Runs the whole system as one Pipeline instead of threads that only meet through the file system:
 
-        SD_list = []
-        cam_list = CameraManager.list_cameras('../bin/')
+        capture -> motion -> save -> classify -> filter -> retention
 
-        for c in cam_list:
-            SD_list.append(SimilarityDetector(work_in_dir=str(
-                '../bin/' + c[0] + '/'), interval=filter_interval, similarity_thresh=93))
+    Frames are taken from the cameras' streams once per capture_interval, and are passed along in memory, so that human
+    detection and the similarity filter no longer decode the saved file, and every frame is filtered as it arrives. Every stage has a bounded queue, so when a stage falls behind the stages before
+    it wait, and the motion queue drops its oldest frames, which keeps the latency stable instead of leaving a growing backlog
+    of unfiltered files on disk. Cameras that are added to or removed from the config are started or stopped while running.
+    '''
+
+    def __init__(self, storage_manager, catalog=None, segments=False, ledger=None, live_view=None, config=None, detector_util=None,
+                 detector_factory=None, min_area=1250, filter_interval=10, capture_interval=1, motion_workers=2, save_workers=2, classify_workers=2,
+                 filter_workers=1, queue_size=32, motion_policy='drop_oldest', bin_dir='../bin/', stream_options=None):
+        '''
+        storage_manager : StorageManager that the retention stage runs
+        bin_dir : directory below which the cameras' directories and the storage directory are
+        stream_options : keyword arguments of the cameras' Streams, e.g. {'test_source': True, 'pace': True} to replay video files
+        detector_util : HumanDetectorUtil used to rank the frames of bursts
+        detector_factory : creates the HumanDetectorUtil of every classify worker, defaults to the class of detector_util
+        capture_interval : seconds between frames taken from every camera
+        *_workers : number of threads of the stages
+        queue_size : number of items that can wait for every worker of a stage
+        motion_policy : policy of the motion queue, 'block' to hold up capture instead of dropping frames, e.g. when replaying
+                        video files
+        '''
+        self.storage_manager = storage_manager
+        self.catalog = catalog
+        self.segments = segments
+        self.ledger = ledger
+        self.live_view = live_view
+        self.bin_dir = bin_dir
+        self.stream_options = stream_options if stream_options is not None else {}
+        self.config = config if config is not None else CameraConfig.get(bin_dir)
+        self.detector_util = detector_util if detector_util is not None else HumanDetectorUtil()
+        self.detector_factory = detector_factory if detector_factory is not None else type(self.detector_util)
+        self.detectors_local = threading.local()  # Detector of every classify worker, they are not documented as thread safe
+        self.min_area = min_area
+        self.filter_interval = filter_interval
+        self.changes = self.config.changes()
+        self.opened = CameraChanges()  # ('opened', name, detector) tuples of streams that have been opened
+        self.wanted = {}  # name -> src of the cameras that should be running
+        self.detectors = {}  # name -> MotionDetectorLFR
+        self.filters = {}  # name -> SimilarityDetector
+        self.seen = {}  # name -> frame count of the last frame taken from the stream
+
+        camera = lambda item: item['camera']
+        self.pipeline = Pipeline()
+        self.pipeline.add_source(self.capture, interval=capture_interval)
+        self.pipeline.add_stage('motion', self.motion, workers=motion_workers, queue_size=queue_size, key=camera,
+                                policy=motion_policy)
+        self.pipeline.add_stage('save', self.save, workers=save_workers, queue_size=queue_size, key=camera)
+        self.pipeline.add_stage('classify', self.classify, workers=classify_workers, queue_size=queue_size)
+        self.filter_stage = self.pipeline.add_stage('filter', self.filter, workers=filter_workers, queue_size=queue_size, key=camera,
+                                                    idle=self.filter_idle)
+        self.pipeline.add_stage('retention', self.retain, queue_size=queue_size, idle=lambda worker: self.storage_manager.reduce_files())
+
+    def start(self):
+        for name, src in self.config.list():
+            self.add_camera(name, src)
+        self.pipeline.start()
+
+    def stop(self, timeout=30):
+        self.pipeline.stop(timeout)
+        for name in list(self.detectors):
+            self.detectors.pop(name).Stream.release_stream()
+        for name in list(self.filters):
+            self.filters.pop(name).close()
+
+    def add_camera(self, name, src):
+        self.wanted[name] = src
+        os.makedirs(self.bin_dir + name + '/', exist_ok=True)
+        # The filter and save stages run on different threads, so each gets its own store
+        store = SegmentFrameStore(self.bin_dir + name + '/') if self.segments else None
+        self.filters[name] = SimilarityDetector(work_in_dir=self.bin_dir + name + '/', interval=self.filter_interval, similarity_thresh=93,
+                                                storage_dir=self.bin_dir + 'storage/', detector_util=self.detector_util,
+                                                catalog=self.catalog, store=store, ledger=self.ledger)
+
+        def open_camera():
+            store = SegmentFrameStore(self.bin_dir + name + '/') if self.segments else None
+            MD = MotionDetectorLFR(stream=Stream(src, name=name, **self.stream_options), name=name, min_area=self.min_area,
+                                   filepath=self.bin_dir + name + '/', catalog=self.catalog, store=store, ledger=self.ledger)
+            self.opened('opened', name, MD)
+
+        Thread(target=open_camera, daemon=True).start()
+
+    def remove_camera(self, name):
+        self.wanted.pop(name, None)
+        MD = self.detectors.pop(name, None)
+        if MD is not None:
+            if self.live_view is not None:
+                self.live_view.remove_camera(name)
+            MD.Stream.release_stream(timeout=0)  # Not joined, a reader stuck on an unreachable camera would hold up the others
+        SD = self.filters.pop(name, None)
+        if SD is not None:
+            self.filter_stage.put({'camera': name, 'closing': SD})  # Closed by the worker that owns it, after its queued images
+
+    def capture(self):
+        '''
+        Source of the pipeline: applies the changes of the config, and takes the newest frame of every camera
+        '''
+        self.config.refresh()
+        for event, name, src in self.changes.drain():
+            if event == 'removed':
+                self.remove_camera(name)
+            else:
+                self.add_camera(name, src)
 
-        while(True):
-            for SD in SD_list:
-                SD.match_and_filter()
\ No newline at end of file
+        for event, name, MD in self.opened.drain():
+            if self.wanted.get(name) != MD.Stream.src or name in self.detectors:
+                MD.Stream.release_stream(timeout=0)  # Removed or replaced while its stream was being opened
+                continue
+            self.detectors[name] = MD
+            self.seen[name] = 0
+            if self.live_view is not None:
+                self.live_view.add_camera(name, MD.Stream)
+            print("[INFO - SystemPipeline] Started " + name)
+
+        items = []
+        for name, MD in list(self.detectors.items()):
+            count, frame = MD.Stream.get_new_frame(self.seen[name])
+            MD.refresh_if_due()
+            if frame is None:
+                continue
+            self.seen[name] = count
+            items.append({'camera': name, 'frame': frame, 'time': datetime.datetime.now()})
+        return items
+
+    def motion(self, item):
+        MD = self.detectors.get(item['camera'])
+        if MD is None or not MD.detect(item['frame']):
+            return None
+        return item
+
+    def save(self, item):
+        MD = self.detectors.get(item['camera'])
+        if MD is None:
+            return None
+        item['path'], item['size'], item['key'] = MD.save(item['frame'], item['time'])
+        return item
+
+    def detector(self):
+        if getattr(self.detectors_local, 'detector', None) is None:
+            self.detectors_local.detector = self.detector_factory()
+        return self.detectors_local.detector
+
+    def classify(self, item):
+        item['human'] = bool(self.detector().detect(item['frame']))
+        FRAMES_PROCESSED.labels(item['camera'], 'classify').inc()
+        if self.catalog is not None:
+            self.catalog.set_human(item['path'], item['human'])
+        # The filter stage scores the frame at a reduced width, free the rest before the item waits in the next queues
+        SD = self.filters.get(item['camera'])
+        if SD is None:
+            item['frame'] = None
+        elif item['frame'].shape[1] > SD.scorer.width:
+            item['frame'] = imutils.resize(item['frame'], width=SD.scorer.width)
+        return item
+
+    def filter(self, item):
+        if 'closing' in item:
+            item['closing'].close()
+            return None
+        SD = self.filters.get(item['camera'])
+        if SD is not None and item['frame'] is not None:
+            SD.match_and_filter()  # Catches up with the directory on the first call, then only rescans once its interval passed
+            name = item['key'] if item['key'] is not None else os.path.relpath(item['path'], SD.wid)
+            SD.filter_frame(name, item['frame'])
+            item['frame'] = None
+        return item
+
+    def filter_idle(self, worker):
+        # Closes the bursts of cameras that have stopped moving, each worker only touches the cameras that it owns
+        for name, SD in list(self.filters.items()):
+            if self.filter_stage.worker_of(name) == worker:
+                SD.match_and_filter()
+
+    def retain(self, item):
+        path = os.path.normpath(item['path'])
+        if os.path.exists(path):  # Not moved or discarded by the filter stage
+            self.storage_manager.retention.label(path, item['human'])
+        self.storage_manager.reduce_files()
+        return None
+
+    def stats(self):
+        return self.pipeline.stats()
@@ -0,0 +1,78 @@
+'''
+-----------------------------------------------
+title: migrate_layout.py
+description: Moves the images of the old flat layout (<camera>/<camera> - <time>.jpg) into the date sharded layout
+             (<camera>/YYYY/MM/DD/HH/<camera> - YYYYMMDD-HHMMSS-ffffff.jpg). Images in the storage directory are moved to
+             storage/<camera>/YYYY/MM/DD/HH/. Stop the system before migrating.
+             e.g. python3 migrate_layout.py --dry-run
+                  python3 migrate_layout.py
+-----------------------------------------------
+'''
+
+import argparse
+import datetime
+import os
+
+from catalog_tool import catalog_directories
+from components_reduced import ImageCatalog, ShardedLayout
+
+
+def migrate_directory(directory, per_camera, catalog=None, dry_run=False):
+    '''
+    Moves the flat images in directory into shards. Returns the number of images moved
+    per_camera : shard below <directory>/<camera>/, as the storage directory does
+    '''
+    names = sorted(entry.name for entry in os.scandir(directory) if entry.name.endswith('.jpg') and entry.is_file())
+    created = set()
+    moved = 0
+
+    for name in names:
+        path = os.path.join(directory, name)
+        camera, captured = ShardedLayout.parse_name(name)
+        if captured is None:  # Not named by the motion detector, fall back to when it was written
+            captured = os.path.getmtime(path)
+        when = datetime.datetime.fromtimestamp(captured)
+
+        root = os.path.join(directory, camera) if per_camera else directory
+        new_path = os.path.join(root, ShardedLayout.relative_path(camera, when))
+        # The old names have a resolution of one second, so frames of the same second are told apart by their microsecond
+        while os.path.exists(new_path):
+            when = when + datetime.timedelta(microseconds=1)
+            new_path = os.path.join(root, ShardedLayout.relative_path(camera, when))
+
+        if dry_run:
+            print(path + " -> " + new_path)
+        else:
+            shard_dir = os.path.dirname(new_path)
+            if shard_dir not in created:
+                os.makedirs(shard_dir, exist_ok=True)
+                created.add(shard_dir)
+            os.rename(path, new_path)
+            if catalog is not None:
+                catalog.move(path, new_path)
+        moved = moved + 1
+
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move flat image directories into the date sharded layout')
+    parser.add_argument('--bin', default='../bin/', help='directory in which the system stores its data')
+    parser.add_argument('--db', default=None, help='catalog database, defaults to <bin>/catalog.db')
+    parser.add_argument('--dry-run', action='store_true', help='print the moves without making them')
+    args = parser.parse_args()
+
+    db_file = args.db if args.db is not None else args.bin + 'catalog.db'
+    catalog = ImageCatalog(db_file) if os.path.isfile(db_file) and not args.dry_run else None
+
+    total = 0
+    for directory, state in catalog_directories(args.bin):
+        if not os.path.isdir(directory):
+            continue
+        moved = migrate_directory(directory, per_camera=(state == 'redundant'), catalog=catalog, dry_run=args.dry_run)
+        print("[INFO - migrate_layout] {} images in {}".format(moved, directory))
+        total = total + moved
+
+    if catalog is not None:
+        catalog.close()
+    print("[INFO - migrate_layout] {} images {}".format(total, 'would be moved' if args.dry_run else 'moved'))
@@ -0,0 +1,1601 @@
+'''
+-----------------------------------------------
+title: storage.py
+description: Classes that lay out, catalogue, watch and read the stored images, and the camera configuration. Used by both
+             components_reduced.py and the GUI's components.py, so that the two read the same files in the same way
+-----------------------------------------------
+'''
+
+import cv2
+from PIL import Image
+import pickle
+import sys
+import os
+import time
+import datetime
+import numpy as np
+import imutils
+from threading import Lock
+import shutil
+import ctypes
+import ctypes.util
+import select
+import struct
+import sqlite3
+import io
+import mmap
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+
+# === SHARDED LAYOUT ===
+
+class ShardedLayout:
+    '''
+    Images are stored in date sharded directories, <camera root>/YYYY/MM/DD/HH/<camera> - YYYYMMDD-HHMMSS-ffffff.jpg, instead of one
+    flat directory per camera, since listing, globbing and renaming all slow down once a directory holds 100k+ files on ext4 or FAT.
+    The storage directory uses the same layout per camera, <storage>/<camera>/YYYY/MM/DD/HH/.
+
+    File names sort in capture order and contain the microsecond at which the frame was captured, so that two frames never
+    collide. Scanners only walk the shards that can contain images they have not seen, and a whole day is expired by removing
+    a single directory.
+
+    Images are referred to by their path relative to the camera root ('2020/11/09/14/Cam - 20201109-141507-000000.jpg'), and
+    images of the old flat layout by their name only, so that both layouts can be read while directories are being migrated.
+    '''
+
+    NAME_FORMAT = "%Y%m%d-%H%M%S-%f"
+    LEGACY_NAME_FORMAT = "%A %d %B %Y %I:%M:%S%p"
+
+    def file_name(camera, when):
+        return camera + " - " + when.strftime(ShardedLayout.NAME_FORMAT) + '.jpg'
+
+    def shard(when):
+        return os.path.join(when.strftime('%Y'), when.strftime('%m'), when.strftime('%d'), when.strftime('%H'))
+
+    def relative_path(camera, when):
+        '''
+        Returns the path of an image captured at when, relative to the camera root
+        '''
+        return os.path.join(ShardedLayout.shard(when), ShardedLayout.file_name(camera, when))
+
+    def parse_name(name):
+        '''
+        Returns the (camera, capture time) of an image from its file name, in either layout. The capture time is a UNIX
+        timestamp, or None if it can not be parsed
+        '''
+        name = os.path.basename(name)
+        if name.endswith('.jpg'):
+            name = name[:-4]
+        camera, _, stamp = name.partition(' - ')
+
+        for name_format in (ShardedLayout.NAME_FORMAT, ShardedLayout.LEGACY_NAME_FORMAT):
+            try:
+                return camera, datetime.datetime.strptime(stamp, name_format).timestamp()
+            except ValueError:
+                pass
+        return camera, None
+
+    def camera_of(name):
+        return ShardedLayout.parse_name(name)[0]
+
+    # (number of digits, lowest, highest) of the year, month, day and hour shards
+    SHARD_SHAPES = [(4, 0, 9999), (2, 1, 12), (2, 1, 31), (2, 0, 23)]
+
+    def is_shard(name, depth=0):
+        '''
+        Returns whether name has the exact shape of a shard at the given depth below a camera root: 0 for years, 1 for months,
+        2 for days and 3 for hours. Camera directories with names made of digits, e.g. storage/1/, are therefore not taken for shards
+        '''
+        if depth >= len(ShardedLayout.SHARD_SHAPES) or not name.isdigit():
+            return False
+        digits, lowest, highest = ShardedLayout.SHARD_SHAPES[depth]
+        return len(name) == digits and lowest <= int(name) <= highest
+
+    def shard_depth(relative):
+        '''
+        Returns the number of shard levels that the directory relative ends in, e.g. 2 for 'Cam/2020/11', 0 for 'Cam' or ''.
+        Shards of the directory's children are one level deeper
+        '''
+        parts = [part for part in relative.split(os.sep) if part]
+        for depth in range(min(len(parts), len(ShardedLayout.SHARD_SHAPES)), 0, -1):
+            if all(ShardedLayout.is_shard(part, i) for i, part in enumerate(parts[-depth:])):
+                return depth
+        return 0
+
+    def is_year(directory, name):
+        '''
+        Returns whether the subdirectory name of a camera root, or of a directory holding camera roots, is a year shard.
+        A camera can be named like a year (storage/2024/), in which case its directory holds year shards or its own images,
+        while a year shard only holds month shards
+        '''
+        if not ShardedLayout.is_shard(name, 0):
+            return False
+        try:
+            with os.scandir(os.path.join(directory, name)) as it:
+                for entry in it:
+                    if entry.name.startswith(name + ' - ') or (ShardedLayout.is_shard(entry.name, 0) and entry.is_dir()):
+                        return False
+        except FileNotFoundError:
+            pass
+        return True
+
+    def roots(directory):
+        '''
+        Returns directory and its per camera sub directories (<storage>/<camera>/), which each hold their own shards
+        '''
+        roots = [directory]
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir() and not ShardedLayout.is_year(directory, entry.name):
+                    roots.append(os.path.join(directory, entry.name))
+        return roots
+
+    def walk(root, since=None, suffix='.jpg'):
+        '''
+        Yields the paths, relative to root, of all images under root, shard by shard from the oldest to the newest.
+        Images of the old flat layout in root itself are yielded first.
+        since : UNIX timestamp, shards that only hold images captured before this hour are skipped without being listed
+        '''
+        since_parts = None
+        if since is not None:
+            since_parts = datetime.datetime.fromtimestamp(since).strftime('%Y %m %d %H').split()
+
+        def walk_level(parts):
+            try:
+                with os.scandir(os.path.join(root, *parts)) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except FileNotFoundError:
+                return
+
+            for entry in entries:
+                if entry.name.endswith(suffix) and entry.is_file():
+                    yield os.path.join(*(parts + [entry.name]))
+
+            if len(parts) == 4:  # Hour shards do not contain further shards
+                return
+
+            for entry in entries:
+                if not ShardedLayout.is_shard(entry.name, len(parts)) or not entry.is_dir():
+                    continue
+                if not parts and not ShardedLayout.is_year(root, entry.name):
+                    continue
+                shard = parts + [entry.name]
+                # Shard names are zero padded, so comparing them as strings compares them in time
+                if since_parts is not None and shard < since_parts[:len(shard)]:
+                    continue
+                for path in walk_level(shard):
+                    yield path
+
+        return walk_level([])
+
+    def days(root):
+        '''
+        Returns the (YYYY, MM, DD) tuples of all day shards under root, oldest first
+        '''
+        days = []
+        for year in sorted(d for d in os.listdir(root) if ShardedLayout.is_year(root, d)):
+            for month in sorted(d for d in os.listdir(os.path.join(root, year)) if ShardedLayout.is_shard(d, 1)):
+                for day in sorted(d for d in os.listdir(os.path.join(root, year, month)) if ShardedLayout.is_shard(d, 2)):
+                    days.append((year, month, day))
+        return days
+
+    def hours(root):
+        '''
+        Returns the (YYYY, MM, DD, HH) tuples of all hour shards under root, oldest first
+        '''
+        hours = []
+        for day in ShardedLayout.days(root):
+            day_dir = os.path.join(root, *day)
+            for hour in sorted(d for d in os.listdir(day_dir) if ShardedLayout.is_shard(d, 3)):
+                hours.append(day + (hour,))
+        return hours
+
+    def shard_time(shard):
+        '''
+        Returns the UNIX timestamp at which a (YYYY, MM, DD[, HH]) shard starts
+        '''
+        return datetime.datetime(*[int(part) for part in shard]).timestamp()
+
+    def remove_day(root, day):
+        '''
+        Removes the shard of a whole day with a single directory removal. Returns the number of bytes that were freed
+        '''
+        day_dir = os.path.join(root, *day)
+        freed = 0
+        for directory, _, files in os.walk(day_dir):
+            for name in files:
+                try:
+                    freed = freed + os.path.getsize(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        shutil.rmtree(day_dir, ignore_errors=True)
+        return freed
+
+# === IMAGE CATALOG ===
+
+class ImageCatalog:
+    '''
+    SQLite catalog of every stored image, so that components can find images with an indexed query instead of listing directories
+    and sorting by modification time. The motion detector adds images when they are saved, and the filters and the storage manager
+    update the catalog as they move, label and delete images. rebuild() brings the catalog in line with what is on disk.
+
+    Every image has a retention state:
+     - 'kept' : the image is in its camera's directory
+     - 'redundant' : the SimilarityDetector moved the image to the storage directory
+     - 'timelapse' : the TimelapseCompactor encoded the image into a timelapse video, the path is '<video>/<frame number>'
+    Deleted images are removed from the catalog.
+
+    The connection is shared by all threads, and is protected by a lock. The database is in WAL mode, so that other processes
+    (the GUI, catalog_tool.py) can read it while the system writes to it.
+    '''
+
+    def normalise(path):
+        # The same image can be reached through '../bin/cam/x.jpg' and '../bin/cam//x.jpg'
+        return os.path.normpath(path)
+
+    def __init__(self, db_file='../bin/catalog.db'):
+        self.db_file = db_file
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute('''CREATE TABLE IF NOT EXISTS images (
+                                   path TEXT PRIMARY KEY,
+                                   camera TEXT NOT NULL,
+                                   captured REAL NOT NULL,
+                                   size INTEGER NOT NULL,
+                                   human INTEGER,
+                                   cluster INTEGER,
+                                   state TEXT NOT NULL DEFAULT 'kept')''')
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS images_camera_captured ON images (camera, captured)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS images_camera_human_captured ON images (camera, human, captured)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS images_captured ON images (captured)")
+
+    def add(self, path, camera, captured, size, human=None, state='kept'):
+        path = ImageCatalog.normalise(path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO images (path, camera, captured, size, human, state) VALUES (?, ?, ?, ?, ?, ?)",
+                            (path, camera, captured, size, human, state))
+
+    def add_many(self, rows):
+        '''
+        Adds (path, camera, captured, size, human, state) rows in a single transaction
+        '''
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO images (path, camera, captured, size, human, state) VALUES (?, ?, ?, ?, ?, ?)",
+                                [(ImageCatalog.normalise(row[0]),) + tuple(row[1:]) for row in rows])
+
+    def add_file(self, path, state='kept'):
+        '''
+        Adds an image that is already on disk, taking the camera and capture time from its name
+        '''
+        stat = os.stat(path)
+        camera, captured = ShardedLayout.parse_name(path)
+        if captured is None:
+            captured = stat.st_mtime
+        self.add(path, camera, captured, stat.st_size, state=state)
+
+    def move(self, path, new_path, state=None):
+        path = ImageCatalog.normalise(path)
+        new_path = ImageCatalog.normalise(new_path)
+        with self.lock, self.db:
+            if state is None:
+                self.db.execute(
+                    "UPDATE images SET path = ? WHERE path = ?", (new_path, path))
+            else:
+                self.db.execute(
+                    "UPDATE images SET path = ?, state = ? WHERE path = ?", (new_path, state, path))
+
+    def remove(self, paths):
+        with self.lock, self.db:
+            self.db.executemany(
+                "DELETE FROM images WHERE path = ?", [(ImageCatalog.normalise(path),) for path in paths])
+
+    def remove_directory(self, directory):
+        '''
+        Removes all images below a directory, e.g. after a whole day shard was removed
+        '''
+        prefix = ImageCatalog.normalise(directory)
+        # Paths below the directory sort between 'dir/' and 'dir0', so the primary key index finds them without a scan
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM images WHERE path >= ? AND path < ?",
+                            (prefix + '/', prefix + '0'))
+
+    def human_count(self, directory):
+        '''
+        Returns the number of images below a directory (or segment) in which a human was detected
+        '''
+        prefix = ImageCatalog.normalise(directory)
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM images WHERE path >= ? AND path < ? AND human = 1",
+                                   (prefix + '/', prefix + '0')).fetchone()[0]
+
+    def set_human(self, path, human):
+        path = ImageCatalog.normalise(path)
+        with self.lock, self.db:
+            self.db.execute("UPDATE images SET human = ? WHERE path = ?",
+                            (1 if human else 0, path))
+
+    def set_size(self, path, size):
+        with self.lock, self.db:
+            self.db.execute("UPDATE images SET size = ? WHERE path = ?",
+                            (size, ImageCatalog.normalise(path)))
+
+    def set_cluster(self, paths, representative):
+        '''
+        Marks the given images as members of the cluster of the representative image. The cluster id is the row id of the
+        representative, which does not change when the image is moved
+        '''
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT rowid FROM images WHERE path = ?", (ImageCatalog.normalise(representative),)).fetchone()
+            if row is None:
+                return
+            self.db.executemany("UPDATE images SET cluster = ? WHERE path = ?",
+                                [(row[0], ImageCatalog.normalise(path)) for path in paths])
+
+    def get(self, path):
+        path = ImageCatalog.normalise(path)
+        with self.lock:
+            return self.db.execute("SELECT path, camera, captured, size, human, cluster, state FROM images WHERE path = ?",
+                                   (path,)).fetchone()
+
+    def human_labels(self, directory=None):
+        '''
+        Returns a dictionary of path to human label, for all images that have been labelled
+        directory : only return the labels of images below this directory, e.g. a single shard. The paths are compared as a
+                    range, which uses the primary key instead of reading every labelled row
+        '''
+        with self.lock:
+            if directory is None:
+                rows = self.db.execute(
+                    "SELECT path, human FROM images WHERE human IS NOT NULL").fetchall()
+            else:
+                # Every path below the directory starts with it and a separator, the next character after the separator ends the range
+                prefix = ImageCatalog.normalise(directory) + os.sep
+                rows = self.db.execute(
+                    "SELECT path, human FROM images WHERE path >= ? AND path < ? AND human IS NOT NULL",
+                    (prefix, prefix[:-1] + chr(ord(os.sep) + 1))).fetchall()
+        return {path: bool(human) for path, human in rows}
+
+    def oldest(self, camera=None, limit=500, human=None, state=None):
+        '''
+        Returns the (path, camera, captured, size, human, cluster, state) rows of the oldest images, filtered by camera,
+        human label and retention state if given
+        '''
+        conditions = []
+        args = []
+        if camera is not None:
+            conditions.append("camera = ?")
+            args.append(camera)
+        if human is not None:
+            conditions.append("human = ?" if human else "(human = 0 OR human IS NULL)")
+            if human:
+                args.append(1)
+        if state is not None:
+            conditions.append("state = ?")
+            args.append(state)
+
+        query = "SELECT path, camera, captured, size, human, cluster, state FROM images"
+        if conditions:
+            query = query + " WHERE " + " AND ".join(conditions)
+        query = query + " ORDER BY captured LIMIT ?"
+        args.append(limit)
+
+        with self.lock:
+            return self.db.execute(query, args).fetchall()
+
+    def events(self, camera=None, start=None, end=None, human=None, limit=100, after=None):
+        '''
+        Returns the images captured in a time range, oldest first, one page at a time.
+        camera : only images of this camera
+        start, end : the range of capture times, as UNIX timestamps. start is inclusive and end is exclusive
+        human : only images with (True) or without (False) a detected human
+        limit : number of images per page
+        after : the cursor returned with the previous page, to continue where that page stopped
+
+        Returns (rows, cursor), where rows are (path, camera, captured, size, human, cluster, state) tuples, and cursor is
+        None once there are no more images. Pages are found through the (camera, captured) index and do not use OFFSET,
+        so that every page takes the same time, no matter how deep into the archive it is
+        '''
+        conditions = []
+        args = []
+        if camera is not None:
+            conditions.append("camera = ?")
+            args.append(camera)
+        if start is not None:
+            conditions.append("captured >= ?")
+            args.append(start)
+        if end is not None:
+            conditions.append("captured < ?")
+            args.append(end)
+        if human is not None:
+            conditions.append("human = 1" if human else "(human = 0 OR human IS NULL)")
+        if after is not None:
+            # The row id breaks ties between images captured in the same second
+            conditions.append("(captured > ? OR (captured = ? AND rowid > ?))")
+            args.extend([after[0], after[0], after[1]])
+
+        query = "SELECT path, camera, captured, size, human, cluster, state, rowid FROM images"
+        if conditions:
+            query = query + " WHERE " + " AND ".join(conditions)
+        query = query + " ORDER BY captured, rowid LIMIT ?"
+        args.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+
+        cursor = None
+        if len(rows) == limit:
+            cursor = (rows[-1][2], rows[-1][7])
+        return [row[:7] for row in rows], cursor
+
+    def usage(self):
+        '''
+        Returns a dictionary of camera to the number of bytes its images use
+        '''
+        with self.lock:
+            return dict(self.db.execute("SELECT camera, SUM(size) FROM images GROUP BY camera").fetchall())
+
+    def rebuild(self, directories, dry_run=False):
+        '''
+        Scans the given (path, state) directories and their shards, adds images that are missing from the catalog, removes rows of images that
+        are no longer on disk and corrects sizes and states. Human labels and clusters of existing rows are kept.
+        Returns a dictionary with the number of images added, removed and updated
+        '''
+        on_disk = {}  # path -> (size, capture time, state)
+        for directory, state in directories:
+            if not os.path.isdir(directory):
+                continue
+            for root in ShardedLayout.roots(directory):
+                for store in (FileFrameStore(root), SegmentFrameStore(root), TimelapseFrameStore(root)):
+                    store_state = 'timelapse' if isinstance(store, TimelapseFrameStore) else state
+                    for key in store.keys():
+                        try:
+                            on_disk[ImageCatalog.normalise(store.path(key))] = (store.size(key), store.timestamp(key), store_state)
+                        except FileNotFoundError:
+                            pass
+
+        with self.lock:
+            rows = {row[0]: row for row in self.db.execute(
+                "SELECT path, size, state FROM images").fetchall()}
+
+        added = [path for path in on_disk if path not in rows]
+        removed = [path for path in rows if path not in on_disk]
+        updated = [path for path in on_disk if path in rows and
+                   (rows[path][1] != on_disk[path][0] or rows[path][2] != on_disk[path][2])]
+
+        if not dry_run:
+            new_rows = []
+            for path in added:
+                size, timestamp, state = on_disk[path]
+                camera, captured = ShardedLayout.parse_name(path)
+                if SegmentFrameStore.SUFFIX in path or TimelapseFrameStore.SUFFIX in path:
+                    camera = ShardedLayout.camera_of(os.path.dirname(path))
+                new_rows.append((path, camera, captured if captured is not None else timestamp, size, state))
+
+            with self.lock, self.db:
+                self.db.executemany("INSERT INTO images (path, camera, captured, size, state) VALUES (?, ?, ?, ?, ?)", new_rows)
+                self.db.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in removed])
+                self.db.executemany("UPDATE images SET size = ?, state = ? WHERE path = ?",
+                                    [(on_disk[path][0], on_disk[path][2], path) for path in updated])
+
+        return {'added': len(added), 'removed': len(removed), 'updated': len(updated)}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# === DIRECTORY WATCHER ===
+
+class DirectoryWatcher:
+    '''
+    Reports images that were added to or removed from a directory, so that the filtering and storage stages do not have to list
+    the directory to find out whether there is any work. On Linux the kernel's inotify interface is used (through ctypes, so no
+    extra packages are needed), which costs nothing while the directory is idle. Elsewhere, or if inotify is not available, the
+    directory is polled: its modification time is checked every poll_interval seconds, and it is only scanned when that changed.
+
+    With recursive set, the shards of the ShardedLayout below the directory are watched as well. Images are only written to the
+    newest shard, so when the watcher starts only the newest shard (and any non-shard subdirectory, such as the cameras in the
+    storage directory) is watched, along with every directory that is created afterwards. Shards that had no events for
+    idle_timeout seconds stop being watched, so the number of watches stays small no matter how large the archive grows.
+
+    poll() returns a list of (event, name) tuples, where name is the path of the image relative to the watched directory and
+    event is one of
+     - 'new' : an image was written and closed, or moved into the directory
+     - 'removed' : an image was deleted, or moved out of the directory
+     - 'rescan' : events were lost (the kernel queue overflowed), the consumer should scan the directory itself. name is None
+    '''
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path, suffix='.jpg', poll_interval=5, recursive=False, idle_timeout=24*60*60):
+        '''
+        path : directory to watch
+        suffix : only files with this suffix are reported
+        poll_interval : time between scans when inotify is not available, in seconds
+        recursive : also watch the shards below the directory
+        idle_timeout : time after which a shard without events is no longer watched, in seconds
+        '''
+        self.path = path
+        self.suffix = suffix
+        self.poll_interval = poll_interval
+        self.recursive = recursive
+        self.idle_timeout = idle_timeout
+        self.fd = None
+        self.libc = None
+
+        self.watches = {}  # watch descriptor -> relative path of the watched directory
+        self.roots = set()  # Relative paths of watched directories that are not shards, e.g. cameras named like a year
+        self.last_event = {}  # watch descriptor -> time of the last event
+        self.last_prune_time = time.time()
+
+        # State of the polling fallback
+        self.last_poll_time = 0
+        self.dir_mtimes = {}  # relative directory -> modification time
+        self.names = None  # relative directory -> set of image names
+
+        if sys.platform.startswith('linux'):
+            try:
+                self.start_inotify()
+            except (OSError, AttributeError) as e:
+                print("[ERROR - DirectoryWatcher] inotify is not available, polling " + path + " instead: ", e)
+                self.fd = None
+
+        if self.fd is None:
+            self.read_polling()  # Take the initial snapshot of the directory
+
+    def start_inotify(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.fd = fd
+
+        try:
+            self.add_watch('')
+        except OSError:
+            os.close(fd)
+            self.fd = None
+            raise
+
+        if self.recursive:
+            self.watch_live_shards('')
+
+    def add_watch(self, relative):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        if self.recursive:
+            mask = mask | self.IN_CREATE
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.path, relative)), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.watches[wd] = relative
+        self.last_event[wd] = time.time()
+        return wd
+
+    def watch_live_shards(self, relative):
+        '''
+        Watches the subdirectories of relative in which images can still be written: every non-shard directory, and the newest shard
+        '''
+        try:
+            with os.scandir(os.path.join(self.path, relative)) as it:
+                subdirs = sorted(entry.name for entry in it if entry.is_dir())
+        except FileNotFoundError:
+            return
+
+        depth = 0 if relative == '' or relative in self.roots else ShardedLayout.shard_depth(relative)
+        if depth == 0:
+            shards = [name for name in subdirs if ShardedLayout.is_year(os.path.join(self.path, relative), name)]
+        else:
+            shards = [name for name in subdirs if ShardedLayout.is_shard(name, depth)]
+        live = [name for name in subdirs if name not in shards]
+        self.roots.update(os.path.join(relative, name) for name in live)
+        if shards:
+            live.append(shards[-1])
+
+        for name in live:
+            try:
+                self.add_watch(os.path.join(relative, name))
+            except OSError as e:
+                print("[ERROR - DirectoryWatcher] Could not watch " + os.path.join(self.path, relative, name) + ": ", e)
+                continue
+            self.watch_live_shards(os.path.join(relative, name))
+
+    def watch_new_directory(self, relative):
+        '''
+        Watches a directory that was created or moved in, and reports the images that were written to it before the watch was added
+        '''
+        events = []
+        try:
+            self.add_watch(relative)
+        except OSError:
+            return events
+
+        with os.scandir(os.path.join(self.path, relative)) as it:
+            for entry in it:
+                if entry.is_dir():
+                    events.extend(self.watch_new_directory(os.path.join(relative, entry.name)))
+                elif entry.name.endswith(self.suffix):
+                    events.append(('new', os.path.join(relative, entry.name)))
+        return events
+
+    def prune(self):
+        '''
+        Stops watching shards that had no events for idle_timeout seconds, and that have no watched subdirectories
+        '''
+        self.last_prune_time = time.time()
+        watched = set(self.watches.values())
+
+        for wd, relative in list(self.watches.items()):
+            if relative in self.roots or ShardedLayout.shard_depth(relative) == 0:
+                continue
+            if time.time() - self.last_event[wd] < self.idle_timeout:
+                continue
+            if any(other.startswith(relative + os.sep) for other in watched):
+                continue
+            self.libc.inotify_rm_watch(self.fd, wd)
+            del self.watches[wd]
+            del self.last_event[wd]
+            watched.discard(relative)
+
+    def poll(self, timeout=0):
+        '''
+        Returns the events since the previous call. Waits up to timeout seconds for events if there are none
+        '''
+        if self.fd is not None:
+            return self.read_inotify(timeout)
+        return self.read_polling()
+
+    def read_inotify(self, timeout):
+        events = []
+
+        if self.recursive and time.time() - self.last_prune_time > 60:
+            self.prune()
+
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return events
+            timeout = 0  # Only wait for the first batch
+
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, length = struct.unpack_from('iIII', buf, i)
+                name = buf[i + 16:i + 16 + length].split(b'\0', 1)[0].decode(errors='replace')
+                i = i + 16 + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    events.append(('rescan', None))
+                    continue
+                if mask & self.IN_IGNORED:  # The watch was removed, or the directory was deleted
+                    self.watches.pop(wd, None)
+                    self.last_event.pop(wd, None)
+                    continue
+                if wd not in self.watches:
+                    continue
+
+                self.last_event[wd] = time.time()
+                relative = os.path.join(self.watches[wd], name)
+
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO) and self.recursive:
+                        events.extend(self.watch_new_directory(relative))
+                elif not name.endswith(self.suffix):
+                    continue
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    events.append(('new', relative))
+                elif mask & (self.IN_MOVED_FROM | self.IN_DELETE):
+                    events.append(('removed', relative))
+
+    def read_polling(self):
+        if time.time() - self.last_poll_time < self.poll_interval:
+            return []
+        self.last_poll_time = time.time()
+
+        # Only directories of which the modification time changed are listed again
+        directories = ['']
+        names = {}
+        events = []
+        while directories:
+            relative = directories.pop()
+            directory = os.path.join(self.path, relative)
+            try:
+                dir_mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            if self.names is not None and self.dir_mtimes.get(relative) == dir_mtime:
+                names[relative] = self.names[relative]
+                if self.recursive:
+                    directories.extend(d for d in self.names if os.path.dirname(d) == relative and d != relative)
+                continue
+            self.dir_mtimes[relative] = dir_mtime
+
+            current = set()
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.endswith(self.suffix):
+                        current.add(entry.name)
+                    elif self.recursive and entry.is_dir():
+                        directories.append(os.path.join(relative, entry.name))
+            names[relative] = current
+
+            if self.names is not None:
+                previous = self.names.get(relative, set())
+                events.extend(('new', os.path.join(relative, name)) for name in current - previous)
+                events.extend(('removed', os.path.join(relative, name)) for name in previous - current)
+
+        if self.names is not None:
+            # Directories that were removed altogether
+            for relative in self.names:
+                if relative not in names:
+                    events.extend(('removed', os.path.join(relative, name)) for name in self.names[relative])
+                    self.dir_mtimes.pop(relative, None)
+
+        self.names = names  # The files that existed when the watcher was started are not reported
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# === IMAGE LOADER ===
+
+class DecodedImageCache:
+    '''
+    Process wide LRU cache of decoded, downscaled images, bounded by the number of bytes of the decoded pixels. A saved frame is
+    decoded by the SimilarityDetector, again by the human detector when its burst is ranked, and again by the StorageManager
+    when it reaches the front of the retention queue. These stages run shortly after each other on recently written files,
+    so they can share one decode.
+
+    Keys contain the modification time and size of the file, so that an image that is replaced (e.g. by the recompressor) is
+    decoded again. Cached images are read-only, since every consumer receives the same array.
+    '''
+
+    def __init__(self, max_bytes=64*2**20):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> image, least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            image = self.entries.get(key)
+            if image is None:
+                self.misses = self.misses + 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return image
+
+    def put(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+        image.flags.writeable = False
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes = self.bytes - previous.nbytes
+            self.entries[key] = image
+            self.bytes = self.bytes + image.nbytes
+
+            while self.bytes > self.max_bytes:
+                key, evicted = self.entries.popitem(last=False)
+                self.bytes = self.bytes - evicted.nbytes
+                self.evictions = self.evictions + 1
+
+    def resize(self, max_bytes):
+        '''
+        Changes the byte budget, evicting the least recently used images if the cache no longer fits
+        '''
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.bytes > self.max_bytes:
+                key, evicted = self.entries.popitem(last=False)
+                self.bytes = self.bytes - evicted.nbytes
+                self.evictions = self.evictions + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+
+class ImageLoader:
+    '''
+    Shared image loading layer for the background scanners. Saved frames are full resolution, while every consumer immediately
+    shrinks them to about 700 pixels wide, so most of the time spent in cv2.imread goes to pixels that are thrown away.
+    libjpeg can decode a JPEG at 1/2, 1/4 or 1/8 of its size directly from the DCT coefficients, which is much cheaper than a full decode.
+
+    The loader chooses the largest reduction that still yields an image at least as wide as the consumer needs, and then resizes
+    the rest of the way. The full resolution size is read from the JPEG header once per directory, since all frames of a camera
+    have the same size.
+    '''
+
+    COLOR_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                   4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    GRAYSCALE_FLAGS = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                       4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+    widths = {}  # Full resolution width of the images in each directory
+    cache = DecodedImageCache()  # Shared by every consumer in the process, see configure_cache()
+
+    def configure_cache(max_bytes):
+        '''
+        Sets the byte budget of the shared cache of decoded images. A budget of 0 disables the cache
+        '''
+        ImageLoader.cache.resize(max_bytes)
+
+    def image_width(path):
+        '''
+        Reads only the header of the image to find its width. Returns None if the file can not be read
+        '''
+        try:
+            with Image.open(path) as img:
+                return img.size[0]
+        except (OSError, ValueError):
+            return None
+
+    def choose_scale(full_width, width):
+        '''
+        Returns the largest reduction factor for which the decoded image is still at least width pixels wide
+        '''
+        for scale in (8, 4, 2):
+            if full_width // scale >= width:
+                return scale
+        return 1
+
+    def load(path, width=None, grayscale=False, cached=True):
+        '''
+        path : path to the image
+        width : width that the consumer needs, the image is decoded at the smallest size that is at least this wide
+                and then resized down to it. The image is decoded at full resolution if no width is given
+        grayscale : decode the image as a single channel greyscale image
+        cached : look the image up in the shared cache, and add it once decoded. Jobs that read every image once (e.g. the
+                 recompressor) pass False, so that they do not push out the images of the other stages
+
+        Returns None if the image could not be read, like cv2.imread. Images from the cache are read-only
+        '''
+        if not cached or ImageLoader.cache.max_bytes <= 0:
+            return ImageLoader.read(path, width, grayscale)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        key = (os.path.normpath(path), stat.st_mtime_ns, stat.st_size, width, grayscale)
+        image = ImageLoader.cache.get(key)
+        if image is None:
+            image = ImageLoader.read(path, width, grayscale)
+            if image is not None:
+                ImageLoader.cache.put(key, image)
+        return image
+
+    def read(path, width=None, grayscale=False):
+        '''
+        Decodes an image without going through the cache, see load()
+        '''
+        flags = ImageLoader.GRAYSCALE_FLAGS if grayscale else ImageLoader.COLOR_FLAGS
+
+        if width is None:
+            return cv2.imread(path, flags[1])
+
+        directory = os.path.dirname(path)
+        full_width = ImageLoader.widths.get(directory)
+        if full_width is None:
+            full_width = ImageLoader.image_width(path)
+            if full_width is None:
+                return None
+            ImageLoader.widths[directory] = full_width
+
+        scale = ImageLoader.choose_scale(full_width, width)
+        image = cv2.imread(path, flags[scale])
+        if image is None:
+            return None
+
+        if scale > 1 and image.shape[1] < width:
+            # The images in this directory changed size, decode again using the size from the header
+            ImageLoader.widths.pop(directory, None)
+            return ImageLoader.read(path, width, grayscale)
+
+        if image.shape[1] > width:
+            image = imutils.resize(image, width=width)
+
+        return image
+
+    def decode(data, width=None, grayscale=False):
+        '''
+        Like load(), for an image that is already in memory (e.g. read from a segment)
+        '''
+        flags = ImageLoader.GRAYSCALE_FLAGS if grayscale else ImageLoader.COLOR_FLAGS
+        buffer = np.frombuffer(data, np.uint8)
+
+        if width is None:
+            return cv2.imdecode(buffer, flags[1])
+
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                full_width = img.size[0]
+        except (OSError, ValueError):
+            return None
+
+        image = cv2.imdecode(buffer, flags[ImageLoader.choose_scale(full_width, width)])
+        if image is not None and image.shape[1] > width:
+            image = imutils.resize(image, width=width)
+        return image
+
+# === FRAME STORE ===
+
+class FrameStore(ABC):
+    '''
+    Common interface of the storage backends of a camera's frames, so that the motion detector, the filters and the storage manager
+    do not need to know how frames are kept on disk.
+
+    Frames are referred to by a key that is unique within the store, and that sorts in capture order within a shard or segment.
+    path(key) turns a key into the path under which the frame is known to the ImageCatalog.
+
+    Stores that frames are written to also provide:
+     - append(camera, when, frame) : encodes and stores a frame captured at the datetime when, and returns its key
+     - remove(keys) : removes frames, and returns the number of bytes freed
+    '''
+
+    movable = False  # Frames can be moved to another directory with os.rename
+
+    @abstractmethod
+    def keys(self, since=None):
+        '''
+        Yields the keys of all frames, oldest first. Frames captured before the UNIX timestamp since may be skipped
+        '''
+
+    @abstractmethod
+    def timestamp(self, key):
+        '''
+        Returns the time at which a frame was captured or written, as a UNIX timestamp
+        '''
+
+    @abstractmethod
+    def size(self, key):
+        '''
+        Returns the number of bytes that a frame takes on disk
+        '''
+
+    @abstractmethod
+    def read(self, key):
+        '''
+        Returns the encoded frame, or None if it no longer exists
+        '''
+
+    def load(self, key, width=None, grayscale=False):
+        '''
+        Returns the decoded frame, see ImageLoader.load(), or None if it can not be read
+        '''
+        # Stored frames never change, so their path identifies them in the shared cache
+        cache_key = (os.path.normpath(self.path(key)), None, None, width, grayscale)
+        image = ImageLoader.cache.get(cache_key)
+        if image is not None:
+            return image
+
+        data = self.read(key)
+        if data is None:
+            return None
+        image = ImageLoader.decode(data, width, grayscale)
+        if image is not None and ImageLoader.cache.max_bytes > 0:
+            ImageLoader.cache.put(cache_key, image)
+        return image
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def watcher(self):
+        '''
+        Returns a DirectoryWatcher that reports new keys, or None if the store has to be listed to find them
+        '''
+        return None
+
+    segment_stores = {}  # Directory -> SegmentFrameStore, shared by load_path()
+
+    def load_path(path, width=None, grayscale=False):
+        '''
+        Loads a frame by the path under which the ImageCatalog knows it, whichever store the frame is in
+        '''
+        directory, name = os.path.split(path)
+        if directory.endswith(TimelapseFrameStore.SUFFIX):
+            root, video = os.path.split(directory)
+            return TimelapseFrameStore(root).load(video + '/' + name, width, grayscale)
+        if not directory.endswith(SegmentFrameStore.SUFFIX):
+            return ImageLoader.load(path, width, grayscale)
+
+        root, segment = os.path.split(directory)
+        store = FrameStore.segment_stores.get(root)
+        if store is None:
+            store = SegmentFrameStore(root)
+            FrameStore.segment_stores[root] = store
+        image = store.load(segment + '/' + name, width, grayscale)
+        if image is None:  # The frame may have been written after the store last read the index
+            store.refresh()
+            image = store.load(segment + '/' + name, width, grayscale)
+        return image
+
+
+class FileFrameStore(FrameStore):
+    '''
+    One JPEG file per frame, in the hourly shards of the ShardedLayout. Keys are the paths relative to root
+    '''
+
+    movable = True
+
+    def __init__(self, root, quality=95):
+        self.root = root
+        self.quality = quality
+        self.shard_dir = None  # Shard that frames are currently saved to, so that it is only created once
+
+    def append(self, camera, when, frame):
+        shard_dir = os.path.join(self.root, ShardedLayout.shard(when))
+        if shard_dir != self.shard_dir:
+            os.makedirs(shard_dir, exist_ok=True)
+            self.shard_dir = shard_dir
+
+        key = ShardedLayout.relative_path(camera, when)
+        cv2.imwrite(os.path.join(self.root, key), frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return key
+
+    def keys(self, since=None):
+        return ShardedLayout.walk(self.root, since=since)
+
+    def timestamp(self, key):
+        return os.stat(os.path.join(self.root, key)).st_mtime
+
+    def size(self, key):
+        return os.path.getsize(os.path.join(self.root, key))
+
+    def read(self, key):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def load(self, key, width=None, grayscale=False):
+        # Decoding straight from the file lets ImageLoader cache the size of the frames per directory
+        return ImageLoader.load(os.path.join(self.root, key), width, grayscale)
+
+    def remove(self, keys):
+        freed = 0
+        for key in keys:
+            try:
+                path = os.path.join(self.root, key)
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed = freed + size
+            except FileNotFoundError:  # Already removed by another component
+                pass
+        return freed
+
+    def watcher(self):
+        return DirectoryWatcher(self.root, recursive=True)
+
+
+class SegmentFrameStore(FrameStore):
+    '''
+    Appends the encoded frames of a camera to large segment files, instead of creating one small file per frame. Every frame file
+    costs an inode, a directory entry and journaled metadata updates, which multiply the writes to flash media, and deleting
+    old footage takes one unlink per frame.
+
+    A segment '<camera> - YYYYMMDD-HHMMSS-ffffff.seg' holds the JPEG data of the frames back to back, and the index
+    '<segment>.idx' holds one (capture time, offset, length) record per frame. The data of a frame is written before its index
+    record, so a frame is only visible once it is complete, and records that point past the end of a crashed segment are ignored.
+    Removed frames are listed in '<segment>.del'; their space is reclaimed when the retention policy drops the whole segment.
+    Frames are read through a memory map of the segment, so that reading a frame does not copy the segment through a file buffer.
+
+    Keys are '<segment>/<frame number>', so that the catalog paths of all frames of a segment share the segment path as prefix.
+    Separate instances can share a directory, e.g. the motion detector appends while the filter reads: refresh() reads the
+    records that were appended to the index files since the previous call.
+    '''
+
+    SUFFIX = '.seg'
+    RECORD = struct.Struct('<dQI')  # capture time, offset, length
+    DELETED = struct.Struct('<I')  # frame number
+
+    def __init__(self, root, segment_bytes=64*2**20, segment_seconds=60*60, quality=95):
+        '''
+        root : directory of the camera
+        segment_bytes : size after which a new segment is started
+        segment_seconds : age after which a new segment is started, so that quiet cameras still produce segments that can be dropped
+        quality : JPEG quality of the stored frames
+        '''
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.quality = quality
+        self.lock = Lock()
+
+        self.segments = {}  # segment name -> {'frames': [(captured, offset, length)], 'deleted': set, 'index_pos', 'deleted_pos'}
+        self.maps = {}  # segment name -> mmap of the segment
+        self.writers = {}  # camera -> [segment name, data file, index file, size, start time]
+
+    def segment_name(camera, when):
+        return camera + " - " + when.strftime(ShardedLayout.NAME_FORMAT) + SegmentFrameStore.SUFFIX
+
+    def split_key(key):
+        segment, _, number = key.rpartition('/')
+        return segment, int(number)
+
+    def append(self, camera, when, frame):
+        ok, data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            raise ValueError("Could not encode frame")
+        data = data.tobytes()
+
+        with self.lock:
+            writer = self.writers.get(camera)
+            if writer is None or writer[3] >= self.segment_bytes or when.timestamp() - writer[4] >= self.segment_seconds:
+                if writer is not None:
+                    writer[1].close()
+                    writer[2].close()
+                name = SegmentFrameStore.segment_name(camera, when)
+                os.makedirs(self.root, exist_ok=True)
+                writer = [name, open(os.path.join(self.root, name), 'ab', buffering=0),
+                          open(os.path.join(self.root, name + '.idx'), 'ab', buffering=0), 0, when.timestamp()]
+                self.writers[camera] = writer
+
+            name, data_file, index_file, offset, start = writer
+            data_file.write(data)
+            index_file.write(SegmentFrameStore.RECORD.pack(when.timestamp(), offset, len(data)))
+            writer[3] = offset + len(data)
+
+            self.refresh_segment(name)
+            return name + '/' + str(len(self.segments[name]['frames']) - 1)
+
+    def read_new(path, pos, record):
+        '''
+        Returns the records appended to path since pos, and the position after them
+        '''
+        try:
+            with open(path, 'rb') as f:
+                f.seek(pos)
+                data = f.read()
+        except FileNotFoundError:
+            return [], pos
+        data = data[:len(data) - len(data) % record.size]  # Ignore a record that is still being written
+        return list(record.iter_unpack(data)), pos + len(data)
+
+    def refresh_segment(self, name):
+        segment = self.segments.setdefault(name, {'frames': [], 'deleted': set(), 'index_pos': 0, 'deleted_pos': 0})
+        path = os.path.join(self.root, name)
+
+        records, segment['index_pos'] = SegmentFrameStore.read_new(path + '.idx', segment['index_pos'], SegmentFrameStore.RECORD)
+        if records:
+            data_size = os.path.getsize(path)
+            segment['frames'].extend(r for r in records if r[1] + r[2] <= data_size)
+
+        deleted, segment['deleted_pos'] = SegmentFrameStore.read_new(path + '.del', segment['deleted_pos'], SegmentFrameStore.DELETED)
+        segment['deleted'].update(r[0] for r in deleted)
+
+    def refresh(self):
+        '''
+        Picks up segments and frames written by other instances, and forgets segments that were dropped
+        '''
+        try:
+            with os.scandir(self.root) as it:
+                names = sorted(entry.name for entry in it if entry.name.endswith(SegmentFrameStore.SUFFIX))
+        except FileNotFoundError:
+            names = []
+
+        with self.lock:
+            for name in set(self.segments) - set(names):
+                self.forget(name)
+            for name in names:
+                self.refresh_segment(name)
+
+    def forget(self, name):
+        self.segments.pop(name, None)
+        segment_map = self.maps.pop(name, None)
+        if segment_map is not None:
+            segment_map.close()
+
+    def keys(self, since=None):
+        self.refresh()
+        with self.lock:
+            segments = [(name, list(self.segments[name]['frames']), set(self.segments[name]['deleted']))
+                        for name in sorted(self.segments)]
+
+        for name, frames, deleted in segments:
+            if since is not None and frames and frames[-1][0] < since:
+                continue
+            for number, frame in enumerate(frames):
+                if number not in deleted and (since is None or frame[0] >= since):
+                    yield name + '/' + str(number)
+
+    def frame(self, key):
+        name, number = SegmentFrameStore.split_key(key)
+        segment = self.segments.get(name)
+        if segment is None or number >= len(segment['frames']) or number in segment['deleted']:
+            raise FileNotFoundError(key)
+        return segment['frames'][number]
+
+    def timestamp(self, key):
+        with self.lock:
+            return self.frame(key)[0]
+
+    def size(self, key):
+        with self.lock:
+            return self.frame(key)[2]
+
+    def read(self, key):
+        with self.lock:
+            try:
+                captured, offset, length = self.frame(key)
+            except FileNotFoundError:
+                return None
+
+            name = SegmentFrameStore.split_key(key)[0]
+            segment_map = self.maps.get(name)
+            if segment_map is None or len(segment_map) < offset + length:
+                # The segment grew since it was mapped
+                if segment_map is not None:
+                    segment_map.close()
+                try:
+                    with open(os.path.join(self.root, name), 'rb') as f:
+                        segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (FileNotFoundError, ValueError):
+                    self.maps.pop(name, None)
+                    return None
+                self.maps[name] = segment_map
+
+            return segment_map[offset:offset + length]
+
+    def remove(self, keys):
+        '''
+        Marks frames as removed. The space is only freed once the segment is dropped, so 0 is returned
+        '''
+        by_segment = {}
+        for key in keys:
+            name, number = SegmentFrameStore.split_key(key)
+            by_segment.setdefault(name, []).append(number)
+
+        with self.lock:
+            for name in by_segment:
+                if not os.path.isfile(os.path.join(self.root, name)):
+                    continue
+                with open(os.path.join(self.root, name + '.del'), 'ab') as f:
+                    f.write(b''.join(SegmentFrameStore.DELETED.pack(number) for number in by_segment[name]))
+                if name in self.segments:
+                    self.segments[name]['deleted'].update(by_segment[name])
+        return 0
+
+    def segment_list(self):
+        '''
+        Returns (start time, segment name, size in bytes, open) tuples of all segments, oldest first. Open segments are still
+        being written to by this instance
+        '''
+        self.refresh()
+        open_segments = set(writer[0] for writer in self.writers.values())
+        segments = []
+        with self.lock:
+            # Another instance may still be appending to the newest segment of each camera
+            newest = {}
+            for name in sorted(self.segments):
+                newest[ShardedLayout.camera_of(name)] = name
+            open_segments.update(newest.values())
+
+            for name in sorted(self.segments):
+                frames = self.segments[name]['frames']
+                try:
+                    size = os.path.getsize(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    continue
+                start = frames[0][0] if frames else os.path.getmtime(os.path.join(self.root, name))
+                segments.append((start, name, size, name in open_segments))
+        return segments
+
+    def segment_keys(self, name):
+        '''
+        Returns the keys of the frames of a segment that have not been removed
+        '''
+        with self.lock:
+            segment = self.segments.get(name)
+            if segment is None:
+                return []
+            return [name + '/' + str(number) for number in range(len(segment['frames'])) if number not in segment['deleted']]
+
+    def drop(self, name):
+        '''
+        Removes a whole segment with its index. Returns the number of bytes freed
+        '''
+        freed = 0
+        with self.lock:
+            self.forget(name)
+            for suffix in ('', '.idx', '.del'):
+                try:
+                    path = os.path.join(self.root, name + suffix)
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    freed = freed + size
+                except FileNotFoundError:
+                    pass
+        return freed
+
+class TimelapseFrameStore(FrameStore):
+    '''
+    Read only view of the frames of the timelapse videos that the TimelapseCompactor writes below root, so that compacted stills
+    can still be listed, catalogued and shown. Keys are '<video path relative to root>/<frame number>', and the capture time of
+    every frame comes from the index next to the video. Frames can not be removed one by one, the RetentionPolicy deletes whole
+    videos.
+    '''
+
+    SUFFIX = '.timelapse.mp4'
+
+    def __init__(self, root):
+        self.root = root
+        self.indexes = {}  # relative video path -> (modification time of the index, rows)
+
+    def read_index(index_file):
+        rows = []
+        with open(index_file) as f:
+            for line in f:
+                number, captured, name = line.rstrip('\n').split('\t')
+                rows.append((int(number), float(captured), name))
+        return rows
+
+    def index(self, video):
+        index_file = os.path.join(self.root, video + '.tsv')
+        mtime = os.path.getmtime(index_file)
+        cached = self.indexes.get(video)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, TimelapseFrameStore.read_index(index_file))
+            self.indexes[video] = cached
+        return cached[1]
+
+    def frame(self, key):
+        video, number = SegmentFrameStore.split_key(key)
+        rows = self.index(video)
+        if number >= len(rows):
+            raise FileNotFoundError(key)
+        return video, number, rows
+
+    def keys(self, since=None):
+        for video in ShardedLayout.walk(self.root, since=since, suffix=TimelapseFrameStore.SUFFIX):
+            try:
+                rows = self.index(video)
+            except FileNotFoundError:  # Not verified yet, or left behind by a crash
+                continue
+            for number, captured, name in rows:
+                if since is None or captured >= since:
+                    yield video + '/' + str(number)
+
+    def timestamp(self, key):
+        video, number, rows = self.frame(key)
+        return rows[number][1]
+
+    def size(self, key):
+        # Frames are encoded as differences, so every frame gets an equal share of the video
+        video, number, rows = self.frame(key)
+        return os.path.getsize(os.path.join(self.root, video)) // max(len(rows), 1)
+
+    def load(self, key, width=None, grayscale=False):
+        video, number = SegmentFrameStore.split_key(key)
+        capture = cv2.VideoCapture(os.path.join(self.root, video))
+        capture.set(cv2.CAP_PROP_POS_FRAMES, number)
+        ok, image = capture.read()
+        capture.release()
+        if not ok:
+            return None
+        if width is not None and image.shape[1] > width:
+            image = imutils.resize(image, width=width)
+        if grayscale:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+
+    def read(self, key):
+        image = self.load(key)
+        if image is None:
+            return None
+        return cv2.imencode('.jpg', image)[1].tobytes()
+
+# === CAMERA CONFIG ===
+
+class CameraChanges:
+    '''
+    Collects the changes of a CameraConfig for a consumer that applies them from its own thread. Changes are
+    (event, name, src) tuples, where event is 'added' or 'removed'; a camera whose source changed is removed and added again.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.changes = []
+
+    def __call__(self, event, name, src):
+        with self.lock:
+            self.changes.append((event, name, src))
+
+    def drain(self):
+        '''
+        Returns the changes since the previous call, oldest first
+        '''
+        with self.lock:
+            changes = self.changes
+            self.changes = []
+        return changes
+
+
+class CameraConfig:
+    '''
+    Keeps the saved cameras in memory, so that they are only unpickled when the file changes, and writes them atomically,
+    so that a crash can never leave a half written file behind. The GUI and the running system are separate processes that
+    share the file, so refresh() compares the file's modification time and size to notice the other process' changes.
+
+    Subscribers are called with (event, name, src) for every camera that is added or removed, by whichever thread made or
+    noticed the change. Consumers that have to apply changes from their own thread subscribe a CameraChanges (see changes()).
+    Use CameraConfig.get(filepath), which returns the same instance for every call with the same directory.
+    '''
+
+    instances = {}
+    instances_lock = Lock()
+
+    def get(filepath):
+        '''
+        Returns the config of the saved_cameras.pickle file in filepath
+        '''
+        key = os.path.abspath(filepath)
+        with CameraConfig.instances_lock:
+            if key not in CameraConfig.instances:
+                CameraConfig.instances[key] = CameraConfig(filepath)
+            return CameraConfig.instances[key]
+
+    def __init__(self, filepath):
+        self.file = os.path.join(filepath, 'saved_cameras.pickle')
+        self.lock = Lock()
+        self.cameras = {}  # name -> src, in the order in which they were added
+        self.signature = None  # (mtime_ns, size) of the file when it was last read or written, None if it does not exist
+        self.subscribers = []
+        self.refresh()
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def exists(self):
+        return self.signature is not None
+
+    def refresh(self):
+        '''
+        Reloads the file if another process changed it, and notifies the subscribers. Returns the changes
+        '''
+        with self.lock:
+            signature = self.file_signature()
+            if signature == self.signature:
+                return []
+
+            cameras = {}
+            if signature is not None:
+                try:
+                    with open(self.file, 'rb') as f:
+                        cameras = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError) as e:
+                    print("[ERROR - CameraConfig] Could not read saved cameras, keeping the previous list: ", e)
+                    return []
+                print("[INFO - CameraConfig] Loaded {} saved cameras".format(len(cameras)))
+
+            changes = CameraConfig.diff(self.cameras, cameras)
+            self.cameras = cameras
+            self.signature = signature
+        self.notify(changes)
+        return changes
+
+    def diff(old, new):
+        changes = []
+        for name in old:
+            if new.get(name) != old[name]:
+                changes.append(('removed', name, old[name]))
+        for name in new:
+            if old.get(name) != new[name]:
+                changes.append(('added', name, new[name]))
+        return changes
+
+    def persist(self):
+        # Write to a temporary file first, and only then replace the saved file
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self.cameras, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.file)
+        self.signature = self.file_signature()
+
+    def list(self):
+        '''
+        Returns a list of [name, src] lists of the saved cameras
+        '''
+        self.refresh()
+        with self.lock:
+            return [[name, self.cameras[name]] for name in self.cameras]
+
+    def add(self, name, src):
+        '''
+        Saves a camera, and returns False if a camera with the same source has already been saved
+        '''
+        self.refresh()
+        with self.lock:
+            if src in self.cameras.values():
+                return False
+            old = dict(self.cameras)
+            self.cameras[name] = src
+            self.persist()
+            changes = CameraConfig.diff(old, self.cameras)
+        self.notify(changes)
+        return True
+
+    def remove(self, name):
+        '''
+        Removes a saved camera, and returns False if no camera has this name
+        '''
+        self.refresh()
+        with self.lock:
+            if name not in self.cameras:
+                return False
+            src = self.cameras.pop(name)
+            self.persist()
+        self.notify([('removed', name, src)])
+        return True
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def changes(self):
+        '''
+        Returns a CameraChanges that receives every change from now on
+        '''
+        changes = CameraChanges()
+        self.subscribe(changes)
+        return changes
+
+    def notify(self, changes):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for event, name, src in changes:
+            for callback in subscribers:
+                callback(event, name, src)
@@ -1,28 +1,107 @@
-from components_reduced import CameraManager, StorageManager, SystemMotionDetection, SystemFiltering
+from components_reduced import CameraManager, CameraConfig, ImageCatalog, StorageManager, SystemMotionDetection, SystemFiltering, TieredRecompressor, HumanDetectorUtil, SegmentFrameStore, TimelapseCompactor, UsageLedger, LiveViewServer, SystemPipeline, MetricsServer, CAMERA_BYTES, LIVE_VIEW_CLIENTS, Tracer
 from threading import Thread
+import signal
+import time
 
-SM = StorageManager(work_in_dir='../bin/storage', interval=3000, space = 5, critical_space=2)
+CATALOG = ImageCatalog('../bin/catalog.db')
+SEGMENTS = False  # Append frames to segment files instead of saving one file per frame
+LEDGER = UsageLedger()  # Bytes used per camera, updated by every component that writes or deletes frames
+QUOTAS = {}  # GiB that a camera may use, e.g. {'Driveway': 20}
+PIPELINE = False  # Run capture, motion, save, classify, filter and retention as one pipeline with bounded queues
+LIVE_VIEW_PORT = 8080  # Port of the MJPEG live view (http://127.0.0.1:8080/), None to disable it
+LIVE_VIEW_HOST = '127.0.0.1'  # Address the live view listens on, '0.0.0.0' to serve other machines (set a user and password)
+LIVE_VIEW_USER = None  # User and password that browsers must send to see the live view, None to not ask for any
+LIVE_VIEW_PASSWORD = None
+TRACE = False  # Record timing spans from the start, otherwise send SIGUSR1 to start and dump them (SIGUSR2 samples stacks)
+METRICS_PORT = 9108  # Port of the Prometheus metrics (http://127.0.0.1:9108/metrics), None to disable them
+
+Tracer.install_signal_handlers('../bin/profiles/')
+if TRACE:
+    Tracer.enable()
+
+CONFIG = CameraConfig.get('../bin/')  # Cameras added or removed from the GUI are started or stopped without a restart
+cam_list = CameraManager.list_cameras('../bin/') or []
+SM = StorageManager(work_in_dir='../bin/storage', interval=3000, space = 5, critical_space=2,
+                    camera_dirs=['../bin/' + c[0] + '/' for c in cam_list], catalog=CATALOG,
+                    stores=[SegmentFrameStore('../bin/' + c[0] + '/') for c in cam_list] if SEGMENTS else None, ledger=LEDGER,
+                    quotas=QUOTAS)
+
+TR = TieredRecompressor(['../bin/storage/'] + ['../bin/' + c[0] + '/' for c in cam_list], interval=60,
+                        detector_util=HumanDetectorUtil(), catalog=CATALOG, ledger=LEDGER)
+
+TC = TimelapseCompactor(['../bin/' + c[0] + '/' for c in cam_list], interval=60, detector_util=HumanDetectorUtil(), catalog=CATALOG,
+                        ledger=LEDGER)
+
+def manage_new_camera(event, name, src):
+    '''
+    Adds the directory of a camera that was added while running to storage management. The directories of removed cameras stay
+    managed, since their footage remains until it is deleted by retention
+    '''
+    camera_dir = '../bin/' + name + '/'
+    if event != 'added' or camera_dir in TC.directories:
+        return
+    SM.add_camera_dir(camera_dir, SegmentFrameStore(camera_dir) if SEGMENTS else None)
+    TR.directories.append(camera_dir)
+    TC.directories.append(camera_dir)
+
+CONFIG.subscribe(manage_new_camera)
 
 def clean_storage():
     print("STORAGE MANAGER THREAD")
     while True:
         SM.reduce_files()
+        time.sleep(1)  # Quotas are checked on every call, once a second is often enough
+
+def recompression():
+    while True:
+        TC.compact()
+        TR.recompress()
+        time.sleep(60)
+
+LIVE_VIEW = LiveViewServer(host=LIVE_VIEW_HOST, port=LIVE_VIEW_PORT, user=LIVE_VIEW_USER, password=LIVE_VIEW_PASSWORD) if LIVE_VIEW_PORT is not None else None
+if LIVE_VIEW is not None:
+    LIVE_VIEW.start()
+
+if METRICS_PORT is not None:
+    CAMERA_BYTES.set_function(LEDGER.snapshot)
+    if LIVE_VIEW is not None:
+        LIVE_VIEW_CLIENTS.set_function(lambda: {camera: stats['clients'] for camera, stats in LIVE_VIEW.stats().items()})
+    MetricsServer(port=METRICS_PORT).start()
 
 def detection():
-    SystemMotionDetection.start()
+    SystemMotionDetection.start(catalog=CATALOG, segments=SEGMENTS, ledger=LEDGER, live_view=LIVE_VIEW, config=CONFIG)
 def filtering():
-    SystemFiltering.start(filter_interval=1000)
-    
-MD_THREAD = Thread(target = detection)
-MD_THREAD.start()
+    SystemFiltering.start(filter_interval=1000, catalog=CATALOG, segments=SEGMENTS, ledger=LEDGER, config=CONFIG)
+
+RECOMPRESSION_THREAD = Thread(target=recompression)
+RECOMPRESSION_THREAD.daemon = True
+RECOMPRESSION_THREAD.start()
 
-FILTERING_THREAD = Thread(target=filtering)    
-FILTERING_THREAD.daemon = True
-FILTERING_THREAD.start()
+if PIPELINE:
+    SP = SystemPipeline(SM, catalog=CATALOG, segments=SEGMENTS, ledger=LEDGER, live_view=LIVE_VIEW, config=CONFIG,
+                        filter_interval=1000)
+    SP.start()
 
-STORAGE_THREAD = Thread(target=clean_storage)
-STORAGE_THREAD.daemon = True
-STORAGE_THREAD.start()
+    def shutdown(signum, frame):
+        # Finish the frames that are already in the pipeline before exiting
+        SP.stop(timeout=30)
+        raise SystemExit(0)
 
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    while True:
+        time.sleep(60)
+        for stage, stats in SP.stats().items():
+            print("[INFO - SystemPipeline] {}: {} queued, {} processed, {} dropped, {:.2f} s mean latency".format(
+                stage, stats['queued'], stats['processed'], stats['dropped'], stats['mean_latency']))
+else:
+    MD_THREAD = Thread(target = detection)
+    MD_THREAD.start()
 
+    FILTERING_THREAD = Thread(target=filtering)
+    FILTERING_THREAD.daemon = True
+    FILTERING_THREAD.start()
 
+    STORAGE_THREAD = Thread(target=clean_storage)
+    STORAGE_THREAD.daemon = True
+    STORAGE_THREAD.start()
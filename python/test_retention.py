@@ -0,0 +1,101 @@
+'''
+-----------------------------------------------
+title: test_retention.py
+description: Checks that the RetentionPolicy ranks the frames of segment stores with the images, never drops a segment
+             holding a human unless forced, and does not repeat a quota pass that freed nothing. Run with python3 -m pytest
+             from the python directory
+-----------------------------------------------
+'''
+
+import datetime
+import os
+
+import numpy as np
+
+from components_reduced import RetentionPolicy, SegmentFrameStore, ShardedLayout
+
+
+class BrightIsHuman:
+    '''
+    Stands in for the HumanDetectorUtil: white frames contain a human, black frames do not
+    '''
+
+    def detect(self, frame):
+        return frame.mean() > 128
+
+    def detect_file(self, path):
+        return False
+
+
+class AlwaysHuman:
+    '''
+    Stands in for the HumanDetectorUtil: every image contains a human
+    '''
+
+    def detect(self, frame):
+        return True
+
+    def detect_file(self, path):
+        return True
+
+
+def write_segments(root):
+    '''
+    Writes three segments of a camera, a minute apart. The first holds a human, the last is still being written.
+    Returns the store and the segment names, oldest first
+    '''
+    store = SegmentFrameStore(str(root), segment_seconds=60)
+    start = datetime.datetime(2024, 5, 6, 7, 0, 0)
+    black = np.zeros((120, 160, 3), np.uint8)
+    white = np.full((120, 160, 3), 255, np.uint8)
+
+    for seconds, frame in [(0, black), (10, white), (100, black), (110, black), (200, black)]:
+        store.append('Cam', start + datetime.timedelta(seconds=seconds), frame)
+    return store, [name for start_time, name, size, is_open in store.segment_list()]
+
+
+def test_segment_with_human_survives_enforce(tmp_path):
+    store, segments = write_segments(tmp_path)
+    policy = RetentionPolicy([(str(tmp_path), False)], volume=str(tmp_path), detector_util=BrightIsHuman(), stores=[store])
+    policy.free_space = lambda: 0  # Never enough space, so that everything that may be deleted is
+
+    assert len(policy.frames) == 5
+    freed = policy.enforce(target_free=1)
+
+    assert freed > 0
+    assert os.path.isfile(os.path.join(tmp_path, segments[0]))  # Holds a human
+    assert not os.path.exists(os.path.join(tmp_path, segments[1]))
+    assert os.path.isfile(os.path.join(tmp_path, segments[2]))  # Still being written
+    assert len(policy.frames) == 3
+
+
+def test_forced_enforce_drops_segment_with_human(tmp_path):
+    store, segments = write_segments(tmp_path)
+    policy = RetentionPolicy([(str(tmp_path), False)], volume=str(tmp_path), detector_util=BrightIsHuman(), stores=[store])
+    policy.free_space = lambda: 0
+
+    policy.enforce(target_free=1)
+    policy.enforce(target_free=1, force=True)
+
+    assert not os.path.exists(os.path.join(tmp_path, segments[0]))
+    assert os.path.isfile(os.path.join(tmp_path, segments[2]))
+
+
+def test_stalled_quota_pass_is_not_repeated(tmp_path):
+    start = datetime.datetime(2024, 5, 6, 7, 0, 0)
+    for seconds in range(20):
+        with open(os.path.join(tmp_path, ShardedLayout.file_name('Cam', start + datetime.timedelta(seconds=seconds))), 'wb') as f:
+            f.write(b'\0' * 100)
+    log_file = os.path.join(tmp_path, 'retention.log')
+    policy = RetentionPolicy([(str(tmp_path), False)], volume=str(tmp_path), quotas={'Cam': 1}, log_file=log_file,
+                             detector_util=AlwaysHuman())
+
+    for i in range(50):
+        assert policy.enforce_quotas() == 0
+    with open(log_file) as f:
+        assert len(f.readlines()) == 20  # One keep per image
+
+    policy.ledger.record('Cam', 100)  # A new frame was written, so the camera is looked at again, without logging the keeps again
+    policy.enforce_quotas()
+    with open(log_file) as f:
+        assert len(f.readlines()) == 20